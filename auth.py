@@ -1,65 +1,320 @@
+import asyncio
 import hashlib
+import heapq
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog import SharedCatalog
+import metrics
+from locks import ReadWriteLock
 from main import Agent
 
+# the cost of hashing a password; raise it as hardware gets faster
+ITERATIONS = 200000
+ALGORITHM = 'pbkdf2_sha256'
+
+
+def hash_password(password, iterations=ITERATIONS):
+    '''
+    Returns the salted PBKDF2 hash of the password as "pbkdf2_sha256$iterations$salt$hash".
+    '''
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return '{}${}${}${}'.format(ALGORITHM, iterations, salt.hex(), digest.hex())
+
+
+def check_password(password, password_hash):
+    '''
+    Tells whether the password matches the hash. Unsalted SHA-256 hashes of older accounts are accepted too.
+    '''
+    if '$' not in password_hash:
+        digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        return hmac.compare_digest(digest, password_hash)
+    algorithm, iterations, salt, expected = password_hash.split('$')
+    if algorithm != ALGORITHM:
+        return False
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def needs_rehash(password_hash, iterations=ITERATIONS):
+    '''
+    Tells whether the hash is unsalted or cheaper than the given number of iterations.
+    '''
+    parts = password_hash.split('$')
+    return len(parts) != 4 or parts[0] != ALGORITHM or int(parts[1]) < iterations
+
+
 class User(Agent):
 
-    def __init__(self, username, password):
-        super().__init__()
+    def __init__(self, username, password, catalog=None, iterations=ITERATIONS):
+        super().__init__(catalog)
         self.username = username
-        self.password = User.__encrypt(password)
-        self.logged_in = False
-
-    @staticmethod
-    def __encrypt(password: str):
-        password = password.encode('utf-8')
-        return hashlib.sha256(password).hexdigest()
+        self.password = hash_password(password, iterations)
+        # bits of the permissions given by the Authorizer directly, and together with the roles of the user
+        self.permission_mask = 0
+        self.effective_mask = 0
+        self.roles = set()
+
+    @classmethod
+    def restore(cls, username, password_hash, catalog=None):
+        '''
+        Creates a user from the stored hash of the password.
+        '''
+        user = cls.__new__(cls)
+        Agent.__init__(user, catalog)
+        user.username = username
+        user.password = password_hash
+        user.permission_mask = 0
+        user.effective_mask = 0
+        user.roles = set()
+        return user
 
     def verify_password(self, to_verify):
-        to_verify = to_verify.encode('utf-8')
-        to_verify = hashlib.sha256(to_verify).hexdigest()
-        return to_verify == self.password
+        return check_password(to_verify, self.password)
 
 
-class Authenticator:
+class UserStore(dict):
+    '''
+    The default in-memory storage of the users: a dictionary username -> User.
+    Other storages (e.g. storage.SQLiteUserStore) provide the same mapping interface.
+    '''
 
-    def __init__(self):
-        self.users = {}
+    def __init__(self, catalog=None):
+        '''
+        :catalog: The SharedCatalog of the listings of all the users. An in-memory one by default.
+        '''
+        super().__init__()
+        self.catalog = SharedCatalog() if catalog is None else catalog
+
+    def create_catalog(self, username):
+        '''
+        Returns the view of the shared catalog seen by the user.
+        '''
+        return self.catalog.view(username)
+
+
+class Session:
+    __slots__ = ('token', 'username', 'created', 'last_used')
+
+    def __init__(self, token, username, created):
+        self.token = token
+        self.username = username
+        self.created = created
+        self.last_used = created
+
+
+class SessionManager:
+    '''
+    Keeps the sessions opened by logging in. Every session has an opaque token; it expires when it is
+    not used for idle_ttl seconds or absolute_ttl seconds after it was opened. A user may have many sessions.
+    Expired sessions are evicted with a heap of deadlines, so no sweep over all the sessions is needed.
+    The sessions may be opened and resolved from several threads.
+    '''
+
+    def __init__(self, idle_ttl=30 * 60, absolute_ttl=24 * 60 * 60, clock=time.monotonic):
+        '''
+        :idle_ttl: Seconds after which an unused session expires.
+        :absolute_ttl: Seconds after which a session expires even if it is used.
+        :clock: The function returning the current time in seconds.
+        '''
+        self.idle_ttl = idle_ttl
+        self.absolute_ttl = absolute_ttl
+        self.clock = clock
+        self.sessions = {}
+        # username -> tokens of the sessions of the user
+        self.by_user = {}
+        # (deadline, token); a deadline may be earlier than the real one if the session was used since
+        self.deadlines = []
+        self.mutex = threading.RLock()
+
+    def _deadline(self, session):
+        return min(session.last_used + self.idle_ttl, session.created + self.absolute_ttl)
+
+    def evict(self):
+        '''
+        Closes the expired sessions.
+        '''
+        with self.mutex:
+            now = self.clock()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, token = heapq.heappop(self.deadlines)
+                session = self.sessions.get(token)
+                if session is None:
+                    continue
+                deadline = self._deadline(session)
+                if deadline <= now:
+                    self.close(token)
+                else:
+                    heapq.heappush(self.deadlines, (deadline, token))
+
+    def open(self, username):
+        '''
+        Opens a new session of the user and returns its token.
+        '''
+        with self.mutex:
+            self.evict()
+            token = secrets.token_urlsafe(24)
+            session = Session(token, username, self.clock())
+            self.sessions[token] = session
+            self.by_user.setdefault(username, set()).add(token)
+            heapq.heappush(self.deadlines, (self._deadline(session), token))
+            return token
+
+    def resolve(self, token):
+        '''
+        Returns the username of the session and marks the session as used.
+        '''
+        with self.mutex:
+            session = self.sessions.get(token)
+            if session is None:
+                raise InvalidSession
+            now = self.clock()
+            if self._deadline(session) <= now:
+                self.close(token)
+                raise InvalidSession
+            session.last_used = now
+            return session.username
+
+    def close(self, token):
+        '''
+        Closes the session; closing an unknown or expired session does nothing.
+        '''
+        with self.mutex:
+            session = self.sessions.pop(token, None)
+            if session is None:
+                return
+            tokens = self.by_user[session.username]
+            tokens.discard(token)
+            if not tokens:
+                del self.by_user[session.username]
+
+    def close_all(self, username):
+        '''
+        Closes all the sessions of the user.
+        '''
+        with self.mutex:
+            for token in list(self.by_user.get(username, ())):
+                self.close(token)
+
+    def count(self, username):
+        '''
+        Returns the number of open sessions of the user.
+        '''
+        with self.mutex:
+            self.evict()
+            return len(self.by_user.get(username, ()))
+
+
+class Authenticator:
+    '''
+    Keeps the users and their sessions. The users may be read from many threads at once;
+    adding and deleting users takes the lock for writing. Passwords are hashed outside the lock.
+    '''
+
+    def __init__(self, users=None, iterations=ITERATIONS, workers=None, sessions=None):
+        '''
+        :users: The storage of the users. A UserStore by default.
+        :iterations: The cost of hashing the passwords. Older hashes are upgraded at the next log in.
+        :workers: The number of threads verifying the passwords for log_in_async().
+        :sessions: The SessionManager of the logged in users.
+        '''
+        self.users = UserStore() if users is None else users
+        self.iterations = iterations
+        self.workers = workers
+        self.executor = None
+        self.sessions = SessionManager() if sessions is None else sessions
+        self.lock = ReadWriteLock('users')
 
     def add_user(self, username, password):
         if len(password) < 6:
             raise PasswordTooShort
-        if username in self.users:
-            raise AlreadyExists
-        self.users[username] = User(username, password)
-
+        with self.lock.read():
+            if username in self.users:
+                raise AlreadyExists
+        user = User(username, password, self.users.create_catalog(username), self.iterations)
+        with self.lock.write():
+            if username in self.users:
+                raise AlreadyExists
+            self.users[username] = user
+
+    @metrics.timed('log_in')
     def log_in(self, username, password):
+        '''
+        Verifies the password and returns the token of a new session of the user.
+        The token is then used instead of the password, see authenticate().
+        '''
         try:
-            user = self.users[username]
-            if user.logged_in:
-                raise AlreadyLoggedIn
-            if not user.verify_password(password):
-                raise InvalidPassword
-            user.logged_in = True
-            return True
+            with self.lock.read():
+                user = self.users[username]
         except KeyError:
             raise DoesNotExist
-
-    def is_logged_in(self, username):
+        if not user.verify_password(password):
+            raise InvalidPassword
+        if needs_rehash(user.password, self.iterations):
+            password_hash = hash_password(password, self.iterations)
+            with self.lock.write():
+                user.password = password_hash
+                # written back so that storages other than a dictionary save the new hash
+                self.users[username] = user
+        return self.sessions.open(username)
+
+    def authenticate(self, token):
+        '''
+        Returns the user of the session; raises InvalidSession if the session expired or was closed.
+        '''
         try:
-            if self.users[username].logged_in:
-                return True
-            return False
+            username = self.sessions.resolve(token)
+            with self.lock.read():
+                return self.users[username]
         except KeyError:
-            return False
+            raise InvalidSession
+
+    def log_out(self, token):
+        self.sessions.close(token)
+
+    async def log_in_async(self, username, password):
+        '''
+        Logs the user in on a worker thread, so that hashing the password does not block the event loop.
+        hashlib releases the GIL while hashing, so several log ins are verified in parallel.
+        '''
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='log-in')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.log_in, username, password)
+
+    def is_logged_in(self, username):
+        return self.sessions.count(username) > 0
 
     def del_user(self, username):
-        try:
-            del self.users[username]
-        except KeyError:
-            raise DoesNotExist
+        with self.lock.write():
+            try:
+                del self.users[username]
+            except KeyError:
+                raise DoesNotExist
+            self.sessions.close_all(username)
+            self.users.catalog.forget_owner(username)
+
+    def restore_user(self, user, listing_ids=()):
+        '''
+        Adds back a user removed by del_user(), with their password and permissions, e.g. to undo the removal.
+        :listing_ids: The IDs of the listings the user owned; they are owned by the user again.
+        '''
+        with self.lock.write():
+            if user.username in self.users:
+                raise AlreadyExists
+            self.users[user.username] = user
+            if listing_ids:
+                self.users.catalog.adopt(user.username, listing_ids)
 
     def list_users(self):
-        for user in self.users:
+        with self.lock.read():
+            usernames = list(self.users)
+        for user in usernames:
             print(user)
         print()
 
@@ -68,56 +323,312 @@ authenticator = Authenticator()
 
 
 class Authorizer:
+    '''
+    Every permission gets a bit, and every user carries the mask of the bits of the permissions
+    they were given, so checking a permission is a single AND.
+    Permissions can also be granted through roles. A role may inherit the permissions of other roles;
+    the mask of every role includes the inherited permissions and is recomputed only when a role
+    changes, so assigning a role and checking a permission do not depend on the depth of the roles.
+    Permissions are checked under a shared lock, so many threads check them at once, while
+    the changes of the permissions and of the roles are made one at a time.
+    '''
 
     def __init__(self):
+        # permission name -> number of its bit
         self.permissions = {}
+        self.names = []
         self.authenticator = authenticator
+        # role name -> mask of the permissions granted to the role itself, and with the inherited ones
+        self.role_grants = {}
+        self.role_masks = {}
+        self.role_parents = {}
+        self.role_children = {}
+        self.role_members = {}
+        # the storage saving the permissions and the roles, see restore_definitions()
+        self.definitions = None
+        self.lock = ReadWriteLock('permissions')
 
     def add_permission(self, perm_name):
-        if perm_name in self.permissions:
-            raise AlreadyExists
-        self.permissions[perm_name] = set()
-
-    def give_permission(self, perm_name, username):
+        with self.lock.write():
+            if perm_name in self.permissions:
+                raise AlreadyExists
+            self.permissions[perm_name] = len(self.names)
+            self.names.append(perm_name)
+            self._save_definitions()
+
+    def _user_and_bit(self, perm_name, username):
         try:
-            user = self.authenticator.users[username]
-            permission = self.permissions[perm_name]
+            return self.authenticator.users[username], 1 << self.permissions[perm_name]
         except KeyError:
             raise DoesNotExist
-        else:
-            permission.add(user)
 
-    def withdraw_permission(self, perm_name, username):
-        try:
-            user = self.authenticator.users[username]
-            permission = self.permissions[perm_name]
-            permission.remove(user)
-        except KeyError:
-            raise DoesNotExist
+    def give_permission(self, perm_name, username):
+        with self.lock.write():
+            user, bit = self._user_and_bit(perm_name, username)
+            user.permission_mask |= bit
+            user.effective_mask |= bit
+            self._save(user)
 
+    def withdraw_permission(self, perm_name, username):
+        with self.lock.write():
+            user, bit = self._user_and_bit(perm_name, username)
+            if not user.permission_mask & bit:
+                raise DoesNotExist
+            user.permission_mask &= ~bit
+            self._update_user(user)
+            self._save(user)
+
+    @metrics.timed('verify_permission')
     def verify_permission(self, perm_name, username):
-        try:
-            user = self.authenticator.users[username]
-            if user in self.permissions[perm_name]:
+        with self.lock.read():
+            user, bit = self._user_and_bit(perm_name, username)
+            if user.effective_mask & bit:
                 return True
+            raise PermissionDenied
+
+    def _save(self, user):
+        '''
+        Writes the user back, so that storages other than a dictionary save their permissions and roles.
+        '''
+        self.authenticator.users[user.username] = user
+
+    def restore(self, user, perm_names, roles):
+        '''
+        Sets the permissions and the roles of a user loaded from a storage, e.g. storage.SQLiteUserStore,
+        from their names. Raises DoesNotExist if one of them is not defined.
+        '''
+        unknown = [name for name in perm_names if name not in self.permissions]
+        unknown += [role for role in roles if role not in self.role_grants]
+        if unknown:
+            raise DoesNotExist('unknown permissions or roles of {}: {}'.format(user.username, ', '.join(unknown)))
+        mask = 0
+        for perm_name in perm_names:
+            mask |= 1 << self.permissions[perm_name]
+        user.permission_mask = mask
+        user.roles = set(roles)
+        for role in user.roles:
+            self.role_members[role].add(user.username)
+        self._update_user(user)
+
+    def restore_definitions(self, storage):
+        '''
+        Adds the permissions and the roles saved in the storage, e.g. storage.SQLiteUserStore, and saves there
+        those defined only here. A saved role keeps its saved permissions and parents.
+        From then on, every change of the permissions and of the roles is saved in the storage.
+        :storage: An object with the methods load_definitions() and save_definitions().
+        '''
+        with self.lock.write():
+            perm_names, roles = storage.load_definitions()
+            for perm_name in perm_names:
+                if perm_name not in self.permissions:
+                    self.permissions[perm_name] = len(self.names)
+                    self.names.append(perm_name)
+            for role in roles:
+                if role not in self.role_grants:
+                    self.role_grants[role] = 0
+                    self.role_masks[role] = 0
+                    self.role_parents[role] = set()
+                    self.role_children[role] = set()
+                    self.role_members[role] = set()
+            for role, (role_perms, parents) in roles.items():
+                mask = 0
+                for perm_name in role_perms:
+                    mask |= 1 << self.permissions[perm_name]
+                self.role_grants[role] = mask
+                for parent in self.role_parents[role]:
+                    self.role_children[parent].discard(role)
+                self.role_parents[role] = set(parents)
+                for parent in parents:
+                    self.role_children[parent].add(role)
+            for role in roles:
+                self._update_role(role)
+            self.definitions = storage
+            self._save_definitions()
+
+    def _save_definitions(self):
+        if self.definitions is not None:
+            self.definitions.save_definitions(self.names, {
+                role: (self.decode(grants), sorted(self.role_parents[role]))
+                for role, grants in self.role_grants.items()})
+
+    def _update_user(self, user):
+        '''
+        Recomputes the mask of all the permissions of the user.
+        '''
+        mask = user.permission_mask
+        for role in user.roles:
+            mask |= self.role_masks[role]
+        user.effective_mask = mask
+
+    def _update_role(self, role):
+        '''
+        Recomputes the mask of the role, and of the roles inheriting from it and their members if it changed.
+        '''
+        mask = self.role_grants[role]
+        for parent in self.role_parents[role]:
+            mask |= self.role_masks[parent]
+        if mask == self.role_masks[role]:
+            return
+        self.role_masks[role] = mask
+        for username in list(self.role_members[role]):
+            user = self.authenticator.users.get(username)
+            if user is None:
+                # the user was deleted
+                self.role_members[role].discard(username)
             else:
-                raise PermissionDenied
-        except KeyError:
-            raise DoesNotExist
+                self._update_user(user)
+        for child in self.role_children[role]:
+            self._update_role(child)
 
-    def list_permissions(self, username):
-        try:
-            user = self.authenticator.users[username]
-        except KeyError:
+    def _check_role(self, role):
+        if role not in self.role_grants:
             raise DoesNotExist
+
+    def add_role(self, role, perm_names=(), parents=()):
+        '''
+        Creates a role with the given permissions, inheriting the permissions of the parent roles.
+        '''
+        with self.lock.write():
+            if role in self.role_grants:
+                raise AlreadyExists
+            for parent in parents:
+                self._check_role(parent)
+            try:
+                mask = 0
+                for perm_name in perm_names:
+                    mask |= 1 << self.permissions[perm_name]
+            except KeyError:
+                raise DoesNotExist
+            self.role_grants[role] = mask
+            self.role_masks[role] = -1
+            self.role_parents[role] = set(parents)
+            self.role_children[role] = set()
+            self.role_members[role] = set()
+            for parent in parents:
+                self.role_children[parent].add(role)
+            self._update_role(role)
+            self._save_definitions()
+
+    def grant_role_permission(self, perm_name, role):
+        '''
+        Adds the permission to the role and to all the roles inheriting from it.
+        '''
+        with self.lock.write():
+            self._check_role(role)
+            try:
+                self.role_grants[role] |= 1 << self.permissions[perm_name]
+            except KeyError:
+                raise DoesNotExist
+            self._update_role(role)
+            self._save_definitions()
+
+    def revoke_role_permission(self, perm_name, role):
+        '''
+        Removes the permission granted to the role itself.
+        '''
+        with self.lock.write():
+            self._check_role(role)
+            try:
+                self.role_grants[role] &= ~(1 << self.permissions[perm_name])
+            except KeyError:
+                raise DoesNotExist
+            self._update_role(role)
+            self._save_definitions()
+
+    def add_role_parent(self, role, parent):
+        '''
+        Makes the role inherit the permissions of the parent role.
+        '''
+        with self.lock.write():
+            self._check_role(role)
+            self._check_role(parent)
+            ancestors, pending = set(), [parent]
+            while pending:
+                current = pending.pop()
+                if current == role:
+                    raise ValueError('Role "{}" would inherit from itself'.format(role))
+                if current not in ancestors:
+                    ancestors.add(current)
+                    pending.extend(self.role_parents[current])
+            self.role_parents[role].add(parent)
+            self.role_children[parent].add(role)
+            self._update_role(role)
+            self._save_definitions()
+
+    def assign_role(self, role, username):
+        '''
+        Gives the user all the permissions of the role.
+        '''
+        with self.lock.write():
+            self._check_role(role)
+            try:
+                user = self.authenticator.users[username]
+            except KeyError:
+                raise DoesNotExist
+            user.roles.add(role)
+            user.effective_mask |= self.role_masks[role]
+            self.role_members[role].add(username)
+            self._save(user)
+
+    def unassign_role(self, role, username):
+        with self.lock.write():
+            self._check_role(role)
+            try:
+                user = self.authenticator.users[username]
+                user.roles.remove(role)
+            except KeyError:
+                raise DoesNotExist
+            self.role_members[role].discard(username)
+            self._update_user(user)
+            self._save(user)
+
+    def list_roles(self, username):
+        with self.lock.read():
+            try:
+                return sorted(self.authenticator.users[username].roles)
+            except KeyError:
+                raise DoesNotExist
+
+    def decode(self, mask):
+        '''
+        Returns the list of the names of the permissions whose bits are set in the mask.
+        '''
         perm_list = []
-        for permission in self.permissions:
-            if user in self.permissions[permission]:
-                perm_list.append(permission)
+        while mask:
+            lowest = mask & -mask
+            perm_list.append(self.names[lowest.bit_length() - 1])
+            mask ^= lowest
         return perm_list
 
+    def list_permissions(self, username):
+        with self.lock.read():
+            try:
+                user = self.authenticator.users[username]
+            except KeyError:
+                raise DoesNotExist
+            return self.decode(user.effective_mask)
+
+    def check_permissions(self, usernames=None, perm_names=None):
+        '''
+        Checks many permissions of many users at once, e.g. for an overview of the accounts.
+        Returns a dictionary username -> {permission name: whether the user has it}.
+        :usernames: The users to check; all of them by default.
+        :perm_names: The permissions to check; all of them by default.
+        '''
+        with self.lock.read():
+            usernames = list(self.authenticator.users) if usernames is None else usernames
+            perm_names = self.names if perm_names is None else perm_names
+            try:
+                bits = [(perm_name, 1 << self.permissions[perm_name]) for perm_name in perm_names]
+                masks = [(username, self.authenticator.users[username].effective_mask) for username in usernames]
+            except KeyError:
+                raise DoesNotExist
+            return {username: {perm_name: bool(mask & bit) for perm_name, bit in bits} for username, mask in masks}
+
     def print_permissions(self):
-        for permission in self.permissions:
+        with self.lock.read():
+            perm_names = list(self.permissions)
+        for permission in perm_names:
             print(permission)
 
 
@@ -145,9 +656,20 @@ class PermissionDenied(Exception):
     pass
 
 
+class InvalidSession(Exception):
+    pass
+
+
+ADD_ENTRY = 'add a new entry'
+DELETE_ENTRIES = 'delete entries'
+VIEW_PROPERTIES = 'view information about properties'
+MANAGE_USERS = 'add and delete users'
+MANAGE_PERMISSIONS = 'manage permissions'
+
 authorizer = Authorizer()
-authorizer.add_permission('add a new entry')
-authorizer.add_permission('delete entries')
-authorizer.add_permission('view information about properties')
-authorizer.add_permission('add and delete users')
-authorizer.add_permission('manage permissions')
+authorizer.add_permission(ADD_ENTRY)
+authorizer.add_permission(DELETE_ENTRIES)
+authorizer.add_permission(VIEW_PROPERTIES)
+authorizer.add_permission(MANAGE_USERS)
+authorizer.add_permission(MANAGE_PERMISSIONS)
+authorizer.add_role('administrator', list(authorizer.permissions))
@@ -1,12 +1,27 @@
 import auth
+import commands
+import metrics
 
 
 class ApplicationSession:
+    '''
+    The terminal menu of the accounts, the permissions and the listings.
+    It prompts for the arguments and runs the actions through a commands.CommandSession,
+    which checks the permissions as it does for the batch scripts and the API server.
+    The commands are timed in metrics.registry; the prompts are not.
+    '''
 
-    def __init__(self):
-        self.user = None
+    def __init__(self, metrics_path=None):
+        '''
+        :metrics_path: The JSON file where the metrics are dumped every minute, if any.
+        '''
         self.authenticator = auth.authenticator
         self.authorizer = auth.authorizer
+        self.session = commands.CommandSession(self.authenticator, self.authorizer)
+        self.dumper = None
+        if metrics_path is not None:
+            self.dumper = metrics.JsonDumper(metrics_path)
+            self.dumper.start()
         print('Welcome!')
         while len(self.authenticator.users.keys()) == 0:
             print('Create a new user profile')
@@ -14,41 +29,35 @@ class ApplicationSession:
         self.log_in()
         self.main_menu()
 
+    @property
+    def user(self):
+        return self.session.user
+
     def log_in(self):
-        while self.user is None:
+        while self.session.user is None:
             print('(Press Ctrl+C to exit)')
-            username = input('Enter username: ')
-            password = input('Enter password: ')
             try:
-                self.authenticator.log_in(username, password)
+                username = input('Enter username: ')
+                password = input('Enter password: ')
+                self.session.run({'command': 'log_in', 'username': username, 'password': password})
             except auth.DoesNotExist:
                 print('User does not exist!')
             except auth.InvalidPassword:
                 print('Wrong password!')
-            except auth.AlreadyLoggedIn:
-                print('You are already logged in!')
             except KeyboardInterrupt:
                 raise SystemExit
             else:
                 print('Welcome, {}!'.format(username))
-                self.user = username
 
     def add_user(self, username):
+        '''
+        Prompts for a new user; without a username, the first user is created, and becomes an administrator.
+        '''
         while True:
             try:
-                if username is None:
-                    try:
-                        new_username = input('Enter a new username: ')
-                        password = input('Enter the new user\'s password: ')
-                        self.authenticator.add_user(new_username, password)
-                        for permission in self.authorizer.permissions:
-                            self.authorizer.give_permission(permission, new_username)
-                    except KeyboardInterrupt:
-                        raise SystemExit
-                elif self.authorizer.verify_permission('add and delete users', username):
-                    new_username = input('Enter a new username: ')
-                    password = input('Enter the new user\'s password: ')
-                    self.authenticator.add_user(new_username, password)
+                new_username = input('Enter a new username: ')
+                password = input('Enter the new user\'s password: ')
+                self.session.run({'command': 'add_user', 'username': new_username, 'password': password})
             except auth.AlreadyExists:
                 print('Username already exists!')
             except auth.PasswordTooShort:
@@ -57,57 +66,58 @@ class ApplicationSession:
                 print('You do not have the permission to add user entries!')
                 break
             except KeyboardInterrupt:
+                if username is None:
+                    raise SystemExit
                 break
-            except:
-                print('exception')
             else:
                 break
             print('Press Ctrl+C to exit')
 
     def manage_permissions(self, username):
+        # menu option -> command
+        actions = {
+            '0': 'add_permission',
+            '1': 'withdraw_permission',
+            '2': 'give_permission',
+        }
+        try:
+            self.session.check(auth.MANAGE_PERMISSIONS)
+        except auth.PermissionDenied:
+            print('You are not allowed to manage permissions!')
+            return
         while True:
             try:
-                if self.authorizer.verify_permission('manage permissions', username):
-                    actions = {
-                        '0': auth.Authorizer.add_permission,
-                        '1': auth.Authorizer.withdraw_permission,
-                        '2': auth.Authorizer.give_permission,
-                        '3': auth.Authorizer.print_permissions
-                    }
-                    while True:
-                        try:
-                            print('Enter the user whose permissions you want to edit/view: (Press Ctrl+C to exit) ')
-                            self.authenticator.list_users()
-                            user_to_edit = ''
-                            while user_to_edit not in self.authenticator.users.keys():
-                                user_to_edit = input()
-                            print('The permissions of {}'.format(user_to_edit),
-                                  self.authorizer.list_permissions(user_to_edit))
-                            print(
-                                '''
-                                0 - add a permission
-                                1 - withdraw a permission
-                                2 - grant a permission
-                                3 - print all available permissions
-                                '''
-                            )
-                            action = None
-                            options = ('0', '1', '2', '3')
-                            while action not in options:
-                                action = input()
-                            if action != '3':
-                                print('Enter the permission name: ')
-                                perm_name = ''
-                                while perm_name not in self.authorizer.permissions.keys():
-                                    perm_name = input()
-                                if action == '0':
-                                    actions[action](self.authorizer, perm_name)
-                                else:
-                                    actions[action](self.authorizer, perm_name, user_to_edit)
-                            else:
-                                self.authorizer.print_permissions()
-                        except KeyboardInterrupt:
-                            break
+                print('Enter the user whose permissions you want to edit/view: (Press Ctrl+C to exit) ')
+                users = self.session.run({'command': 'list_users'})[0]
+                print('\n'.join(users))
+                user_to_edit = ''
+                while user_to_edit not in users:
+                    user_to_edit = input()
+                print('The permissions of {}'.format(user_to_edit),
+                      self.session.run({'command': 'list_permissions', 'username': user_to_edit})[0])
+                print(
+                    '''
+                    0 - add a permission
+                    1 - withdraw a permission
+                    2 - grant a permission
+                    3 - print all available permissions
+                    '''
+                )
+                action = None
+                options = ('0', '1', '2', '3')
+                while action not in options:
+                    action = input()
+                if action == '3':
+                    print('\n'.join(self.session.run({'command': 'all_permissions'})[0]))
+                    continue
+                print('Enter the permission name: ')
+                perm_name = input()
+                command = {'command': actions[action], 'permission': perm_name}
+                if action != '0':
+                    command['username'] = user_to_edit
+                self.session.run(command)
+            except KeyboardInterrupt:
+                break
             except auth.PermissionDenied:
                 print('You are not allowed to manage permissions!')
                 break
@@ -118,55 +128,60 @@ class ApplicationSession:
 
     def delete_user(self, username):
         try:
-            while True:
-                if self.authorizer.verify_permission('add and delete users', username):
-                    print('Enter the name of the user to delete: ')
-                    self.authenticator.list_users()
-                    user_to_delete = input()
-                    self.authenticator.del_user(user_to_delete)
+            print('Enter the name of the user to delete: ')
+            print('\n'.join(self.session.run({'command': 'list_users'})[0]))
+            self.session.run({'command': 'delete_user', 'username': input()})
         except auth.PermissionDenied:
             print('You do not have the permission to add and delete users!')
         except auth.DoesNotExist:
             print('The user does not exist!')
+        except KeyboardInterrupt:
+            pass
 
     def view_info(self, username):
         try:
-            if self.authorizer.verify_permission('view information about properties', username):
-                print(
-                '''
-                0 - find a property
-                1 - list all properties
-                ''')
-                option = ''
-                while option not in ('0', '1'):
-                    option = input()
-                if option == '0':
-                    self.authenticator.users[username].find_property()
-                elif option == '1':
-                    self.authenticator.users[username].display_properties()
+            user = self.session.check(auth.VIEW_PROPERTIES)
         except auth.PermissionDenied:
             print('You do not have the right to view property entries!')
+            return
+        print(
+        '''
+        0 - find a property
+        1 - list all properties
+        2 - browse the properties page by page
+        ''')
+        option = ''
+        while option not in ('0', '1', '2'):
+            option = input()
+        if option == '0':
+            user.find_property()
+        elif option == '1':
+            user.display_properties()
+        elif option == '2':
+            user.browse_properties()
 
     def add_property(self, username):
         try:
-            if self.authorizer.verify_permission('add a new entry', username):
-                self.authenticator.users[username].add_property()
+            self.session.check(auth.ADD_ENTRY).add_property()
         except auth.PermissionDenied:
             print('You do not have the permission to add new entries!')
 
     def remove_property(self, username):
         try:
-            if self.authorizer.verify_permission('delete entries', username):
-                self.authenticator.users[username].remove_property()
+            self.session.check(auth.DELETE_ENTRIES).remove_property()
         except auth.PermissionDenied:
             print('You do not have the permission to remove entries!')
 
     def log_out(self, username):
         print('Goodbye, {}!'.format(username))
+        self.session.run({'command': 'log_out'})
         self.log_in()
 
     def quit(self, username):
         print('Goodbye, {}!'.format(username))
+        self.session.run({'command': 'log_out'})
+        if self.dumper is not None:
+            self.dumper.stop()
         raise SystemExit
 
     def main_menu(self):
@@ -196,4 +211,11 @@ class ApplicationSession:
             options = tuple((str(i) for i in range(8)))
             while option not in options:
                 option = input()
+            try:
+                self.session.current_user()
+            except auth.InvalidSession:
+                print('Your session has expired, please log in again.')
+                self.session.user = self.session.token = None
+                self.log_in()
+                continue
             actions[option](self, self.user)
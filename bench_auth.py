@@ -0,0 +1,51 @@
+'''
+Measures how many log ins per second Authenticator handles for several costs of the password hash.
+Usage: python bench_auth.py [number of log ins per cost]
+'''
+import asyncio
+import sys
+import time
+
+import auth
+
+COSTS = (1000, 10000, 50000, 100000, 200000, 400000)
+
+
+def sequential_rate(authenticator, usernames):
+    '''
+    Returns the log ins per second of log_in() called one after another.
+    '''
+    start = time.perf_counter()
+    for username in usernames:
+        authenticator.log_in(username, 'password')
+    elapsed = time.perf_counter() - start
+    return len(usernames) / elapsed
+
+
+def concurrent_rate(authenticator, usernames):
+    '''
+    Returns the log ins per second of log_in_async() called concurrently.
+    '''
+    async def log_in_all():
+        await asyncio.gather(*(authenticator.log_in_async(username, 'password') for username in usernames))
+
+    start = time.perf_counter()
+    asyncio.run(log_in_all())
+    elapsed = time.perf_counter() - start
+    return len(usernames) / elapsed
+
+
+def main_benchmark(count):
+    print('{:>10}{:>16}{:>16}'.format('iterations', 'sequential/s', 'concurrent/s'))
+    for iterations in COSTS:
+        authenticator = auth.Authenticator(iterations=iterations)
+        usernames = ['user{}'.format(i) for i in range(count)]
+        for username in usernames:
+            authenticator.add_user(username, 'password')
+        print('{:>10}{:>16.1f}{:>16.1f}'.format(
+            iterations, sequential_rate(authenticator, usernames), concurrent_rate(authenticator, usernames)))
+        authenticator.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
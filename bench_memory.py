@@ -0,0 +1,48 @@
+'''
+Compares the memory used per listing by the regular and the slotted property classes.
+Usage: python bench_memory.py [number of listings]
+'''
+import sys
+import tracemalloc
+
+import main
+import slotted
+
+SAMPLE_ARGS = {
+    ("house", "rental"): dict(square_feet=1800, beds=3, baths=2, num_stories='2', garage='attached',
+                              fenced='yes', furnished='no', utilities=150, rent=1900),
+    ("house", "purchase"): dict(square_feet=2200, beds=4, baths=3, num_stories='2', garage='detached',
+                                fenced='no', price=350000, taxes=4200),
+    ("apartment", "rental"): dict(square_feet=750, beds=1, baths=1, balcony='yes', laundry='coin',
+                                  furnished='yes', utilities=80, rent=1200),
+    ("apartment", "purchase"): dict(square_feet=950, beds=2, baths=1, balcony='solarium', laundry='ensuite',
+                                    price=210000, taxes=2500)
+}
+
+
+def bytes_per_listing(PropertyClass, init_args, count):
+    '''
+    Returns the average number of bytes allocated for one instance of the class.
+    '''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    listings = [PropertyClass(**init_args) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # the list holding the listings is not a part of a listing
+    allocated -= sys.getsizeof(listings)
+    return allocated / count
+
+
+def main_benchmark(count):
+    print('{:<24}{:>12}{:>12}{:>10}'.format('type', 'regular', 'slotted', 'saved'))
+    for key, init_args in SAMPLE_ARGS.items():
+        regular = bytes_per_listing(main.Agent.type_map[key], init_args, count)
+        compact = bytes_per_listing(slotted.SlottedAgent.type_map[key], init_args, count)
+        print('{:<24}{:>12.1f}{:>12.1f}{:>9.0%}'.format(
+            ' '.join(key), regular, compact, 1 - compact / regular))
+
+
+if __name__ == '__main__':
+    main_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,216 @@
+'''
+Benchmarks the hot paths of the catalog, the searches and the authentication on synthetic listings.
+
+The listings are generated from a seed, so two runs with the same arguments measure the same work.
+For every operation the throughput, the percentiles of the latency and the peak memory of the process
+are reported as JSON. The results can be saved and later compared with a new run, which flags the
+operations that got slower than the threshold.
+Usage: python bench_suite.py [--count 100000] [--seed 1] [--save results.json]
+                             [--baseline results.json] [--threshold 0.1]
+'''
+import argparse
+import io
+import json
+import random
+import sys
+import time
+from array import array
+
+import auth
+import render
+from main import Agent
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+GARAGES = ('attached', 'detached', 'none')
+LAUNDRIES = ('coin', 'ensuite', 'none')
+BALCONIES = ('yes', 'no', 'solarium')
+
+
+def generate_listings(count, seed=1, type_map=None):
+    '''
+    Yields count listings of all the kinds, with plausible and reproducible values.
+    :seed: The seed of the random numbers; the same seed yields the same listings.
+    :type_map: The classes of the listings, Agent.type_map by default.
+    '''
+    type_map = Agent.type_map if type_map is None else type_map
+    rng = random.Random(seed)
+    for _ in range(count):
+        kind = 'house' if rng.random() < 0.4 else 'apartment'
+        action = 'rental' if rng.random() < 0.6 else 'purchase'
+        beds = rng.choice((1, 1, 2, 2, 2, 3, 3, 4, 5)) if kind == 'apartment' else rng.randint(2, 6)
+        args = dict(square_feet=round(rng.gauss(450 + 350 * beds, 150)), beds=beds,
+                    baths=max(1, beds - rng.randint(0, 2)))
+        if kind == 'house':
+            args.update(num_stories=rng.randint(1, 3), garage=rng.choice(GARAGES),
+                        fenced=rng.choice(('yes', 'no')))
+        else:
+            args.update(balcony=rng.choice(BALCONIES), laundry=rng.choice(LAUNDRIES))
+        if action == 'rental':
+            args.update(furnished=rng.choice(('yes', 'no')), utilities=rng.randrange(50, 300, 10),
+                        rent=rng.randrange(600, 1000 + 600 * beds, 25))
+        else:
+            price = rng.randrange(80000, 150000 + 120000 * beds, 1000)
+            args.update(price=price, taxes=round(price * rng.uniform(0.008, 0.02)))
+        yield type_map[(kind, action)](**args)
+
+
+def random_query(rng):
+    '''
+    Returns the arguments of a typical search: a kind, an action, a few criteria and sometimes a sort key.
+    '''
+    kind, action = rng.choice(list(Agent.type_map))
+    criteria = {'beds': str(rng.randint(1, 4))}
+    if action == 'rental':
+        low = rng.randrange(600, 2500, 100)
+        criteria['rent'] = '{}-{}'.format(low, low + 500)
+    else:
+        criteria['price'] = '<{}'.format(rng.randrange(150000, 600000, 10000))
+    if kind == 'house' and rng.random() < 0.5:
+        criteria['garage'] = rng.choice(GARAGES)
+    order_by = rng.choice((None, 'square_feet', 'rent' if action == 'rental' else 'price'))
+    return kind, action, order_by, criteria
+
+
+def peak_memory():
+    '''
+    Returns the peak resident memory of the process in bytes, or None where it is not known.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(latencies, fraction):
+    '''
+    Returns the latency below which the fraction of the sorted latencies lie.
+    '''
+    if not latencies:
+        return None
+    return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+
+def measure(operation, arguments):
+    '''
+    Calls the operation once with every argument and returns the report of its latencies.
+    '''
+    latencies = array('d')
+    clock = time.perf_counter
+    start = clock()
+    for argument in arguments:
+        before = clock()
+        operation(argument)
+        latencies.append(clock() - before)
+    elapsed = clock() - start
+    latencies = sorted(latencies)
+    return {
+        'operations': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'latency': {'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9),
+                    'p99': percentile(latencies, 0.99), 'max': latencies[-1] if latencies else None},
+        'peak_memory': peak_memory(),
+    }
+
+
+def run(count, seed=1, queries=1000, pages=200, page_size=10, removals=1000, log_ins=20, checks=100000,
+        iterations=auth.ITERATIONS):
+    '''
+    Runs all the benchmarks and returns their results.
+    :count: The number of listings in the catalog.
+    :queries, pages, removals, log_ins, checks: The number of measured calls of every operation.
+    :iterations: The cost of the password hashes.
+    '''
+    rng = random.Random(seed)
+    agent = Agent()
+    listings = list(generate_listings(count, seed))
+    results = {'add_property': measure(agent.add, listings)}
+
+    def find(query):
+        kind, action, order_by, criteria = query
+        agent.search(kind, action, order_by, **criteria).top(page_size)
+    results['find_property'] = measure(find, [random_query(rng) for _ in range(queries)])
+
+    output = io.StringIO()
+
+    def display(start):
+        render.write(agent.catalog.slice(start, start + page_size), output)
+        output.seek(0)
+        output.truncate()
+    results['display_properties'] = measure(display, [rng.randrange(max(count - page_size, 1))
+                                                      for _ in range(pages)])
+
+    results['remove_property'] = measure(agent.remove, rng.sample(listings, min(removals, count)))
+    del listings
+
+    authenticator = auth.Authenticator(iterations=iterations)
+    authorizer = auth.Authorizer()
+    authorizer.authenticator = authenticator
+    for perm_name in (auth.ADD_ENTRY, auth.DELETE_ENTRIES, auth.VIEW_PROPERTIES):
+        authorizer.add_permission(perm_name)
+    usernames = ['user{}'.format(i) for i in range(max(log_ins, 100))]
+    for username in usernames[:log_ins]:
+        authenticator.add_user(username, 'password')
+    for username in usernames[log_ins:]:
+        # the users only checked for permissions do not need a costly hash
+        authenticator.users[username] = auth.User(username, 'password', iterations=1)
+    for i, username in enumerate(usernames):
+        authorizer.give_permission((auth.ADD_ENTRY, auth.VIEW_PROPERTIES)[i % 2], username)
+    results['log_in'] = measure(lambda username: authenticator.log_in(username, 'password'), usernames[:log_ins])
+
+    def verify(username):
+        try:
+            authorizer.verify_permission(auth.VIEW_PROPERTIES, username)
+        except auth.PermissionDenied:
+            pass
+    results['verify_permission'] = measure(verify, [rng.choice(usernames) for _ in range(checks)])
+    return {'count': count, 'seed': seed, 'iterations': iterations, 'results': results}
+
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    Returns the list of the regressions of the current results against the baseline: operations whose
+    throughput fell or whose 99th percentile latency rose by more than the threshold.
+    '''
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if before['throughput'] and result['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append({'operation': name, 'metric': 'throughput',
+                                'baseline': before['throughput'], 'current': result['throughput']})
+        if before['latency']['p99'] and result['latency']['p99'] > before['latency']['p99'] * (1 + threshold):
+            regressions.append({'operation': name, 'metric': 'p99',
+                                'baseline': before['latency']['p99'], 'current': result['latency']['p99']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the catalog, the searches and the authentication.')
+    parser.add_argument('--count', type=int, default=100000, help='the number of listings, from 1000 to 10000000')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=auth.ITERATIONS, help='the cost of the password hashes')
+    parser.add_argument('--save', help='the file receiving the results')
+    parser.add_argument('--baseline', help='the results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='the tolerated slowdown, 0.1 for 10%%')
+    args = parser.parse_args()
+
+    report = run(args.count, args.seed, iterations=args.iterations)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            report['regressions'] = compare(json.load(file), report, args.threshold)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+'''
+Module for importing listings in bulk from CSV or JSONL files without the interactive prompts.
+
+Each record names the kind ("house" or "apartment") and the action ("purchase" or "rental")
+of the listing; the other fields are the arguments of the constructors, e.g.
+    kind,action,square_feet,beds,baths,garage,fenced,num_stories,rent,utilities,furnished
+    house,rental,1800,3,2,attached,yes,2,"$1,900",150,no
+
+The file is streamed: records are read, validated and added to the catalog in batches,
+so the memory used by the import does not depend on the size of the file.
+Usage: python bulk_import.py listings.csv --database property.db [--owner username]
+'''
+import argparse
+import csv
+import json
+import sys
+from itertools import islice
+
+import storage
+from catalog import SharedCatalog
+from kinds import fields
+from main import Agent, Apartment, House
+
+VALID_VALUES = {
+    'garage': House.valid_garage,
+    'fenced': House.valid_fenced,
+    'laundry': Apartment.valid_laundries,
+    'balcony': Apartment.valid_balconies,
+    'furnished': ('yes', 'no')
+}
+
+
+class InvalidRecord(Exception):
+    pass
+
+
+def read_csv(file):
+    '''
+    Yields the line number and the dictionary of every row of a CSV file with a header.
+    '''
+    reader = csv.DictReader(file)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(file):
+    '''
+    Yields the line number and the dictionary of every non-empty line of a JSONL file.
+    '''
+    for line_num, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError as error:
+            yield line_num, error
+
+
+def create_property(record, type_map=None):
+    '''
+    Validates the record and returns the property created from it.
+    :record: A dictionary with the kind, the action and the arguments of the constructor.
+    :type_map: The classes of the properties, Agent.type_map by default.
+    '''
+    type_map = Agent.type_map if type_map is None else type_map
+    if not isinstance(record, dict):
+        raise InvalidRecord('not a record: {}'.format(record))
+    # csv.DictReader keeps the values beyond the header under the key None
+    if None in record:
+        raise InvalidRecord('more values than the header: {}'.format(', '.join(map(str, record[None]))))
+    # empty cells stand for missing values
+    record = {name.strip(): value.strip() if isinstance(value, str) else value
+              for name, value in record.items() if name and value not in ('', None)}
+    key = (str(record.pop('kind', '')).lower(), str(record.pop('action', '')).lower())
+    try:
+        PropertyClass = type_map[key]
+    except KeyError:
+        raise InvalidRecord('unknown kind and action: {} {}'.format(*key))
+    allowed = {argument for argument, _ in fields(PropertyClass)}
+    unexpected = set(record) - allowed
+    if unexpected:
+        raise InvalidRecord('unexpected fields for a {} {}: {}'.format(*key, ', '.join(sorted(unexpected))))
+    for name, valid_options in VALID_VALUES.items():
+        if name in record:
+            record[name] = str(record[name]).lower()
+            if record[name] not in valid_options:
+                raise InvalidRecord('{} must be one of {}, not "{}"'.format(
+                    name, ', '.join(valid_options), record[name]))
+    try:
+        return PropertyClass(**record)
+    except ValueError as error:
+        raise InvalidRecord(error)
+
+
+def create_record(property, type_map=None):
+    '''
+    Returns the record of the property, the inverse of create_property().
+    Missing values are left out.
+    '''
+    type_map = Agent.type_map if type_map is None else type_map
+    kind, action = next(key for key, PropertyClass in type_map.items() if PropertyClass is type(property))
+    record = {'kind': kind, 'action': action}
+    for argument, attribute in fields(type(property)):
+        value = getattr(property, attribute, None)
+        if value not in ('', None):
+            record[argument] = value
+    return record
+
+
+def parse_records(records, type_map=None, report=None):
+    '''
+    Yields a property for every valid record; invalid records are reported and skipped.
+    :records: An iterable of pairs (line number, record).
+    :report: A function called with the line number and the error of every invalid record.
+    '''
+    for line_num, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise InvalidRecord(record)
+            yield create_property(record, type_map)
+        except InvalidRecord as error:
+            if report is not None:
+                report(line_num, error)
+
+
+def import_file(agent, file, file_format='csv', batch_size=10000, report=None):
+    '''
+    Adds all the valid listings of the file to the agent and returns their number.
+    The properties are added in batches of batch_size, updating the indexes once per batch.
+    :agent: The agent receiving the listings.
+    :file: An open text file.
+    :file_format: Either "csv" or "jsonl".
+    :report: A function called with the line number and the error of every skipped record.
+    '''
+    reader = read_jsonl if file_format == 'jsonl' else read_csv
+    properties = parse_records(reader(file), agent.type_map, report)
+    imported = 0
+    while True:
+        batch = list(islice(properties, batch_size))
+        if not batch:
+            return imported
+        agent.extend(batch)
+        imported += len(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports listings from a CSV or JSONL file.')
+    parser.add_argument('path', help='the file with the listings')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='the format of the file; guessed from the extension by default')
+    parser.add_argument('--database', required=True, help='the SQLite database receiving the listings')
+    parser.add_argument('--owner', help='the user owning the listings')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    connection = storage.connect(args.database)
+    # the listings are owned by the user like those they add themselves, see catalog.SharedCatalog
+    agent = Agent(catalog=SharedCatalog(storage.SQLiteCatalog(connection)).view(args.owner))
+    file_format = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.json')) else 'csv')
+    skipped = 0
+
+    def report(line_num, error):
+        nonlocal skipped
+        skipped += 1
+        print('line {}: {}'.format(line_num, error), file=sys.stderr)
+
+    with open(args.path, newline='') as file:
+        imported = import_file(agent, file, file_format, args.batch_size, report)
+    print('Imported {} listings, skipped {}.'.format(imported, skipped))
+
+
+if __name__ == '__main__':
+    main()
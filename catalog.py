@@ -0,0 +1,441 @@
+'''
+Module with the default in-memory catalog of properties used by Agent.
+'''
+from itertools import islice
+
+import facets
+from index import Found, Matches, PropertyIndex
+from locks import ReadWriteLock
+from render import state
+
+
+class Catalog:
+    '''
+    Stores the properties of an agent in a list and keeps them indexed.
+    Every catalog backend provides the methods add(), extend(), remove(), search(), slice(), __iter__()
+    and __len__(), and get(), id_of() and stored() for the IDs of the listings. The in-memory catalogs also
+    find the listings nearest to a point with nearest() and count them by facet with facets().
+    Every listing gets an ID when it is added, which it keeps until it is removed. A removed listing
+    is replaced by the last one, so removing takes constant time but moves the last listing in slice().
+    '''
+
+    def __init__(self):
+        self.properties = []
+        # property -> its position in self.properties
+        self.positions = {}
+        # ID of the listing -> property; the IDs are the numbers given by the index
+        self.listings = {}
+        # hash of the values of the property -> the properties with that hash, in the order they were added,
+        # to find the stored property with the same values as a copy
+        self.hashes = {}
+        self.index = PropertyIndex()
+
+    def add(self, property):
+        '''
+        Stores the property and indexes it.
+        '''
+        self.positions[property] = len(self.properties)
+        self.properties.append(property)
+        self.hashes.setdefault(hash(state(property)), []).append(property)
+        self.index.add(property)
+        self.listings[self.index.order[property]] = property
+
+    def extend(self, properties):
+        '''
+        Stores all the properties and indexes them in one batch.
+        '''
+        properties = list(properties)
+        for position, property in enumerate(properties, len(self.properties)):
+            self.positions[property] = position
+            self.hashes.setdefault(hash(state(property)), []).append(property)
+        self.properties.extend(properties)
+        self.index.extend(properties)
+        order = self.index.order
+        self.listings.update((order[property], property) for property in properties)
+
+    def _stored(self, property):
+        '''
+        Returns the stored property; a property that is not stored itself stands for
+        the first stored one with the same values.
+        '''
+        if property in self.positions:
+            return property
+        key = state(property)
+        stored = next((stored for stored in self.hashes.get(hash(key), ()) if state(stored) == key), None)
+        if stored is None:
+            raise ValueError('The property is not in the catalog')
+        return stored
+
+    def remove(self, property):
+        '''
+        Removes the property from the catalog and from the indexes.
+        A property that is not stored itself removes the first stored one with the same values.
+        '''
+        property = self._stored(property)
+        position = self.positions.pop(property)
+        last = self.properties.pop()
+        if last is not property:
+            self.properties[position] = last
+            self.positions[last] = position
+        key = hash(state(property))
+        same = self.hashes.get(key, [])
+        for number, stored in enumerate(same):
+            if stored is property:
+                del same[number]
+                break
+        if not same:
+            self.hashes.pop(key, None)
+        del self.listings[self.index.order[property]]
+        self.index.remove(property)
+
+    def get(self, listing_id):
+        '''
+        Returns the listing with the ID; raises KeyError if there is none.
+        '''
+        return self.listings[listing_id]
+
+    def id_of(self, property):
+        '''
+        Returns the ID of the listing.
+        '''
+        return self.index.order[self._stored(property)]
+
+    def stored(self, listing_ids):
+        '''
+        Returns the set of the IDs whose listings are still stored, e.g. to leave out of a page of results
+        the listings removed since the search.
+        '''
+        return {listing_id for listing_id in listing_ids if listing_id in self.listings}
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the list of properties of the given class matching all the criteria.
+        :property_class: One of the classes of Agent.type_map.
+        :criteria: A dictionary of search parameters and their values.
+        '''
+        found = self.index.search(property_class, criteria)
+        # the IDs of the listings are the numbers given by the index
+        if isinstance(found, Matches):
+            found.listing_ids = found.ids
+            return found
+        order = self.index.order
+        return Found(found, [order[property] for property in found])
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the list of the k properties of the given class matching all the criteria
+        nearest to the point, the nearest first.
+        '''
+        return self.index.nearest(property_class, latitude, longitude, k, criteria)
+
+    def facets(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the properties of the class, see facets.py.
+        '''
+        return self.index.facets.lookup(property_class)
+
+    def slice(self, start, stop):
+        '''
+        Returns the list of the properties from position start up to position stop.
+        '''
+        return self.properties[start:stop]
+
+    def __iter__(self):
+        return iter(self.properties)
+
+    def __len__(self):
+        return len(self.properties)
+
+
+class SharedCatalog:
+    '''
+    Catalog shared by all the users of the application. Every distinct listing is stored once,
+    together with the users who entered it and its visibility: public listings are seen by everybody,
+    private ones only by their owners. Users work with the catalog through a CatalogView.
+    Listings are told apart by their attribute values, so the same listing entered by several users
+    is stored once with several owners. The owners and the visibility are kept by the IDs of the listings
+    in the storage.
+    A storage that keeps the owners and the visibility of its listings, such as storage.SQLiteCatalog,
+    has the methods ownerships() and save_ownerships(): the catalog reads them when it is created,
+    without reading the listings, and saves them whenever they change.
+    The agents of all the users share the lock of the catalog.
+    '''
+
+    def __init__(self, storage=None):
+        '''
+        :storage: The catalog backend holding the listings. A Catalog by default.
+        '''
+        self.storage = Catalog() if storage is None else storage
+        # ID of the listing -> usernames of its owners
+        self.owners = {}
+        # username -> IDs of the listings they own
+        self.owned = {}
+        # IDs of the listings seen only by their owners
+        self.private = set()
+        self.lock = ReadWriteLock('catalog')
+        self.saves = hasattr(self.storage, 'save_ownerships')
+        if hasattr(self.storage, 'ownerships'):
+            owners, self.private = self.storage.ownerships()
+            for listing_id, usernames in owners.items():
+                for username in usernames:
+                    self._own(listing_id, username)
+
+    def _save(self, listing_ids):
+        '''
+        Saves the owners and the visibility of the listings if the storage keeps them.
+        '''
+        if self.saves:
+            self.storage.save_ownerships((listing_id, self.owners.get(listing_id, ()),
+                                          'private' if listing_id in self.private else 'public')
+                                         for listing_id in listing_ids)
+
+    def view(self, username):
+        '''
+        Returns the catalog as seen by the user.
+        '''
+        return CatalogView(self, username)
+
+    def _own(self, listing_id, owner):
+        self.owners.setdefault(listing_id, set()).add(owner)
+        self.owned.setdefault(owner, set()).add(listing_id)
+
+    def _disown(self, listing_id, owner):
+        owners = self.owners.get(listing_id, set())
+        owners.discard(owner)
+        if not owners:
+            self.owners.pop(listing_id, None)
+        owned = self.owned.get(owner, set())
+        owned.discard(listing_id)
+        if not owned:
+            self.owned.pop(owner, None)
+
+    def _find(self, property):
+        '''
+        Returns the ID of the stored listing with the same values as the property, or None if there is none.
+        '''
+        try:
+            return self.storage.id_of(property)
+        except (KeyError, ValueError):
+            return None
+
+    def add(self, property, owner=None, visibility='public'):
+        '''
+        Stores the listing unless an identical one is stored already, and records the owner.
+        :owner: The username of the user entering the listing.
+        :visibility: Either "public" or "private".
+        '''
+        listing_id = self._find(property)
+        if listing_id is None:
+            self.storage.add(property)
+            listing_id = self.storage.id_of(property)
+            if visibility == 'private':
+                self.private.add(listing_id)
+        if owner is not None:
+            self._own(listing_id, owner)
+        self._save([listing_id])
+
+    def extend(self, properties, owner=None, visibility='public'):
+        '''
+        Stores all the new listings in one batch and records the owner of all of them.
+        '''
+        listing_ids, new, batch = [], [], {}
+        for property in properties:
+            listing_id = self._find(property)
+            if listing_id is not None:
+                listing_ids.append(listing_id)
+            elif state(property) not in batch:
+                # the listings repeated in the batch are stored once
+                batch[state(property)] = property
+                new.append(property)
+        self.storage.extend(new)
+        for property in new:
+            listing_id = self.storage.id_of(property)
+            listing_ids.append(listing_id)
+            if visibility == 'private':
+                self.private.add(listing_id)
+        if owner is not None:
+            for listing_id in listing_ids:
+                self._own(listing_id, owner)
+        self._save(listing_ids)
+
+    def remove(self, property, owner=None):
+        '''
+        Removes the ownership of the user; the listing is deleted when no owner is left.
+        A listing without owners is deleted by any user who sees it; a listing of other users cannot be
+        removed (PermissionError), and a listing the user does not see is not found (ValueError).
+        :owner: The user removing the listing; None deletes the listing whoever owns it.
+        '''
+        listing_id = self.storage.id_of(property)
+        owners = self.owners.get(listing_id, set())
+        if owner is not None:
+            if not self._visible(listing_id, owner):
+                raise ValueError('The property is not in the catalog')
+            if owners and owner not in owners:
+                raise PermissionError('The property belongs to other users')
+            if len(owners) > 1:
+                self._disown(listing_id, owner)
+                self._save([listing_id])
+                return
+        self.storage.remove(property)
+        for username in list(owners):
+            self._disown(listing_id, username)
+        self.private.discard(listing_id)
+
+    def set_visibility(self, property, visibility):
+        '''
+        Makes the listing "public" or "private".
+        '''
+        with self.lock.write():
+            listing_id = self.storage.id_of(property)
+            if visibility == 'private':
+                self.private.add(listing_id)
+            else:
+                self.private.discard(listing_id)
+            self._save([listing_id])
+
+    def forget_owner(self, username):
+        '''
+        Drops the ownerships of a deleted user. Their public listings stay in the catalog,
+        private listings left without an owner are not seen by anybody.
+        '''
+        with self.lock.write():
+            listing_ids = list(self.owned.get(username, ()))
+            for listing_id in listing_ids:
+                self._disown(listing_id, username)
+            self._save(listing_ids)
+
+    def adopt(self, username, listing_ids):
+        '''
+        Gives the user back the ownership of the listings that are still stored, e.g. when
+        the deletion of the user is undone.
+        :listing_ids: The IDs of the listings.
+        '''
+        with self.lock.write():
+            listing_ids = self.storage.stored(listing_ids)
+            for listing_id in listing_ids:
+                self._own(listing_id, username)
+            self._save(listing_ids)
+
+    def _visible(self, listing_id, username):
+        return listing_id not in self.private or username in self.owners.get(listing_id, ())
+
+    def visible(self, property, username):
+        '''
+        Tells whether the user sees the listing.
+        '''
+        return not self.private or self._visible(self.storage.id_of(property), username)
+
+    def _filter(self, properties, username):
+        if not self.private:
+            return properties if isinstance(properties, list) else list(properties)
+        listing_ids = getattr(properties, 'listing_ids', None)
+        if listing_ids is None:
+            listing_ids = [self.storage.id_of(property) for property in properties]
+        kept = [position for position, listing_id in enumerate(listing_ids) if self._visible(listing_id, username)]
+        found = Found([properties[position] for position in kept], [listing_ids[position] for position in kept])
+        if isinstance(properties, Matches):
+            return Matches(found, [properties.ids[position] for position in kept], found.listing_ids)
+        return found
+
+    def search(self, property_class, criteria, username=None):
+        '''
+        Returns the list of the listings of the given class matching all the criteria seen by the user.
+        '''
+        return self._filter(self.storage.search(property_class, criteria), username)
+
+    def nearest(self, property_class, latitude, longitude, k, criteria, username=None):
+        '''
+        Returns the k listings of the given class matching all the criteria seen by the user nearest to the point.
+        '''
+        # at most the private listings are hidden from the user, so that many more are asked for
+        found = self.storage.nearest(property_class, latitude, longitude, k + len(self.private), criteria)
+        return self._filter(found, username)[:k]
+
+    def facets(self, property_class, username=None):
+        '''
+        Returns the counts of the values of every facet among the listings of the class seen by the user.
+        '''
+        if not self.private:
+            return self.storage.facets(property_class)
+        return facets.count(self.search(property_class, {}, username))
+
+    def get(self, listing_id, username=None):
+        '''
+        Returns the listing with the ID if the user sees it; raises KeyError otherwise.
+        '''
+        if not self._visible(listing_id, username):
+            raise KeyError(listing_id)
+        return self.storage.get(listing_id)
+
+    def id_of(self, property):
+        return self.storage.id_of(property)
+
+    def stored(self, listing_ids):
+        return self.storage.stored(listing_ids)
+
+    def __iter__(self):
+        return iter(self.storage)
+
+    def __len__(self):
+        return len(self.storage)
+
+
+class CatalogView:
+    '''
+    The listings of a SharedCatalog seen by one user. The view holds no listings of its own:
+    every operation is a filter over the shared storage.
+    '''
+
+    def __init__(self, shared, username):
+        '''
+        :shared: The SharedCatalog.
+        :username: The user looking at the catalog.
+        '''
+        self.shared = shared
+        self.username = username
+
+    @property
+    def lock(self):
+        return self.shared.lock
+
+    def add(self, property, visibility='public'):
+        self.shared.add(property, self.username, visibility)
+
+    def extend(self, properties, visibility='public'):
+        self.shared.extend(properties, self.username, visibility)
+
+    def remove(self, property):
+        self.shared.remove(property, self.username)
+
+    def search(self, property_class, criteria):
+        return self.shared.search(property_class, criteria, self.username)
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        return self.shared.nearest(property_class, latitude, longitude, k, criteria, self.username)
+
+    def facets(self, property_class):
+        return self.shared.facets(property_class, self.username)
+
+    def get(self, listing_id):
+        return self.shared.get(listing_id, self.username)
+
+    def id_of(self, property):
+        return self.shared.id_of(property)
+
+    def stored(self, listing_ids):
+        return self.shared.stored(listing_ids)
+
+    def slice(self, start, stop):
+        if not self.shared.private:
+            return self.shared.storage.slice(start, stop)
+        return list(islice(self, start, stop))
+
+    def __iter__(self):
+        for property in self.shared.storage:
+            if self.shared.visible(property, self.username):
+                yield property
+
+    def __len__(self):
+        own = self.shared.owned.get(self.username, ())
+        hidden = len(self.shared.private) - sum(1 for listing_id in own if listing_id in self.shared.private)
+        return len(self.shared.storage) - hidden
@@ -58,6 +58,998 @@ def check_purchase():
     purchase.display()
 
 
+def check_search():
+    '''
+    >>> check_search()
+    2
+    attached
+    0
+    '''
+    agent = main.Agent()
+    agent.add(main.HouseRental(beds='3', baths='2', garage='attached', fenced='yes', rent='1200'))
+    agent.add(main.HouseRental(beds='3', baths='1', garage='none', fenced='yes', rent='900'))
+    agent.add(main.HousePurchase(beds='3', baths='2', garage='attached', price='100000'))
+    print(len(agent.search('house', 'rental', beds='3', fenced='yes')))
+    print(agent.search('house', 'rental', beds='3', baths='2')[0].garage)
+    agent.remove(agent.search('house', 'rental', garage='attached')[0])
+    print(len(agent.search('house', 'rental', garage='attached')))
+
+
+def check_range_search():
+    '''
+    >>> check_range_search()
+    [900, 1200]
+    [1500]
+    [1200]
+    (100000, 4000)
+    '''
+    agent = main.Agent()
+    for rent, square_feet in (('$1,200', '1,300'), ('900', '800'), ('$1,500', '2000')):
+        agent.add(main.ApartmentRental(rent=rent, square_feet=square_feet, balcony='yes'))
+    agent.add(main.ApartmentPurchase(price='$100,000', taxes='$4,000'))
+    print(sorted(a.rent for a in agent.search('apartment', 'rental', rent='<1500')))
+    print([a.rent for a in agent.search('apartment', 'rental', square_feet='>=1500')])
+    print([a.rent for a in agent.search('apartment', 'rental', rent='1000-1500', square_feet='<2000')])
+    purchase = agent.search('apartment', 'purchase', price=100000)[0]
+    print((purchase.price, purchase.taxes))
+
+
+def check_sorted_search():
+    '''
+    >>> check_sorted_search()
+    6
+    [700, 800]
+    [2000, 1900]
+    [900, 1000, 1100] True
+    [1200, 1300, 1900] True
+    [2000] None
+    InvalidCursor [1000, 1100]
+    '''
+    import auth
+    import query
+    agent = main.Agent()
+    for rent in (1200, 800, 2000, 900, 1100, 700, 1300, 1000, 1900):
+        agent.add(main.ApartmentRental(rent=rent, laundry='coin' if rent > 850 else 'none'))
+    print(len(agent.search('apartment', 'rental', rent='>=1000')))
+    print([a.rent for a in agent.search('apartment', 'rental', order_by='rent').top(2)])
+    print([a.rent for a in agent.search('apartment', 'rental', order_by='rent', descending=True).top(2)])
+    page, cursor = agent.search_page('apartment', 'rental', page_size=3, order_by='rent', laundry='coin')
+    print([a.rent for a in page], cursor is not None)
+    page, cursor = agent.search_page(page_size=3, cursor=cursor)
+    print([a.rent for a in page], cursor is not None)
+    page, cursor = agent.search_page(page_size=3, cursor=cursor)
+    print([a.rent for a in page], cursor)
+    # the cursor of a user is not resumed by another one
+    alice, bob = auth.User('alice', 'secret', iterations=1000), auth.User('bob', 'secret', iterations=1000)
+    alice.extend(main.HouseRental(rent=rent) for rent in (900, 1000, 1100))
+    page, cursor = alice.search_page('house', 'rental', page_size=1, order_by='rent')
+    try:
+        bob.search_page(cursor=cursor)
+    except query.InvalidCursor as error:
+        print(type(error).__name__, [a.rent for a in alice.search_page(page_size=2, cursor=cursor)[0]])
+
+
+def check_find_property():
+    '''
+    >>> check_find_property()
+    Range(low=-5, high=-5, low_inclusive=True, high_inclusive=True)
+    Range(low=None, high=5, low_inclusive=True, high_inclusive=True)
+    invalid value 'three': expected a number or a range such as "<1500" or "1000..2000"
+    invalid location 'abc': expected "latitude,longitude,km" or "south,west,north,east"
+    invalid location '1,2': expected "latitude,longitude,km" or "south,west,north,east"
+    Shown 1 of 1 properties
+    [900]
+    '''
+    import contextlib
+    import io
+    from unittest import mock
+    from fields import parse_range
+    print(parse_range('-5'))
+    print(parse_range('..5'))
+    agent = main.Agent()
+    for rent in (900, 1200):
+        agent.add(main.HouseRental(rent=rent, beds=3))
+    # a value that cannot be searched is asked again instead of ending the session
+    answers = iter(['house', 'rental', 'beds=three', '', 'location=abc', '', 'location=1,2', '',
+                    'rent=..1000', '', 'none', 'q'])
+    output = io.StringIO()
+    with mock.patch('builtins.input', lambda *prompt: next(answers)), contextlib.redirect_stdout(output):
+        found = agent.find_property()
+    for line in output.getvalue().splitlines():
+        if line.startswith(('invalid', 'Shown')):
+            print(line)
+    print([a.rent for a in found])
+
+
+def check_iter_properties():
+    '''
+    >>> check_iter_properties()
+    [700, 800, 900, 1000, 1100] [(0, 2), (2, 4), (4, 6)]
+    '''
+    agent = main.Agent()
+    agent.extend(main.HouseRental(rent=rent) for rent in (700, 800, 900, 1000, 1100))
+    slices = []
+    slice_catalog = agent.catalog.slice
+
+    def slice(start, stop):
+        slices.append((start, stop))
+        return slice_catalog(start, stop)
+    agent.catalog.slice = slice
+    print([a.rent for a in agent.iter_properties(page_size=2)], slices)
+
+
+def check_render():
+    '''
+    >>> check_render()
+    True False True 2
+    2 True
+    '''
+    import io
+    import render
+    cache = render.BlockCache(size=2)
+    house = main.HouseRental(rent=900)
+    block = cache.get(house)
+    hit = cache.get(house) is block
+    # the key of the block is the state of the listing, so a change formats it again
+    house.rent = 1000
+    changed = cache.get(house)
+    cache.get(main.HouseRental(rent=1100))
+    print(hit, changed is block, 'rent: $1,000' in changed, len(cache.blocks))
+    writes = []
+
+    class Output(io.StringIO):
+        def write(self, text):
+            writes.append(text)
+            return super().write(text)
+    output = Output()
+    render.stream((main.HouseRental(rent=rent) for rent in (700, 800, 900)), page_size=2, output=output)
+    print(len(writes), output.getvalue().count('rent: ') == 3)
+
+
+def check_browse_properties():
+    '''
+    >>> check_browse_properties()
+    ['Page 1 of 3', 'Page 2 of 3', 'Page 3 of 3', 'Page 3 of 3', 'Page 2 of 3', 'Page 1 of 1']
+    '''
+    import contextlib
+    import io
+    from unittest import mock
+    agent = main.Agent()
+    houses = [main.HouseRental(rent=rent) for rent in (700, 800, 900, 1000, 1100)]
+    agent.extend(houses)
+    answers = iter(['n', 'n', 'n', 'p', 'remove', 'q'])
+
+    def answer(prompt):
+        option = next(answers)
+        if option == 'remove':
+            # the listings removed while browsing move the last page back
+            for house in houses[2:]:
+                agent.remove(house)
+            option = 'n'
+        return option
+    output = io.StringIO()
+    with mock.patch('builtins.input', answer), contextlib.redirect_stdout(output):
+        agent.browse_properties(page_size=2)
+    print([line for line in output.getvalue().splitlines() if line.startswith('Page')])
+
+
+def check_locks():
+    '''
+    >>> check_locks()
+    True ['read', 'release', 'write']
+    1 1 True True
+    True
+    '''
+    import threading
+    import locks
+    lock = locks.ReadWriteLock('check')
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def read():
+        with lock.read():
+            with lock.read():
+                events.append('read')
+                reading.set()
+                release.wait()
+                events.append('release')
+
+    def write():
+        with lock.write():
+            events.append('write')
+    reader = threading.Thread(target=read)
+    reader.start()
+    reading.wait()
+    writer = threading.Thread(target=write)
+    writer.start()
+    # the writer waits for the reader
+    writer.join(0.05)
+    blocked = writer.is_alive()
+    release.set()
+    reader.join()
+    writer.join()
+    print(blocked, events)
+    # the nested read is not counted again
+    stats = lock.metrics()
+    print(stats['read']['count'], stats['write']['count'], stats['read']['hold'] >= 0.05,
+          stats['write']['wait'] >= 0.05)
+    print(locks.metrics()['check']['read']['max_hold'] == stats['read']['max_hold'])
+
+
+def check_metrics():
+    '''
+    >>> check_metrics()
+    {'count': 11, 'errors': 1, 'p50': 0.0005, 'p90': 0.005, 'p99': 5}
+    1 1
+    {'0.0001': 0, '0.0005': 9, '0.001': 9, '0.005': 10, '+Inf': 11}
+    property_action_seconds_bucket{action="search",le="0.0005"} 9
+    property_action_seconds_count{action="search"} 11
+    property_action_errors_total{action="search"} 1
+    None
+    '''
+    import metrics
+    registry = metrics.Registry()
+    for _ in range(9):
+        registry.observe('search', 0.0003)
+    registry.observe('search', 0.002, error=True)
+    registry.observe('search', 2)
+    try:
+        with registry.timer('log_in'):
+            raise ValueError
+    except ValueError:
+        pass
+    search = registry.as_dict()['search']
+    print({name: search[name] for name in ('count', 'errors', 'p50', 'p90', 'p99')})
+    print(registry.as_dict()['log_in']['count'], registry.as_dict()['log_in']['errors'])
+    print({bound: search['buckets'][bound] for bound in ('0.0001', '0.0005', '0.001', '0.005', '+Inf')})
+    for line in registry.prometheus().splitlines():
+        if line.endswith(('le="0.0005"} 9', '_count{action="search"} 11', 'errors_total{action="search"} 1')):
+            print(line)
+    print(metrics.Histogram().percentile(0.5))
+
+
+def check_text_search():
+    '''
+    >>> check_text_search()
+    Catalog
+    ['3 Park Avenue', '12 Elm Street']
+    ['12 Elm Street']
+    ['12 Elm Street', '5 Elmwood Road']
+    ['5 Elmwood Road']
+    PropertyTable
+    ['3 Park Avenue', '12 Elm Street']
+    ['12 Elm Street']
+    ['12 Elm Street', '5 Elmwood Road']
+    ['5 Elmwood Road']
+    SQLiteCatalog
+    ['3 Park Avenue', '12 Elm Street']
+    ['12 Elm Street']
+    ['12 Elm Street', '5 Elmwood Road']
+    ['5 Elmwood Road']
+    SnapshotCatalog
+    ['3 Park Avenue', '12 Elm Street']
+    ['12 Elm Street']
+    ['12 Elm Street', '5 Elmwood Road']
+    ['5 Elmwood Road']
+    '''
+    import os
+    import tempfile
+    import snapshot
+    import storage
+    import table
+    from catalog import Catalog
+    houses = [main.HouseRental(beds='3', address='12 Elm Street', description='Quiet house near the park'),
+              main.HouseRental(beds='3', address='3 Park Avenue', description='Park view, next to the park'),
+              main.HouseRental(beds='2', address='5 Elmwood Road', description='Five minutes from the park')]
+    with tempfile.TemporaryDirectory() as directory:
+        # the snapshot stores the texts in its file
+        path = os.path.join(directory, 'catalog.snap')
+        snapshot.write_snapshot(path, houses)
+        catalogs = [Catalog(), table.PropertyTable(), storage.SQLiteCatalog(storage.connect(':memory:')),
+                    snapshot.SnapshotCatalog(path)]
+        for catalog in catalogs:
+            agent = main.Agent(catalog=catalog)
+            if not isinstance(catalog, snapshot.SnapshotCatalog):
+                agent.extend(houses)
+            print(type(catalog).__name__)
+            print([a.address for a in agent.search('house', 'rental', text='park', beds='3')])
+            print([a.address for a in agent.search('house', 'rental', text='"near the park"')])
+            print([a.address for a in agent.search('house', 'rental', text='elm*')])
+            agent.remove(agent.search('house', 'rental', text='elm')[0])
+            print([a.address for a in agent.search('house', 'rental', text='elm* park')])
+        catalogs[-1].close()
+
+
+def check_location_search():
+    '''
+    >>> check_location_search()
+    Catalog
+    ['Louvre', 'Bastille']
+    ['Louvre']
+    ['Bastille', 'Louvre']
+    ['Bastille']
+    PropertyTable
+    ['Louvre', 'Bastille']
+    ['Louvre']
+    ['Bastille', 'Louvre']
+    ['Bastille']
+    SQLiteCatalog
+    ['Louvre', 'Bastille']
+    ['Louvre']
+    ['Bastille', 'Louvre']
+    ['Bastille']
+    SnapshotCatalog
+    ['Louvre', 'Bastille']
+    ['Louvre']
+    ['Bastille', 'Louvre']
+    ['Bastille']
+    '''
+    import os
+    import tempfile
+    import snapshot
+    import storage
+    import table
+    from catalog import Catalog
+    houses = [main.HouseRental(address=address, latitude=latitude, longitude=longitude, garage=garage)
+              for address, latitude, longitude, garage in (('Louvre', 48.8606, 2.3376, 'none'),
+                                                           ('Bastille', 48.8532, 2.3692, 'attached'),
+                                                           ('Versailles', 48.8049, 2.1204, 'attached'),
+                                                           ('Nowhere', '', '', 'attached'))]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.snap')
+        snapshot.write_snapshot(path, houses[:2])
+        catalogs = [Catalog(), table.PropertyTable(), storage.SQLiteCatalog(storage.connect(':memory:')),
+                    snapshot.SnapshotCatalog(path)]
+        for catalog in catalogs:
+            agent = main.Agent(catalog=catalog)
+            # the snapshot has the other houses in memory
+            agent.extend(houses[2:] if isinstance(catalog, snapshot.SnapshotCatalog) else houses)
+            print(type(catalog).__name__)
+            print([a.address for a in agent.search('house', 'rental', location='48.8566,2.3522,3')])
+            print([a.address for a in agent.search('house', 'rental', location='48.85,2.30,48.87,2.35')])
+            print([a.address for a in agent.nearest('house', 'rental', 48.8530, 2.3700, k=2)])
+            print([a.address for a in agent.nearest('house', 'rental', 48.8606, 2.3376, k=1, garage='attached')])
+        catalogs[-1].close()
+
+
+def check_facets():
+    '''
+    >>> check_facets()
+    {'garage': {'attached': 2, 'none': 1}, 'fenced': {'yes': 3}, 'beds': {2: 1, 3: 2}}
+    {'garage': {'attached': 1, 'none': 1}, 'fenced': {'yes': 2}, 'beds': {3: 2}}
+    {'garage': {'attached': 1, 'none': 1}, 'fenced': {'yes': 2}, 'beds': {2: 1, 3: 1}}
+    Catalog {'garage': {'none': 3}, 'baths': {1: 1, 1.5: 1, 2: 1}}
+    PropertyTable {'garage': {'none': 3}, 'baths': {1: 1, 1.5: 1, 2: 1}}
+    SQLiteCatalog {'garage': {'none': 3}, 'baths': {1: 1, 1.5: 1, 2: 1}}
+    SnapshotCatalog {'garage': {'none': 3}, 'baths': {1: 1, 1.5: 1, 2: 1}}
+    '''
+    agent = main.Agent()
+    for beds, garage in (('3', 'attached'), ('3', 'none'), ('2', 'attached')):
+        agent.add(main.HousePurchase(beds=beds, garage=garage, fenced='yes'))
+    agent.add(main.ApartmentPurchase(beds='1', balcony='solarium'))
+    print(agent.facets('house', 'purchase'))
+    print(agent.search('house', 'purchase', beds='3').facets())
+    agent.remove(agent.search('house', 'purchase', beds='3', garage='attached')[0])
+    print(agent.facets('house', 'purchase'))
+    # every catalog counts the facets, and orders the numbers by value
+    import os
+    import tempfile
+    import snapshot
+    import storage
+    import table
+    from catalog import Catalog
+    houses = [main.HousePurchase(baths=baths, garage='none') for baths in ('2', '1.5', '1')]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.snap')
+        snapshot.write_snapshot(path, houses[:2])
+        catalogs = [Catalog(), table.PropertyTable(), storage.SQLiteCatalog(storage.connect(':memory:')),
+                    snapshot.SnapshotCatalog(path)]
+        for catalog in catalogs:
+            catalog.extend(houses if not isinstance(catalog, snapshot.SnapshotCatalog) else houses[2:])
+            print(type(catalog).__name__, main.Agent(catalog=catalog).facets('house', 'purchase'))
+        catalogs[-1].close()
+
+
+def check_listing_ids():
+    '''
+    >>> check_listing_ids()
+    [0, 1, 2, 3]
+    800
+    [0, 3, 2] 3
+    2000 KeyError
+    [1200, 2000, 900]
+    2 ValueError 1
+    '''
+    import storage
+    agent = main.Agent()
+    for rent in (1200, 800, 2000, 900):
+        agent.add(main.HouseRental(rent=rent))
+    print([agent.listing_id(listing) for listing in agent.catalog])
+    print(agent.get(1).rent)
+    # the last listing takes the place of the removed one and keeps its ID
+    agent.remove_listing(1)
+    print([agent.listing_id(listing) for listing in agent.catalog], agent.listing_id(main.HouseRental(rent=900)))
+    try:
+        agent.get(1)
+    except KeyError:
+        print(agent.get(2).rent, 'KeyError')
+    print([listing.rent for listing in agent.search('house', 'rental')])
+    # the ID of a row of another database is not taken for the ID of the listing
+    first = storage.SQLiteCatalog(storage.connect(':memory:'))
+    second = storage.SQLiteCatalog(storage.connect(':memory:'))
+    first.extend([main.HouseRental(rent=700), main.HouseRental(rent=800)])
+    second.add(main.HouseRental(rent=800))
+    second.add(main.HouseRental(rent=900))
+    house = first.get(2)
+    try:
+        second.id_of(first.get(1))
+    except ValueError:
+        print(house.table_row, 'ValueError', second.id_of(house))
+
+
+def check_ownerships():
+    '''
+    >>> check_ownerships()
+    0 [['alice'], ['alice', 'bob']] 1
+    [900, 1000] [1000]
+    [['alice'], ['alice', 'bob']]
+    [900, 1000, 1200] [1000, 1200]
+    [150000] ['carol']
+    1 False CREATE INDEX properties_kind ON properties (kind, action)
+    ValueError PermissionError
+    [900, 1000] ['alice']
+    [900]
+    '''
+    import os
+    import sqlite3
+    import tempfile
+    import storage
+    from catalog import SharedCatalog
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'property.db')
+        shared = SharedCatalog(storage.SQLiteCatalog(storage.connect(path)))
+        shared.add(main.HouseRental(rent=900), 'alice', 'private')
+        shared.add(main.HouseRental(rent=1000), 'alice')
+        shared.add(main.HouseRental(rent=1000), 'bob')
+        # the owners and the visibility are read again from the database, without building the listings
+        built = []
+        catalog = storage.SQLiteCatalog(storage.connect(path))
+        catalog._build = built.append
+        shared = SharedCatalog(catalog)
+        print(len(built), sorted(sorted(owners) for owners in shared.owners.values()), len(shared.private))
+        shared = SharedCatalog(storage.SQLiteCatalog(storage.connect(path)))
+        print([a.rent for a in shared.view('alice')], [a.rent for a in shared.view('bob')])
+        print([sorted(shared.owners[shared.id_of(a)]) for a in shared.view('alice')])
+        shared.view('bob').add(main.HouseRental(rent=1200))
+        shared.forget_owner('bob')
+        shared = SharedCatalog(storage.SQLiteCatalog(storage.connect(path)))
+        print([a.rent for a in shared.view('alice')], [a.rent for a in shared.view('dave')])
+        # a listing imported with an owner by an older version, in the owner column
+        path = os.path.join(directory, 'legacy.db')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute('CREATE TABLE properties (id INTEGER PRIMARY KEY, owner TEXT, '
+                               'kind TEXT NOT NULL, action TEXT NOT NULL, price NUMERIC)')
+            connection.execute('CREATE INDEX properties_kind ON properties (owner, kind, action)')
+            connection.execute("INSERT INTO properties (owner, kind, action, price) "
+                               "VALUES ('carol', 'house', 'purchase', 150000)")
+        connection.close()
+        shared = SharedCatalog(storage.SQLiteCatalog(storage.connect(path)))
+        found = shared.view('dave').search(main.HousePurchase, {})
+        print([a.price for a in found], sorted(shared.owners[shared.id_of(found[0])]))
+        # the migration runs once
+        connection = storage.connect(path)
+        print(connection.execute('PRAGMA user_version').fetchone()[0],
+              'owner' in {row[1] for row in connection.execute('PRAGMA table_info(properties)')},
+              connection.execute('SELECT sql FROM sqlite_master WHERE name = ?', ('properties_kind',)).fetchone()[0])
+    # only the owners remove their listings, and a listing owned by several users stays for the others
+    shared = SharedCatalog()
+    shared.add(main.HouseRental(rent=900), 'alice', 'private')
+    shared.add(main.HouseRental(rent=1000), 'alice')
+    shared.add(main.HouseRental(rent=1000), 'bob')
+    shared.add(main.HouseRental(rent=1100))
+    errors = []
+    for rent in (900, 1000):
+        try:
+            shared.view('carol').remove(main.HouseRental(rent=rent))
+        except (ValueError, PermissionError) as error:
+            errors.append(type(error).__name__)
+    print(*errors)
+    shared.view('bob').remove(main.HouseRental(rent=1000))
+    shared.view('carol').remove(main.HouseRental(rent=1100))
+    print([a.rent for a in shared.view('alice')], sorted(shared.owners[shared.id_of(main.HouseRental(rent=1000))]))
+    shared.view('alice').remove(main.HouseRental(rent=1000))
+    print([a.rent for a in shared.view('alice')])
+
+
+def check_user_store():
+    '''
+    >>> check_user_store()
+    ['delete entries'] ['administrator', 'editor'] [1900]
+    {'delete entries': True, 'manage permissions': True, 'publish': True, 'view information about properties': False}
+    ['view information about properties'] ['editor'] [1900]
+    ['manage permissions', 'view information about properties']
+    DoesNotExist unknown permissions or roles of alice: reviewer
+    '''
+    import os
+    import tempfile
+    import auth
+    import storage
+
+    def open_database(path):
+        authorizer = auth.Authorizer()
+        for perm_name in (auth.DELETE_ENTRIES, auth.MANAGE_PERMISSIONS, auth.VIEW_PROPERTIES):
+            authorizer.add_permission(perm_name)
+        authorizer.add_role('administrator', [auth.MANAGE_PERMISSIONS])
+        users = storage.SQLiteUserStore(storage.connect(path), authorizer=authorizer)
+        authorizer.authenticator = auth.Authenticator(users=users, iterations=1000)
+        return authorizer.authenticator, authorizer
+
+    def show(authenticator, authorizer):
+        user = authenticator.authenticate(authenticator.log_in('alice', 'secret'))
+        print(authorizer.decode(user.permission_mask), authorizer.list_roles('alice'), [a.rent for a in user.property_list])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'property.db')
+        authenticator, authorizer = open_database(path)
+        authenticator.add_user('alice', 'secret')
+        authorizer.give_permission(auth.DELETE_ENTRIES, 'alice')
+        authorizer.assign_role('administrator', 'alice')
+        authorizer.add_permission('publish')
+        authorizer.add_role('editor', ['publish'], ['administrator'])
+        authorizer.assign_role('editor', 'alice')
+        authenticator.users['alice'].add(main.HouseRental(rent=1900))
+        # the users, their permissions, the roles and the listings are read again from the database
+        authenticator, authorizer = open_database(path)
+        show(authenticator, authorizer)
+        print(authorizer.check_permissions(['alice'], sorted(authorizer.permissions))['alice'])
+        authorizer.withdraw_permission(auth.DELETE_ENTRIES, 'alice')
+        authorizer.give_permission(auth.VIEW_PROPERTIES, 'alice')
+        authorizer.unassign_role('administrator', 'alice')
+        authorizer.revoke_role_permission('publish', 'editor')
+        authenticator, authorizer = open_database(path)
+        show(authenticator, authorizer)
+        print(authorizer.list_permissions('alice'))
+        # a name that is not defined is not dropped silently
+        with authenticator.users.mutex, authenticator.users.connection:
+            authenticator.users.connection.execute('''UPDATE users SET roles = '["reviewer"]' ''')
+        try:
+            open_database(path)[0].users['alice']
+        except auth.DoesNotExist as error:
+            print(type(error).__name__, error)
+
+
+def check_password_upgrade():
+    '''
+    >>> check_password_upgrade()
+    True InvalidPassword True
+    pbkdf2_sha256 1000 False
+    pbkdf2_sha256 2000 False
+    '''
+    import hashlib
+    import auth
+    authenticator = auth.Authenticator(iterations=1000)
+    authenticator.add_user('alice', 'secret')
+    user = authenticator.users['alice']
+    # an account of an older version, with the unsalted SHA-256 hash of its password
+    user.password = legacy = hashlib.sha256(b'secret').hexdigest()
+    try:
+        authenticator.log_in('alice', 'wrong')
+    except auth.InvalidPassword as error:
+        print(auth.needs_rehash(user.password, 1000), type(error).__name__, user.password == legacy)
+    authenticator.log_in('alice', 'secret')
+    algorithm, iterations, salt, digest = user.password.split('$')
+    print(algorithm, iterations, auth.needs_rehash(user.password, 1000))
+    # hashes cheaper than the current cost are upgraded too
+    authenticator.iterations = 2000
+    authenticator.log_in('alice', 'secret')
+    algorithm, iterations, salt, digest = user.password.split('$')
+    print(algorithm, iterations, auth.needs_rehash(user.password, 2000))
+
+
+def check_permissions():
+    '''
+    >>> check_permissions()
+    {'alice': {'add a new entry': True, 'delete entries': False}, 'bob': {'add a new entry': False, 'delete entries': False}}
+    {'bob': {'delete entries': True}}
+    ['delete entries'] PermissionDenied
+    DoesNotExist DoesNotExist
+    '''
+    import auth
+    authorizer = auth.Authorizer()
+    authorizer.authenticator = auth.Authenticator(iterations=1000)
+    authorizer.add_permission(auth.ADD_ENTRY)
+    authorizer.add_permission(auth.DELETE_ENTRIES)
+    for username in ('alice', 'bob'):
+        authorizer.authenticator.add_user(username, 'secret')
+    authorizer.give_permission(auth.ADD_ENTRY, 'alice')
+    print(authorizer.check_permissions())
+    authorizer.give_permission(auth.DELETE_ENTRIES, 'bob')
+    print(authorizer.check_permissions(['bob'], [auth.DELETE_ENTRIES]))
+    authorizer.withdraw_permission(auth.ADD_ENTRY, 'alice')
+    try:
+        authorizer.verify_permission(auth.ADD_ENTRY, 'alice')
+    except auth.PermissionDenied as error:
+        print(authorizer.list_permissions('bob'), type(error).__name__)
+    errors = []
+    for usernames, perm_names in ((['carol'], None), (None, ['fly'])):
+        try:
+            authorizer.check_permissions(usernames, perm_names)
+        except auth.DoesNotExist as error:
+            errors.append(type(error).__name__)
+    print(*errors)
+
+
+def check_roles():
+    '''
+    >>> check_roles()
+    ['add a new entry', 'view information about properties'] ['editor']
+    ['add a new entry', 'delete entries', 'view information about properties']
+    ['add a new entry', 'view information about properties']
+    Role "viewer" would inherit from itself
+    Role "editor" would inherit from itself
+    ['add a new entry']
+    '''
+    import auth
+    authorizer = auth.Authorizer()
+    authorizer.authenticator = auth.Authenticator(iterations=1000)
+    for perm_name in (auth.ADD_ENTRY, auth.DELETE_ENTRIES, auth.VIEW_PROPERTIES):
+        authorizer.add_permission(perm_name)
+    authorizer.authenticator.add_user('alice', 'secret')
+    authorizer.add_role('viewer', [auth.VIEW_PROPERTIES])
+    authorizer.add_role('editor', [auth.ADD_ENTRY], parents=['viewer'])
+    authorizer.add_role('manager', parents=['editor'])
+    authorizer.assign_role('editor', 'alice')
+    print(sorted(authorizer.list_permissions('alice')), authorizer.list_roles('alice'))
+    # the permissions granted to a parent reach the roles inheriting from it and their members
+    authorizer.grant_role_permission(auth.DELETE_ENTRIES, 'viewer')
+    print(sorted(authorizer.list_permissions('alice')))
+    authorizer.revoke_role_permission(auth.DELETE_ENTRIES, 'viewer')
+    print(sorted(authorizer.list_permissions('alice')))
+    for role, parent in (('viewer', 'manager'), ('editor', 'editor')):
+        try:
+            authorizer.add_role_parent(role, parent)
+        except ValueError as error:
+            print(error)
+    authorizer.unassign_role('editor', 'alice')
+    authorizer.give_permission(auth.ADD_ENTRY, 'alice')
+    print(authorizer.list_permissions('alice'))
+
+
+def check_sessions():
+    '''
+    >>> check_sessions()
+    2 alice
+    1 InvalidSession
+    alice alice
+    0 InvalidSession 0
+    '''
+    import auth
+    now = [0]
+    sessions = auth.SessionManager(idle_ttl=10, absolute_ttl=25, clock=lambda: now[0])
+    authenticator = auth.Authenticator(iterations=1000, sessions=sessions)
+    authenticator.add_user('alice', 'secret')
+    used, unused = authenticator.log_in('alice', 'secret'), authenticator.log_in('alice', 'secret')
+    now[0] = 8
+    print(sessions.count('alice'), authenticator.authenticate(used).username)
+    # the unused session expired after idle_ttl, the other one was used since
+    now[0] = 12
+    count = sessions.count('alice')
+    try:
+        authenticator.authenticate(unused)
+    except auth.InvalidSession as error:
+        print(count, type(error).__name__)
+    usernames = []
+    for now[0] in (17, 24):
+        usernames.append(authenticator.authenticate(used).username)
+    print(*usernames)
+    # a session used all along expires after absolute_ttl
+    now[0] = 25
+    try:
+        authenticator.authenticate(used)
+    except auth.InvalidSession as error:
+        print(sessions.count('alice'), type(error).__name__, len(sessions.sessions))
+
+
+def check_table():
+    '''
+    >>> check_table()
+    [1200, 900]
+    [1500] 2
+    ['SlottedHouseRental', 'SlottedHousePurchase']
+    0
+    '''
+    import slotted
+    import table
+    agent = main.Agent(catalog=table.PropertyTable(capacity=2))
+    for rent in (1200, 900, 1500):
+        agent.add(main.HouseRental(rent=rent, garage='attached'))
+    print([a.rent for a in agent.search('house', 'rental', rent='<1500')])
+    agent.remove_listing(agent.listing_id(agent.search('house', 'rental', rent=900)[0]))
+    found = agent.search('house', 'rental', rent='>1000', order_by='rent', descending=True)
+    print([a.rent for a in found.top(1)], agent.listing_id(found[0]))
+    agent = slotted.SlottedAgent(catalog=table.PropertyTable(type_map=slotted.SlottedAgent.type_map))
+    agent.add(slotted.SlottedHouseRental(rent=1000))
+    agent.add(slotted.SlottedHousePurchase(price=100000))
+    print([type(a).__name__ for a in agent.catalog])
+    agent.remove(slotted.SlottedHouseRental(rent=1000))
+    print(len(agent.search('house', 'rental')))
+
+
+def check_import_file():
+    '''
+    >>> check_import_file()
+    line 3: unknown kind and action: castle rental
+    line 4: could not convert string to float: 'three'
+    line 5: more values than the header: yes
+    2 [1900, 1200]
+    '''
+    import io
+    import bulk_import
+    file = io.StringIO('kind,action,beds,rent,furnished\n'
+                       'house,rental,3,"$1,900",no\n'
+                       'castle,rental,3,1000,no\n'
+                       'house,rental,three,1000,no\n'
+                       'apartment,rental,2,1500,no,yes\n'
+                       'apartment,rental,1,1200,\n')
+    agent = main.Agent()
+    imported = bulk_import.import_file(agent, file, report=lambda line_num, error: print('line {}: {}'.format(
+        line_num, error)))
+    print(imported, [a.rent for a in agent.property_list])
+
+
+def check_sharded():
+    '''
+    >>> check_sharded()
+    [1200, 800, 2000, 900, 1100, 700, 1300, 1000]
+    [700, 800] True
+    [2000, 1300, 1200] [1100, 1000, 900] [800, 700] True
+    8 {'beds': {2: 3, 3: 5}} True
+    ['park view, park side', 'a park', 'near the park', 'by the park'] True
+    [1200, 800, 2000, 900, 1100, 700, 1000] 7
+    '''
+    import sharded
+    descriptions = {800: 'near the park', 900: 'a park', 1300: 'park view, park side', 1000: 'by the park'}
+    with sharded.ShardedCatalog(shards_per_family=3, start_method='fork') as catalog:
+        agent = main.Agent(catalog=catalog)
+        agent.extend(main.HouseRental(rent=rent, description=descriptions.get(rent, ''), beds=2 if rent < 1000 else 3)
+                     for rent in (1200, 800, 2000, 900, 1100, 700))
+        agent.add(main.HouseRental(rent=1300, description=descriptions[1300], beds=3))
+        agent.add(main.HouseRental(rent=1000, description=descriptions[1000], beds=3))
+        print([a.rent for a in agent.search('house', 'rental')])
+        found = agent.search('house', 'rental', order_by='rent')
+        # the shards only send their two first listings
+        print([a.rent for a in found.top(2)], found.fetched is None)
+        # the pages are read from the shards one after another, and the search is not run again
+        found = agent.search('house', 'rental', order_by='rent', descending=True)
+        pages = [[a.rent for a in found.page(3)] for _ in range(3)]
+        print(*pages, found.exhausted())
+        print(len(found), found.facets(), found.fetched is None)
+        # ranked by the scores of one catalog holding all the listings
+        single = main.Agent()
+        single.extend(agent.search('house', 'rental'))
+        ranked = [a.description for a in agent.search('house', 'rental', text='park')]
+        print(ranked, ranked == [a.description for a in single.search('house', 'rental', text='park')])
+        agent.remove_listing(agent.listing_id(main.HouseRental(rent=1300, description=descriptions[1300], beds=3)))
+        print([a.rent for a in agent.search('house', 'rental')], len(agent.catalog))
+
+
+def check_paged_ids():
+    '''
+    >>> check_paged_ids()
+    ShardedCatalog [700, 800] [1000, 1100] True
+    Catalog [700, 800] [1000, 1100] True
+    '''
+    import commands
+    import sharded
+    with sharded.ShardedCatalog(shards_per_family=3, start_method='fork') as catalog:
+        for storage in (catalog, None):
+            agent = main.Agent(catalog=storage)
+            agent.extend(main.HouseRental(rent=rent) for rent in (1200, 800, 2000, 900, 1100, 700, 1300, 1000))
+            page, cursor = agent.search_page('house', 'rental', page_size=2, order_by='rent')
+            first = commands.CommandSession.records(agent, page)
+            # a listing of the next page is removed before it is read
+            agent.remove_listing(agent.listing_id(main.HouseRental(rent=900)))
+            page, cursor = agent.search_page(page_size=3, cursor=cursor)
+            second = commands.CommandSession.records(agent, page)
+            ids = [agent.listing_id(main.HouseRental(rent=record['rent'])) for record in first + second]
+            print(type(agent.catalog).__name__, [record['rent'] for record in first],
+                  [record['rent'] for record in second], ids == [record['id'] for record in first + second])
+
+
+def check_kinds():
+    '''
+    >>> check_kinds()
+    ('apartment', 'condo', 'house') ('lease to own', 'purchase', 'rental')
+    ('square_feet', 'beds', 'baths', 'rent', 'text', 'location')
+    CondoLeaseToOwn 1200 300
+    True
+    Catalog 1
+    PropertyTable 1
+    SQLiteCatalog 1
+    SnapshotCatalog 1
+    ShardedCatalog 1
+    '''
+    import os
+    import tempfile
+    import catalog
+    import kinds
+    import sharded
+    import snapshot
+    import storage
+    import table
+    from fields import NumericField
+
+    class Condo(main.Property):
+        init_fields = (('hoa_fee', 'hoa_fee'),)
+
+        def display(self, file=None):
+            super().display(file)
+            print("CONDO DETAILS", file=file)
+            print("HOA fee: {}".format(self.hoa_fee), file=file)
+
+    class LeaseToOwn:
+        init_fields = (('rent', 'rent'), ('option_price', 'option_price'))
+        rent = NumericField()
+        option_price = NumericField()
+
+        def display(self, file=None):
+            super().display(file)
+            print("LEASE TO OWN DETAILS", file=file)
+            print("rent: {}".format(self.rent), file=file)
+
+        @staticmethod
+        def prompt_init():
+            return dict(rent=input("What is the monthly rent? "), option_price=input("What is the option price? "))
+
+    class CondoAgent(main.Agent):
+        type_map = dict(main.Agent.type_map)
+        search_attributes = dict(main.Agent.search_attributes)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.snap')
+        snapshot.write_snapshot(path, [main.HouseRental(rent=900)], CondoAgent.type_map)
+        # the catalogs are all created before the classes are registered
+        catalogs = [catalog.Catalog(), table.PropertyTable(type_map=CondoAgent.type_map),
+                    storage.SQLiteCatalog(storage.connect(':memory:'), type_map=CondoAgent.type_map),
+                    snapshot.SnapshotCatalog(path, CondoAgent.type_map),
+                    sharded.ShardedCatalog(type_map=CondoAgent.type_map, start_method='fork')]
+        registry = kinds.ClassRegistry(CondoAgent)
+        registry.register_kind('condo', Condo)
+        registry.register_payment('lease to own', LeaseToOwn)
+        agent = CondoAgent()
+        print(agent.kinds(), agent.actions())
+        print(CondoAgent.search_attributes[('condo', 'lease to own')])
+        condo = CondoAgent.type_map[('condo', 'lease to own')](beds='2', hoa_fee='300', rent='$1,200')
+        print(type(condo).__name__, condo.rent, condo.hoa_fee)
+        print('CONDO DETAILS' in main.render.cache.get(condo))
+        for storing in catalogs:
+            agent = CondoAgent(catalog=storing)
+            agent.add(condo)
+            print(type(storing).__name__, len(agent.search('condo', 'lease to own', rent='<1500', beds=2)))
+        catalogs[3].close()
+        catalogs[4].close()
+
+
+def check_commands():
+    '''
+    >>> check_commands()
+    {"line": 1, "ok": true, "result": "admin"}
+    {"line": 2, "ok": true, "result": "admin"}
+    {"line": 3, "ok": false, "error": "does not exist"}
+    {"line": 4, "ok": true, "result": ["admin"]}
+    {"line": 5, "ok": true, "result": {"kind": "house", "action": "rental", "rent": 1900, "id": 0}}
+    {"line": 6, "ok": true, "result": null}
+    {"line": 7, "ok": false, "error": "does not exist"}
+    {"line": 8, "ok": false, "error": "argument \\"password\\" must be a str"}
+    {"line": 9, "ok": true, "result": ["admin"]}
+    (6, 3)
+    [1500] ['administrator']
+    does not exist; undoing the group failed: the undo broke DoesNotExist
+    '''
+    import io
+    import auth
+    import commands
+    authenticator = auth.Authenticator(iterations=1000)
+    authorizer = auth.Authorizer()
+    authorizer.authenticator = authenticator
+    for perm_name in (auth.MANAGE_USERS, auth.MANAGE_PERMISSIONS, auth.ADD_ENTRY, auth.DELETE_ENTRIES):
+        authorizer.add_permission(perm_name)
+    authorizer.add_role('administrator', list(authorizer.permissions))
+    script = [
+        '{"command": "add_user", "username": "admin", "password": "secret"}',
+        '{"command": "log_in", "username": "admin", "password": "secret"}',
+        '{"group": [{"command": "add_user", "username": "bob", "password": "secret"},'
+        ' {"command": "give_permission", "username": "bob", "permission": "fly"}]}',
+        '{"command": "list_users"}',
+        '{"command": "add_property", "kind": "house", "action": "rental", "rent": 1900}',
+        '{"command": "remove_property", "id": 0}',
+        '{"command": "remove_property", "id": 0}',
+        '{"command": "add_user", "username": "carol", "password": 12345678}',
+        '{"command": "list_users"}',
+    ]
+    output = io.StringIO()
+    session = commands.CommandSession(authenticator, authorizer)
+    counts = commands.run_batch(session, script, output)
+    print(output.getvalue(), end='')
+    print(counts)
+    # a user deleted by a group that fails comes back with their listings and roles
+    authenticator.add_user('dave', 'secret')
+    authorizer.assign_role('administrator', 'dave')
+    authenticator.users['dave'].add(main.HouseRental(rent=1500))
+    fail = {'command': 'give_permission', 'username': 'dave', 'permission': 'fly'}
+    try:
+        session.run_group([{'command': 'delete_user', 'username': 'dave'}, fail])
+    except auth.DoesNotExist:
+        print([a.rent for a in authenticator.users['dave'].property_list], authorizer.list_roles('dave'))
+
+    # the error of an undo does not hide the error of the command
+    def broken(arguments):
+        def undo():
+            raise commands.CommandError('the undo broke')
+        return None, undo
+    session.commands['broken'] = (broken, None)
+    try:
+        session.run_group([{'command': 'broken'}, fail])
+    except commands.UndoFailed as error:
+        print(error, type(error.__cause__).__name__)
+
+
+def check_server():
+    '''
+    >>> check_server()
+    401 {'error': 'invalid or expired session'}
+    200 {'kind': 'house', 'action': 'rental', 'rent': 1900, 'id': 0}
+    200 {'listings': [{'kind': 'house', 'action': 'rental', 'rent': 1900, 'id': 0}], 'total': 1}
+    200 {'listings': [{'kind': 'house', 'action': 'rental', 'rent': 1900, 'id': 0}], 'cursor': None}
+    400 {'error': 'the body must be a JSON object'}
+    400 {'error': 'field "password" must be a str'}
+    404 {'error': 'no such resource'}
+    405 {'error': 'method not allowed'}
+    500 {'error': 'internal server error'}
+    200 {}
+    404 {'error': 'does not exist'}
+    '''
+    import asyncio
+    import contextlib
+    import io
+    import re
+    import auth
+    import server
+    authenticator = auth.Authenticator(iterations=1000)
+    authorizer = auth.Authorizer()
+    authorizer.authenticator = authenticator
+    for perm_name in (auth.ADD_ENTRY, auth.DELETE_ENTRIES, auth.VIEW_PROPERTIES):
+        authorizer.add_permission(perm_name)
+    authorizer.add_role('administrator', list(authorizer.permissions))
+    authenticator.add_user('admin', 'secret')
+    authorizer.assign_role('administrator', 'admin')
+    api = server.ApiServer(authorizer)
+
+    def fail(request):
+        raise AttributeError('a bug')
+    api.routes.append(('GET', re.compile('/fail$'), fail))
+
+    async def requests():
+        status, payload = await api.dispatch('POST', '/login', {}, b'{"username": "admin", "password": "secret"}')
+        headers = {'authorization': 'Bearer ' + payload['token']}
+        for method, target, request_headers, body in (
+                ('GET', '/listings', {}, b''),
+                ('POST', '/listings', headers, b'{"kind": "house", "action": "rental", "rent": 1900}'),
+                ('GET', '/listings', headers, b''),
+                ('POST', '/listings/search', headers, b'{"kind": "house", "action": "rental"}'),
+                ('DELETE', '/listings', headers, b'[1900]'),
+                ('POST', '/login', {}, b'{"username": "admin", "password": 123456}'),
+                ('GET', '/houses', headers, b''),
+                ('PUT', '/listings', headers, b''),
+                ('GET', '/fail', headers, b''),
+                ('DELETE', '/listings/0', headers, b''),
+                ('GET', '/listings/0', headers, b'')):
+            print(*await api.dispatch(method, target, request_headers, body))
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(requests())
+
+
 def check_agent():
     agent = main.Agent()
     agent.add_property()
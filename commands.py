@@ -0,0 +1,399 @@
+'''
+Module for running the actions of the accounts, the permissions and the listings without the prompts,
+for the terminal menu of ApplicationSession, the API server and the batch scripts.
+
+In a batch script, the commands are JSON objects, one per line, named by "command";
+the other fields are the arguments:
+    {"command": "log_in", "username": "admin", "password": "secret"}
+    {"command": "add_user", "username": "alice", "password": "secret"}
+    {"command": "give_permission", "username": "alice", "permission": "delete entries"}
+    {"command": "add_property", "kind": "house", "action": "rental", "rent": 1900, "beds": 3}
+    {"command": "find", "kind": "house", "action": "rental", "criteria": {"rent": "<2000"}, "limit": 10}
+    {"command": "remove_property", "id": 12}
+The listings returned by add_property and find carry their "id", which remove_property takes.
+A line {"group": [command, ...]} runs its commands as one unit: when one of them fails,
+the ones before it are undone and the rest are not run.
+
+For every line one JSON result is written: {"line": 3, "ok": true, "result": ...}
+or {"line": 3, "ok": false, "error": "..."}. The results are buffered and written a block at a time.
+Usage: python commands.py [script.jsonl]   (the commands are read from stdin without a script)
+'''
+import json
+import sys
+
+import auth
+import metrics
+from bulk_import import create_property, create_record
+
+ERRORS = {
+    auth.InvalidSession: 'not logged in or the session expired',
+    auth.InvalidPassword: 'wrong password',
+    auth.PermissionDenied: 'permission denied',
+    auth.DoesNotExist: 'does not exist',
+    auth.AlreadyExists: 'already exists',
+    auth.PasswordTooShort: 'password is too short',
+}
+
+
+class CommandError(Exception):
+    pass
+
+
+class UndoFailed(CommandError):
+    '''
+    Raised when a command of a group fails and undoing the commands before it fails too.
+    It is chained to the error of the command, and keeps the errors of the undos in undo_errors.
+    '''
+
+    def __init__(self, error, undo_errors):
+        super().__init__('{}; undoing the group failed: {}'.format(
+            describe(error), '; '.join(describe(undo_error) for undo_error in undo_errors)))
+        self.error = error
+        self.undo_errors = undo_errors
+
+
+class CommandSession:
+    '''
+    The actions of the accounts, the permissions and the listings: every command takes its arguments
+    as a dictionary, checks the permission it needs and returns its result instead of printing it.
+    Every command returns a pair (result, undo), where undo() reverts the command.
+    The terminal menu of ApplicationSession and the API server both run their actions through it.
+    '''
+
+    def __init__(self, authenticator=None, authorizer=None, bootstrap=True):
+        '''
+        :bootstrap: Whether the first user may be created without logging in; it becomes an administrator.
+        '''
+        self.authenticator = auth.authenticator if authenticator is None else authenticator
+        self.authorizer = auth.authorizer if authorizer is None else authorizer
+        self.bootstrap = bootstrap
+        self.user = None
+        self.token = None
+        # command name -> (method, permission needed or None)
+        self.commands = {
+            'log_in': (self.log_in, None),
+            'log_out': (self.log_out, None),
+            'add_user': (self.add_user, auth.MANAGE_USERS),
+            'delete_user': (self.delete_user, auth.MANAGE_USERS),
+            'list_users': (self.list_users, auth.MANAGE_USERS),
+            'add_permission': (self.add_permission, auth.MANAGE_PERMISSIONS),
+            'give_permission': (self.give_permission, auth.MANAGE_PERMISSIONS),
+            'withdraw_permission': (self.withdraw_permission, auth.MANAGE_PERMISSIONS),
+            'assign_role': (self.assign_role, auth.MANAGE_PERMISSIONS),
+            'unassign_role': (self.unassign_role, auth.MANAGE_PERMISSIONS),
+            'list_permissions': (self.list_permissions, auth.MANAGE_PERMISSIONS),
+            'all_permissions': (self.all_permissions, auth.MANAGE_PERMISSIONS),
+            'add_property': (self.add_property, auth.ADD_ENTRY),
+            'remove_property': (self.remove_property, auth.DELETE_ENTRIES),
+            'find': (self.find, auth.VIEW_PROPERTIES),
+        }
+
+    @staticmethod
+    def _argument(arguments, name, kind=str):
+        '''
+        Removes the argument from the arguments and returns it.
+        :kind: The type of the argument, e.g. str for the names and the passwords; None for any type.
+        '''
+        try:
+            value = arguments.pop(name)
+        except KeyError:
+            raise CommandError('missing argument "{}"'.format(name))
+        if kind is not None and not isinstance(value, kind):
+            raise CommandError('argument "{}" must be a {}'.format(name, kind.__name__))
+        return value
+
+    def current_user(self):
+        '''
+        Returns the logged in user; raises InvalidSession if the session expired.
+        '''
+        if self.token is None:
+            raise auth.InvalidSession
+        return self.authenticator.authenticate(self.token)
+
+    def check(self, perm_name):
+        '''
+        Returns the logged in user after checking that they have the permission;
+        for the actions that are not commands, such as the interactive searches.
+        '''
+        user = self.current_user()
+        self.authorizer.verify_permission(perm_name, user.username)
+        return user
+
+    def run(self, command):
+        '''
+        Runs one command after checking the permission it needs and returns the pair (result, undo).
+        '''
+        if not isinstance(command, dict):
+            raise CommandError('not a command: {}'.format(command))
+        arguments = dict(command)
+        name = self._argument(arguments, 'command', None)
+        try:
+            method, perm_name = self.commands[name]
+        except (KeyError, TypeError):
+            raise CommandError('unknown command "{}"'.format(name))
+        # the first user can be created by anybody and becomes an administrator
+        bootstrap = self.bootstrap and name == 'add_user' and len(self.authenticator.users) == 0
+        with metrics.registry.timer('command.' + name):
+            if perm_name is not None and not bootstrap:
+                self.check(perm_name)
+            return method(arguments)
+
+    def run_group(self, commands):
+        '''
+        Runs the commands as one unit and returns the list of their results.
+        If one of them fails, the commands run before it are undone and the error is raised.
+        If an undo fails too, the other undos still run, and UndoFailed reports all the errors.
+        '''
+        if not isinstance(commands, list):
+            raise CommandError('a group is a list of commands')
+        results, undos = [], []
+        try:
+            for command in commands:
+                result, undo = self.run(command)
+                results.append(result)
+                undos.append(undo)
+        except Exception as error:
+            undo_errors = []
+            for undo in reversed(undos):
+                try:
+                    undo()
+                except Exception as undo_error:
+                    undo_errors.append(undo_error)
+            if undo_errors:
+                raise UndoFailed(error, undo_errors) from error
+            raise
+        return results
+
+    def log_in(self, arguments):
+        previous = self.user, self.token
+        username = self._argument(arguments, 'username')
+        self.token = self.authenticator.log_in(username, self._argument(arguments, 'password'))
+        self.user = username
+
+        def undo():
+            self.authenticator.log_out(self.token)
+            self.user, self.token = previous
+        return username, undo
+
+    def log_out(self, arguments):
+        user = self.current_user()
+        self.authenticator.log_out(self.token)
+        self.user = self.token = None
+
+        def undo():
+            self.token = self.authenticator.sessions.open(user.username)
+            self.user = user.username
+        return None, undo
+
+    def add_user(self, arguments):
+        username = self._argument(arguments, 'username')
+        first = len(self.authenticator.users) == 0
+        self.authenticator.add_user(username, self._argument(arguments, 'password'))
+        if first:
+            self.authorizer.assign_role('administrator', username)
+        return username, lambda: self.authenticator.del_user(username)
+
+    def delete_user(self, arguments):
+        username = self._argument(arguments, 'username')
+        user = self.authenticator.users.get(username)
+        catalog = self.authenticator.users.catalog
+        owned = set(getattr(catalog, 'owned', {}).get(username, ()))
+        self.authenticator.del_user(username)
+
+        def undo():
+            self.authenticator.restore_user(user, owned)
+            for role in user.roles:
+                self.authorizer.assign_role(role, username)
+        return username, undo
+
+    def list_users(self, arguments):
+        return list(self.authenticator.users), lambda: None
+
+    def add_permission(self, arguments):
+        perm_name = self._argument(arguments, 'permission')
+        self.authorizer.add_permission(perm_name)
+
+        def undo():
+            # nobody was given the new permission before the undo, so its bit can be freed
+            with self.authorizer.lock.write():
+                del self.authorizer.permissions[perm_name]
+                self.authorizer.names.pop()
+                self.authorizer._save_definitions()
+        return perm_name, undo
+
+    def _had_permission(self, perm_name, username):
+        user, bit = self.authorizer._user_and_bit(perm_name, username)
+        return bool(user.permission_mask & bit)
+
+    def give_permission(self, arguments):
+        perm_name = self._argument(arguments, 'permission')
+        username = self._argument(arguments, 'username')
+        had = self._had_permission(perm_name, username)
+        self.authorizer.give_permission(perm_name, username)
+        if had:
+            return None, lambda: None
+        return None, lambda: self.authorizer.withdraw_permission(perm_name, username)
+
+    def withdraw_permission(self, arguments):
+        perm_name = self._argument(arguments, 'permission')
+        username = self._argument(arguments, 'username')
+        self.authorizer.withdraw_permission(perm_name, username)
+        return None, lambda: self.authorizer.give_permission(perm_name, username)
+
+    def assign_role(self, arguments):
+        role = self._argument(arguments, 'role')
+        username = self._argument(arguments, 'username')
+        had = role in self.authorizer.list_roles(username)
+        self.authorizer.assign_role(role, username)
+        if had:
+            return None, lambda: None
+        return None, lambda: self.authorizer.unassign_role(role, username)
+
+    def unassign_role(self, arguments):
+        role = self._argument(arguments, 'role')
+        username = self._argument(arguments, 'username')
+        self.authorizer.unassign_role(role, username)
+        return None, lambda: self.authorizer.assign_role(role, username)
+
+    def list_permissions(self, arguments):
+        return self.authorizer.list_permissions(self._argument(arguments, 'username')), lambda: None
+
+    def all_permissions(self, arguments):
+        with self.authorizer.lock.read():
+            return list(self.authorizer.permissions), lambda: None
+
+    @staticmethod
+    def record(user, listing, listing_id=None):
+        '''
+        Returns the record of the listing with its ID.
+        :listing_id: The ID of the listing if it is known; it is looked up otherwise.
+        '''
+        record = create_record(listing, user.type_map)
+        record['id'] = user.listing_id(listing) if listing_id is None else listing_id
+        return record
+
+    @staticmethod
+    def records(user, listings):
+        '''
+        Returns the records of the listings with their IDs, e.g. of a page of results. The IDs given by
+        the catalog with the listings are used, see index.Found; the others are looked up. The listings
+        removed since they were found are left out.
+        '''
+        listing_ids = getattr(listings, 'listing_ids', None)
+        if listing_ids is None:
+            listing_ids = []
+            for listing in listings:
+                try:
+                    listing_ids.append(user.listing_id(listing))
+                except (KeyError, ValueError):
+                    listing_ids.append(None)
+        stored = user.stored(listing_id for listing_id in listing_ids if listing_id is not None)
+        return [CommandSession.record(user, listing, listing_id) for listing, listing_id in zip(listings, listing_ids)
+                if listing_id in stored]
+
+    def add_property(self, arguments):
+        user = self.current_user()
+        listing = create_property(arguments, user.type_map)
+        user.add(listing)
+        return self.record(user, listing), lambda: user.remove(listing)
+
+    def remove_property(self, arguments):
+        '''
+        Removes the listing with the "id"; without an ID, the listing with the given fields,
+        which is found by comparing it with the stored listings.
+        '''
+        user = self.current_user()
+        if 'id' in arguments:
+            listing_id = arguments['id']
+            if not isinstance(listing_id, int):
+                raise CommandError('the id of a listing is an integer')
+            try:
+                listing = user.get(listing_id)
+                user.remove_listing(listing_id)
+            except KeyError:
+                raise auth.DoesNotExist
+            except PermissionError:
+                raise auth.PermissionDenied
+            return None, lambda: user.add(listing)
+        listing = create_property(arguments, user.type_map)
+        try:
+            user.remove(listing)
+        except ValueError:
+            raise auth.DoesNotExist
+        except PermissionError:
+            raise auth.PermissionDenied
+        return None, lambda: user.add(listing)
+
+    def find(self, arguments):
+        user = self.current_user()
+        criteria = arguments.get('criteria', {})
+        if not isinstance(criteria, dict):
+            raise CommandError('argument "criteria" must be an object')
+        found = user.search(self._argument(arguments, 'kind'), self._argument(arguments, 'action'),
+                            arguments.get('order_by'), bool(arguments.get('descending')), **criteria)
+        listings = found.top(int(arguments['limit']) if 'limit' in arguments else len(found))
+        return self.records(user, listings), lambda: None
+
+
+def describe(error):
+    '''
+    Returns the message reported for the error of a command.
+    '''
+    for kind, message in ERRORS.items():
+        if isinstance(error, kind):
+            return message
+    return str(error) or type(error).__name__
+
+
+def run_batch(session, lines, output=None, buffer_size=1000):
+    '''
+    Runs the commands of the lines and writes one JSON result per line.
+    Returns the numbers of the commands that succeeded and of those that failed.
+    :session: The CommandSession running the commands.
+    :lines: An iterable of JSON lines, e.g. an open file.
+    :output: A text file, sys.stdout by default.
+    :buffer_size: The number of results written at once.
+    '''
+    output = sys.stdout if output is None else output
+    buffer = []
+    succeeded = failed = 0
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            command = json.loads(line)
+            if isinstance(command, dict) and 'group' in command:
+                result = session.run_group(command['group'])
+            else:
+                result = session.run(command)[0]
+            output_line = json.dumps({'line': line_num, 'ok': True, 'result': result})
+        except Exception as error:
+            # whatever goes wrong is the error of this line; the other lines are still run
+            failed += 1
+            buffer.append(json.dumps({'line': line_num, 'ok': False, 'error': describe(error)}))
+        else:
+            succeeded += 1
+            buffer.append(output_line)
+        if len(buffer) >= buffer_size:
+            output.write('\n'.join(buffer) + '\n')
+            buffer = []
+    if buffer:
+        output.write('\n'.join(buffer) + '\n')
+    output.flush()
+    return succeeded, failed
+
+
+def main():
+    session = CommandSession()
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as file:
+            succeeded, failed = run_batch(session, file)
+    else:
+        succeeded, failed = run_batch(session, sys.stdin)
+    print('{} commands succeeded, {} failed.'.format(succeeded, failed), file=sys.stderr)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+'''
+Module counting the listings by the values of their categorical attributes, for the sidebars of the searches.
+
+The counts of every class of listings are kept up to date on every add and remove, so the counts
+of the whole catalog are read without looking at the listings:
+    agent.facets('house', 'rental')           # {'garage': {'attached': 120, 'none': 35}, 'beds': {...}, ...}
+    agent.search('house', 'rental', rent='<1500').facets()
+The counts of a result set are taken over its listings, in one pass.
+'''
+from collections import Counter
+from operator import attrgetter
+
+from fields import NumericField
+
+# facet -> attribute of the property; the facets are named as the search parameters
+FACETS = {
+    'garage': 'garage',
+    'fenced': 'fenced',
+    'laundry': 'laundry',
+    'balcony': 'balcony',
+    'furnished': 'furnished',
+    'beds': 'num_bedrooms',
+    'baths': 'num_baths'
+}
+
+
+def _value_key(value):
+    '''
+    Returns the sort key of a value of a facet: the numbers come first, in ascending order, then the strings.
+    '''
+    if isinstance(value, (int, float)):
+        return 0, value, ''
+    return 1, 0, str(value)
+
+
+def sort_counts(counts):
+    '''
+    Returns the counts of the values of a facet as a dictionary ordered by value; empty values are left out.
+    '''
+    return {value: counts[value] for value in sorted(counts, key=_value_key)
+            if value not in (None, '') and counts[value] > 0}
+
+
+def merge(all_counts):
+    '''
+    Returns the sum of the counts {facet: {value: count}} of several catalogs, e.g. of the shards of a catalog.
+    '''
+    total = {}
+    for counts in all_counts:
+        for facet, values in counts.items():
+            total.setdefault(facet, Counter()).update(values)
+    found = {}
+    for facet, values in total.items():
+        values = sort_counts(values)
+        if values:
+            found[facet] = values
+    return found
+
+
+def _getter(PropertyClass, attribute):
+    '''
+    Returns the function reading the attribute of the properties of the class. The numbers are read
+    from where NumericField stores them, without calling the descriptor.
+    '''
+    descriptor = getattr(PropertyClass, attribute, None)
+    if isinstance(descriptor, NumericField):
+        return attrgetter(descriptor.storage)
+    return attrgetter(attribute)
+
+
+def count(properties):
+    '''
+    Returns the counts of the values of every facet among the properties: {facet: {value: count}}.
+    Facets that none of the properties has are left out.
+    '''
+    properties = list(properties)
+    classes = set(map(type, properties))
+    if len(classes) == 1:
+        groups = {classes.pop(): properties}
+    else:
+        groups = {}
+        for property in properties:
+            groups.setdefault(type(property), []).append(property)
+    found = {}
+    for facet, attribute in FACETS.items():
+        counts = Counter()
+        for PropertyClass, group in groups.items():
+            if not hasattr(PropertyClass, attribute) and not hasattr(group[0], attribute):
+                # e.g. the garage of an apartment
+                continue
+            try:
+                counts.update(Counter(map(_getter(PropertyClass, attribute), group)))
+            except AttributeError:
+                counts.update(getattr(property, attribute, None) for property in group)
+        counts = sort_counts(counts)
+        if counts:
+            found[facet] = counts
+    return found
+
+
+class FacetCounts:
+    '''
+    The counts of the values of every facet, per class of the properties, updated on every add and remove.
+    '''
+
+    def __init__(self):
+        # class of the properties -> facet -> Counter of the values
+        self.counts = {}
+
+    def _update(self, property, step):
+        counts = self.counts.get(type(property))
+        if counts is None:
+            counts = self.counts[type(property)] = {facet: Counter() for facet in FACETS}
+        for facet, attribute in FACETS.items():
+            counts[facet][getattr(property, attribute, None)] += step
+
+    def add(self, property):
+        self._update(property, 1)
+
+    def extend(self, properties):
+        for property in properties:
+            self._update(property, 1)
+
+    def remove(self, property):
+        self._update(property, -1)
+
+    def lookup(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the properties of the class: {facet: {value: count}}.
+        '''
+        found = {}
+        for facet, counts in self.counts.get(property_class, {}).items():
+            counts = sort_counts(counts)
+            if counts:
+                found[facet] = counts
+        return found
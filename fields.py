@@ -0,0 +1,114 @@
+'''
+Module for parsing and formatting the numeric fields of the properties.
+'''
+from collections import namedtuple
+
+
+def parse_number(value):
+    '''
+    Converts the value into an int or a float and returns it.
+    Strings such as "$100,000" or " 1,200 " are accepted; empty values give None.
+    :value: A number or a string with the number.
+    '''
+    if value is None or isinstance(value, (int, float)):
+        return value
+    text = str(value).strip().lstrip('$').replace(',', '').strip()
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def format_number(value):
+    '''
+    Returns the number as it is printed in the details of a property.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def format_money(value):
+    '''
+    Returns the sum of money as it is printed in the details of a property, e.g. "$100,000".
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, float) and not value.is_integer():
+        return '${:,.2f}'.format(value)
+    return '${:,}'.format(int(value))
+
+
+class NumericField:
+    '''
+    Descriptor that parses the assigned value into a number once, when it is assigned.
+    '''
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.storage = '_' + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(instance, self.storage, None)
+
+    def __set__(self, instance, value):
+        setattr(instance, self.storage, parse_number(value))
+
+
+class Range(namedtuple('Range', ('low', 'high', 'low_inclusive', 'high_inclusive'))):
+    '''
+    Range of values of a numeric field. None stands for an open bound.
+    '''
+
+    def __new__(cls, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        return super().__new__(cls, low, high, low_inclusive, high_inclusive)
+
+    def __contains__(self, value):
+        if value is None:
+            return False
+        if self.low is not None:
+            if value < self.low or (value == self.low and not self.low_inclusive):
+                return False
+        if self.high is not None:
+            if value > self.high or (value == self.high and not self.high_inclusive):
+                return False
+        return True
+
+
+def parse_range(value):
+    '''
+    Converts a search value into a Range and returns it; raises ValueError if it is neither a number nor a range.
+    Accepted forms: "1500", "-5", "<1500", "<=1500", ">1200", ">=1200", "1000..2000", "..1500" (up to 1500)
+    and "1200.." (from 1200). "1000-2000" is still read as "1000..2000".
+    :value: A number, a Range or a string in one of the forms above.
+    '''
+    if isinstance(value, Range):
+        return value
+    if isinstance(value, (int, float)):
+        return Range(value, value)
+    text = str(value).strip()
+    try:
+        for prefix in ('<=', '>=', '<', '>'):
+            if text.startswith(prefix):
+                number = parse_number(text[len(prefix):])
+                if prefix[0] == '<':
+                    return Range(high=number, high_inclusive=prefix == '<=')
+                return Range(low=number, low_inclusive=prefix == '>=')
+        if '..' in text:
+            low, high = text.split('..', 1)
+            return Range(parse_number(low), parse_number(high))
+        # the minus sign of a negative low bound is not the separator
+        if '-' in text[1:]:
+            separator = text.index('-', 1)
+            return Range(parse_number(text[:separator]), parse_number(text[separator + 1:]))
+        number = parse_number(text)
+    except ValueError:
+        raise ValueError('invalid value {!r}: expected a number or a range such as "<1500" or "1000..2000"'
+                         .format(value))
+    return Range(number, number)
@@ -0,0 +1,295 @@
+'''
+Module with the spatial index of the locations of the listings.
+
+The surface of the earth is cut into cells of a fixed number of degrees, and every cell keeps the
+listings located in it. A radius or bounding-box query only looks at the cells it overlaps, and
+the k nearest listings are found by visiting the cells in rings around the point:
+    agent.search('house', 'rental', location='48.8566,2.3522,2', beds='3')   # within 2 km
+    agent.search('house', 'rental', location='48.80,2.25,48.90,2.42')        # south, west, north, east
+    agent.nearest('house', 'rental', 48.8566, 2.3522, k=5, garage='attached')
+'''
+import heapq
+import math
+from collections import namedtuple
+from itertools import count
+
+from fields import parse_number
+
+# mean radius of the earth in kilometers
+EARTH_RADIUS = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(latitude, longitude, other_latitude, other_longitude):
+    '''
+    Returns the great-circle distance in kilometers between two points given in degrees.
+    '''
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    sin_phi = math.sin((other_phi - phi) / 2)
+    sin_lambda = math.sin(math.radians(other_longitude - longitude) / 2)
+    a = sin_phi * sin_phi + math.cos(phi) * math.cos(other_phi) * sin_lambda * sin_lambda
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Circle(namedtuple('Circle', ('latitude', 'longitude', 'radius'))):
+    '''
+    The points within radius kilometers of a point.
+    '''
+
+    def box(self):
+        '''
+        Returns the Box around the circle.
+        '''
+        delta = self.radius / KM_PER_DEGREE
+        south, north = max(self.latitude - delta, -90.0), min(self.latitude + delta, 90.0)
+        cosine = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+        if south == -90.0 or north == 90.0 or delta >= 180 * cosine:
+            return Box(south, -180.0, north, 180.0)
+        delta /= cosine
+        return Box(south, _wrap(self.longitude - delta), north, _wrap(self.longitude + delta))
+
+    def __contains__(self, point):
+        return distance(self.latitude, self.longitude, *point) <= self.radius
+
+
+class Box(namedtuple('Box', ('south', 'west', 'north', 'east'))):
+    '''
+    The points between two latitudes and two longitudes. A box whose west is greater than
+    its east crosses the 180th meridian.
+    '''
+
+    def box(self):
+        return self
+
+    def covers(self, south, west, north, east):
+        '''
+        Tells whether the whole box (south, west, north, east), which does not cross the 180th meridian, is inside.
+        '''
+        if not (self.south <= south and north <= self.north):
+            return False
+        if self.west <= self.east:
+            return self.west <= west and east <= self.east
+        return west >= self.west or east <= self.east
+
+    def __contains__(self, point):
+        latitude, longitude = point
+        if not self.south <= latitude <= self.north:
+            return False
+        if self.west <= self.east:
+            return self.west <= longitude <= self.east
+        return longitude >= self.west or longitude <= self.east
+
+
+def _wrap(longitude):
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def parse_area(value):
+    '''
+    Converts a search value into a Circle or a Box and returns it.
+    Accepted forms: "latitude,longitude,radius in km" and "south,west,north,east".
+    :value: A Circle, a Box or a string in one of the forms above.
+    '''
+    if isinstance(value, (Circle, Box)):
+        return value
+    try:
+        numbers = [parse_number(part) for part in str(value).split(',')]
+    except ValueError:
+        numbers = []
+    if None in numbers or len(numbers) not in (3, 4):
+        raise ValueError('invalid location {!r}: expected "latitude,longitude,km" or "south,west,north,east"'
+                         .format(value))
+    if len(numbers) == 3:
+        return Circle(*numbers)
+    return Box(*numbers)
+
+
+def within(properties, area):
+    '''
+    Returns the properties located in the area, in the order they are given; for the catalogs without
+    a GridIndex, which first narrow the properties down to the bounding box of the area.
+    :area: A Circle, a Box or a string accepted by parse_area().
+    '''
+    area = parse_area(area)
+    return [property for property in properties
+            if GridIndex.point(property) is not None and GridIndex.point(property) in area]
+
+
+def nearest(properties, latitude, longitude, k):
+    '''
+    Returns the list of the k properties nearest to the point, the nearest first, for the catalogs
+    without a GridIndex; the properties without a location are left out.
+    '''
+    located = [property for property in properties if GridIndex.point(property) is not None]
+    return heapq.nsmallest(k, located, key=lambda property: distance(latitude, longitude,
+                                                                     *GridIndex.point(property)))
+
+
+class GridIndex:
+    '''
+    Keeps the properties with a location in the cells of a grid of latitudes and longitudes.
+    Properties without a latitude or a longitude are not indexed.
+    '''
+
+    def __init__(self, cell_size=0.02):
+        '''
+        :cell_size: The side of a cell in degrees; 0.02 degrees is about 2 km.
+        '''
+        self.cell_size = cell_size
+        self.rows = math.ceil(180 / cell_size)
+        self.columns = math.ceil(360 / cell_size)
+        # (row, column) -> set of the properties located in the cell
+        self.cells = {}
+
+    @staticmethod
+    def point(property):
+        '''
+        Returns the (latitude, longitude) of the property, or None if it has no location.
+        '''
+        latitude = getattr(property, 'latitude', None)
+        longitude = getattr(property, 'longitude', None)
+        if latitude is None or longitude is None:
+            return None
+        return latitude, longitude
+
+    def _row(self, latitude):
+        return min(int((latitude + 90) // self.cell_size), self.rows - 1)
+
+    def _column(self, longitude):
+        return int((longitude + 180) // self.cell_size) % self.columns
+
+    def _cell(self, point):
+        return self._row(point[0]), self._column(point[1])
+
+    def add(self, property):
+        '''
+        Adds the property to the cell of its location.
+        '''
+        point = self.point(property)
+        if point is not None:
+            self.cells.setdefault(self._cell(point), set()).add(property)
+
+    def extend(self, properties):
+        for property in properties:
+            self.add(property)
+
+    def remove(self, property):
+        '''
+        Removes the property from the cell of its location.
+        '''
+        point = self.point(property)
+        if point is None:
+            return
+        cell = self._cell(point)
+        found = self.cells.get(cell)
+        if found is None:
+            return
+        found.discard(property)
+        if not found:
+            del self.cells[cell]
+
+    def _overlapping(self, box):
+        '''
+        Yields the (row, column) and the properties of the non-empty cells overlapping the box.
+        '''
+        rows = range(self._row(box.south), self._row(box.north) + 1)
+        west = int((box.west + 180) // self.cell_size)
+        east = int((box.east + 180) // self.cell_size)
+        if box.west > box.east:
+            # the box crosses the 180th meridian
+            east += self.columns
+        if east - west + 1 >= self.columns:
+            columns = range(self.columns)
+        else:
+            columns = [column % self.columns for column in range(west, east + 1)]
+        if len(rows) * len(columns) > len(self.cells):
+            # a large area: the non-empty cells are fewer than the cells of the area
+            rows, columns = set(rows), set(columns)
+            for (row, column), found in self.cells.items():
+                if row in rows and column in columns:
+                    yield (row, column), found
+            return
+        for row in rows:
+            for column in columns:
+                found = self.cells.get((row, column))
+                if found:
+                    yield (row, column), found
+
+    def lookup(self, area):
+        '''
+        Returns the set of properties located in the area.
+        :area: A Circle, a Box or a string accepted by parse_area().
+        '''
+        area = parse_area(area)
+        size, result = self.cell_size, set()
+        for (row, column), found in self._overlapping(area.box()):
+            if isinstance(area, Box) and area.covers(row * size - 90, column * size - 180, (row + 1) * size - 90,
+                                                     (column + 1) * size - 180):
+                # the points of a cell inside the box need no check
+                result.update(found)
+            else:
+                result.update(property for property in found if self.point(property) in area)
+        return result
+
+    def nearest(self, latitude, longitude, k, accept):
+        '''
+        Returns the list of the k properties of the accepted set nearest to the point, the nearest first.
+        The cells are visited in rings around the point until no unvisited cell can hold a nearer property.
+        :accept: The set of the properties that may be returned, e.g. those of one class.
+        '''
+        if k <= 0:
+            return []
+        # the k nearest found so far, as a heap of (-distance, tie breaker, property)
+        best, ties = [], count()
+
+        def visit(found):
+            for property in found:
+                if property not in accept:
+                    continue
+                entry = (-distance(latitude, longitude, *self.point(property)), next(ties), property)
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+
+        row, column = self._cell((latitude, longitude))
+        for ring in count():
+            if (2 * ring + 1) ** 2 > len(self.cells):
+                # the rings would look at more cells than there are non-empty ones: all of them are scanned
+                del best[:]
+                for found in self.cells.values():
+                    visit(found)
+                break
+            for cell in self._ring(row, column, ring):
+                found = self.cells.get(cell)
+                if found:
+                    visit(found)
+            if len(best) == k and -best[0][0] <= self._reach(latitude, ring):
+                break
+        return [property for _, _, property in sorted(best, reverse=True)]
+
+    def _ring(self, row, column, ring):
+        '''
+        Returns the cells at the given number of cells from the cell (row, column), inside the grid.
+        '''
+        if ring == 0:
+            return [(row, column)]
+        cells = set()
+        for r in range(max(row - ring, 0), min(row + ring + 1, self.rows)):
+            if abs(r - row) == ring:
+                columns = range(column - ring, column + ring + 1)
+            else:
+                columns = (column - ring, column + ring)
+            cells.update((r, c % self.columns) for c in columns)
+        return cells
+
+    def _reach(self, latitude, ring):
+        '''
+        Returns a distance in kilometers within which all the points lie in the first rings around the point.
+        '''
+        degrees = ring * self.cell_size
+        # a point outside the rings is farther in latitude, or farther in longitude at a latitude
+        # no farther from the equator than the last ring
+        cosine = math.cos(math.radians(min(abs(latitude) + degrees + self.cell_size, 90)))
+        across = 2 * EARTH_RADIUS * math.asin(cosine * math.sin(math.radians(min(degrees, 180)) / 2))
+        return min(degrees * KM_PER_DEGREE, across)
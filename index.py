@@ -0,0 +1,322 @@
+'''
+Module with the in-memory indexes used by Agent to search its properties.
+'''
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from operator import itemgetter
+
+from facets import FacetCounts
+from fields import parse_range
+from geo import GridIndex, parse_area
+from text import TextIndex
+
+
+class HashIndex:
+    '''
+    Maps each value of one attribute to the set of properties having that value.
+    '''
+
+    def __init__(self, attribute):
+        '''
+        :attribute: The name of the indexed attribute of the property.
+        '''
+        self.attribute = attribute
+        self.postings = {}
+
+    def add(self, property):
+        '''
+        Adds the property to the posting list of its value.
+        '''
+        value = getattr(property, self.attribute, None)
+        if value is None:
+            return
+        self.postings.setdefault(value, set()).add(property)
+
+    def remove(self, property):
+        '''
+        Removes the property from the posting list of its value.
+        '''
+        value = getattr(property, self.attribute, None)
+        posting = self.postings.get(value)
+        if posting is None:
+            return
+        posting.discard(property)
+        if not posting:
+            del self.postings[value]
+
+    def extend(self, properties):
+        '''
+        Adds all the properties to the posting lists of their values.
+        '''
+        for property in properties:
+            self.add(property)
+
+    def lookup(self, value):
+        '''
+        Returns the set of properties with the given value.
+        '''
+        return self.postings.get(value, set())
+
+
+class SortedIndex:
+    '''
+    Keeps the properties sorted by a numeric attribute to answer range queries.
+    Removed properties are only marked, and left out of the results, so that removing does not
+    shift the lists; they are dropped from the lists once they make up half of them.
+    '''
+
+    def __init__(self, attribute):
+        '''
+        :attribute: The name of the indexed attribute of the property.
+        '''
+        self.attribute = attribute
+        # (value, id of the property), kept sorted; ids break the ties between equal values
+        self.keys = []
+        self.properties = []
+        self.removed = set()
+
+    def _compact(self):
+        '''
+        Drops the removed properties from the lists.
+        '''
+        kept = [(key, property) for key, property in zip(self.keys, self.properties) if property not in self.removed]
+        self.keys = [key for key, _ in kept]
+        self.properties = [property for _, property in kept]
+        self.removed = set()
+
+    def add(self, property):
+        '''
+        Inserts the property at the position of its value.
+        '''
+        value = getattr(property, self.attribute, None)
+        if value is None:
+            return
+        if property in self.removed:
+            self._compact()
+        key = (value, id(property))
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.properties.insert(position, property)
+
+    def extend(self, properties):
+        '''
+        Inserts all the properties at once: the new entries are sorted and merged with the index.
+        '''
+        properties = list(properties)
+        if self.removed and not self.removed.isdisjoint(properties):
+            self._compact()
+        entries = sorted(((getattr(property, self.attribute, None), id(property)), property)
+                         for property in properties if getattr(property, self.attribute, None) is not None)
+        merged = list(merge(zip(self.keys, self.properties), entries, key=itemgetter(0)))
+        self.keys = [key for key, _ in merged]
+        self.properties = [property for _, property in merged]
+
+    def remove(self, property):
+        '''
+        Removes the property from the index.
+        '''
+        if getattr(property, self.attribute, None) is None:
+            return
+        self.removed.add(property)
+        if 2 * len(self.removed) > len(self.keys):
+            self._compact()
+
+    def bounds(self, value_range):
+        '''
+        Returns the slice (start, stop) of the properties with values in the range.
+        '''
+        start, stop = 0, len(self.keys)
+        if value_range.low is not None:
+            if value_range.low_inclusive:
+                start = bisect_left(self.keys, (value_range.low,))
+            else:
+                start = bisect_right(self.keys, (value_range.low, float('inf')))
+        if value_range.high is not None:
+            if value_range.high_inclusive:
+                stop = bisect_right(self.keys, (value_range.high, float('inf')))
+            else:
+                stop = bisect_left(self.keys, (value_range.high,))
+        return start, max(start, stop)
+
+    def lookup(self, value_range):
+        '''
+        Returns the set of properties with values in the range.
+        '''
+        start, stop = self.bounds(value_range)
+        found = set(self.properties[start:stop])
+        if self.removed:
+            found -= self.removed
+        return found
+
+
+class Found(list):
+    '''
+    The properties returned by a catalog with the IDs of their listings: listing_ids[i] is the ID
+    of properties[i], so that the IDs are not looked up again, e.g. for the copies returned by the shards.
+    '''
+
+    def __init__(self, properties, listing_ids):
+        super().__init__(properties)
+        self.listing_ids = listing_ids
+
+
+class Matches(Found):
+    '''
+    The properties found by a search, in no particular order, with the IDs giving their order:
+    ids[i] is the number of properties added before properties[i]. The sorting is left to
+    the ResultSet, which only sorts as much as it returns.
+    The IDs of the listings are those of Found, or None when the catalog does not give them.
+    '''
+
+    def __init__(self, properties, ids, listing_ids=None):
+        super().__init__(properties, listing_ids)
+        self.ids = ids
+
+
+def in_order(properties):
+    '''
+    Returns the list of the properties in the order they were added.
+    :properties: The result of a search, either a list already in that order or Matches.
+    '''
+    if not isinstance(properties, Matches):
+        return properties
+    return [property for _, property in sorted(zip(properties.ids, properties))]
+
+
+class PropertyIndex:
+    '''
+    Keeps a hash index per searchable attribute of the properties of an agent,
+    a full-text index of their descriptions and addresses searched with the "text" parameter,
+    and a spatial index of their locations searched with the "location" parameter.
+    It also counts the properties of every class by the values of their facets, see facets.py.
+    '''
+
+    # search parameter -> attribute of the property
+    attributes = {
+        'balcony': 'balcony',
+        'laundry': 'laundry',
+        'garage': 'garage',
+        'fenced': 'fenced',
+        'num_stories': 'num_stories',
+        'furnished': 'furnished'
+    }
+
+    numeric_attributes = {
+        'beds': 'num_bedrooms',
+        'baths': 'num_baths',
+        'square_feet': 'square_feet',
+        'price': 'price',
+        'taxes': 'taxes',
+        'rent': 'rent',
+        'utilities': 'utilities'
+    }
+
+    def __init__(self):
+        self.order = {}
+        self.counter = 0
+        self.types = {}
+        self.indexes = {name: HashIndex(attribute) for name, attribute in self.attributes.items()}
+        self.indexes.update({name: SortedIndex(attribute) for name, attribute in self.numeric_attributes.items()})
+        self.indexes['text'] = TextIndex()
+        self.indexes['location'] = GridIndex()
+        self.facets = FacetCounts()
+
+    def add(self, property):
+        '''
+        Registers the property in all the indexes.
+        '''
+        self.order[property] = self.counter
+        self.counter += 1
+        self.types.setdefault(type(property), set()).add(property)
+        for index in self.indexes.values():
+            index.add(property)
+        self.facets.add(property)
+
+    def extend(self, properties):
+        '''
+        Registers all the properties, updating every index once for the whole batch.
+        '''
+        properties = list(properties)
+        for property in properties:
+            self.order[property] = self.counter
+            self.counter += 1
+            self.types.setdefault(type(property), set()).add(property)
+        for index in self.indexes.values():
+            index.extend(properties)
+        self.facets.extend(properties)
+
+    def remove(self, property):
+        '''
+        Removes the property from all the indexes.
+        '''
+        if self.order.pop(property, None) is None:
+            return
+        self.types[type(property)].discard(property)
+        for index in self.indexes.values():
+            index.remove(property)
+        self.facets.remove(property)
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the Matches of the properties of the given class matching all the criteria,
+        or the list of them ranked by relevance when searching the text.
+        :property_class: One of the classes of Agent.type_map.
+        :criteria: A dictionary of search parameters and the values they must equal.
+        Numeric parameters also accept a Range or a string such as "<1500" or "1000..2000",
+        "text" accepts a query such as 'near park "elm street" oak*', see text.py,
+        and "location" an area such as "48.8566,2.3522,2" (2 km around a point), see geo.py.
+        '''
+        postings = [self.types.get(property_class, set())]
+        ranges = []
+        for name, value in criteria.items():
+            if name in self.numeric_attributes:
+                value_range = parse_range(value)
+                start, stop = self.indexes[name].bounds(value_range)
+                ranges.append((stop - start, name, value_range))
+            elif name not in ('text', 'location') or value:
+                postings.append(self.indexes[name].lookup(value))
+        postings.sort(key=len)
+        ranges.sort(key=lambda item: item[0])
+        if ranges and ranges[0][0] < len(postings[0]):
+            # the narrowest range is the smallest candidate set, so it is the only one materialized
+            _, name, value_range = ranges.pop(0)
+            result = self.indexes[name].lookup(value_range)
+        else:
+            result = set(postings.pop(0))
+        for posting in postings:
+            if not result:
+                break
+            result.intersection_update(posting)
+        for _, name, value_range in ranges:
+            attribute = self.numeric_attributes[name]
+            result = {property for property in result if getattr(property, attribute) in value_range}
+        if criteria.get('text'):
+            return self.indexes['text'].rank(result, criteria['text'], self.order)
+        result, order = list(result), self.order
+        return Matches(result, [order[property] for property in result])
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the list of the k properties of the given class matching all the criteria
+        nearest to the point, the nearest first.
+        '''
+        accept = self.types.get(property_class, set())
+        if criteria:
+            accept = set(self.search(property_class, criteria))
+        return self.indexes['location'].nearest(latitude, longitude, k, accept)
+
+
+def parse_criteria(criteria):
+    '''
+    Returns the search parameters with the values of the numeric ones converted into Ranges and
+    the location into an area, so that a value that cannot be searched raises ValueError before the search is run.
+    :criteria: A dictionary of search parameters and their values, e.g. as entered by the user.
+    '''
+    parsed = {}
+    for name, value in criteria.items():
+        if name in PropertyIndex.numeric_attributes:
+            value = parse_range(value)
+        elif name == 'location' and value:
+            value = parse_area(value)
+        parsed[name] = value
+    return parsed
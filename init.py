@@ -1,6 +1,9 @@
+import sys
+
 from auth_account import ApplicationSession
 
+# python init.py [metrics.json]
 try:
-    _ = ApplicationSession()
+    _ = ApplicationSession(sys.argv[1] if len(sys.argv) > 1 else None)
 except SystemExit:
     quit()
@@ -0,0 +1,129 @@
+'''
+Module composing the concrete property classes from a kind of property and a payment type.
+
+The kinds (House, Apartment, ...) and the payment types (Purchase, Rental, ...) declare the arguments
+of their constructors in init_fields, as pairs (argument, attribute). Instead of a chain of
+super().__init__(**kwargs) calls, every concrete class gets one generated __init__ assigning all
+the attributes, like the __init__ written by dataclasses.
+'''
+import keyword
+import sys
+
+from index import PropertyIndex
+
+
+def fields(PropertyClass):
+    '''
+    Returns the pairs (argument, attribute) of all the bases of the class, the most basic class first.
+    '''
+    found = []
+    for base in reversed(PropertyClass.__mro__):
+        for argument, attribute in base.__dict__.get('init_fields', ()):
+            if not all(name.isidentifier() and not keyword.iskeyword(name) for name in (argument, attribute)):
+                raise ValueError('invalid field {} of {}'.format(argument, base.__name__))
+            found.append((argument, attribute))
+    return found
+
+
+def flat_init(PropertyClass):
+    '''
+    Returns an __init__ of the class that assigns all the attributes without calling the __init__ of the bases.
+    Every argument defaults to an empty string, as in the constructors of the bases.
+    '''
+    pairs = fields(PropertyClass)
+    if not pairs:
+        raise ValueError('{} declares no init_fields'.format(PropertyClass.__name__))
+    arguments = ', '.join("{}=''".format(argument) for argument, _ in pairs)
+    body = '\n'.join('    self.{} = {}'.format(attribute, argument) for argument, attribute in pairs)
+    namespace = {}
+    exec('def __init__(self, {}):\n{}\n'.format(arguments, body), namespace)
+    init = namespace['__init__']
+    init.__qualname__ = '{}.__init__'.format(PropertyClass.__qualname__)
+    init.__doc__ = 'Generated by kinds.flat_init() from the init_fields of the bases.'
+    return init
+
+
+def precompile(PropertyClass):
+    '''
+    Replaces the __init__ of the class by its flat __init__ and returns the class.
+    '''
+    PropertyClass.__init__ = flat_init(PropertyClass)
+    return PropertyClass
+
+
+class ClassRegistry:
+    '''
+    The kinds of properties and the payment types known to an agent, and the concrete classes
+    combining them. Registering a kind or a payment type composes the classes of all its combinations,
+    so e.g. a "condo" kind is sold and rented without writing CondoPurchase and CondoRental by hand.
+    The composed classes are cached, so composing the same pair twice returns the same class.
+    '''
+
+    def __init__(self, agent_class):
+        '''
+        :agent_class: The Agent class whose type_map and search_attributes receive the composed classes.
+        Its existing classes are kept, and get a flat __init__.
+        '''
+        self.agent_class = agent_class
+        self.kinds = {}
+        self.payments = {}
+        # (kind class, payment class) -> concrete class
+        self.classes = {}
+        for (kind, action), PropertyClass in agent_class.type_map.items():
+            PaymentClass, KindClass = PropertyClass.__bases__
+            self.kinds[kind] = KindClass
+            self.payments[action] = PaymentClass
+            self.classes[(KindClass, PaymentClass)] = precompile(PropertyClass)
+
+    def compose(self, KindClass, PaymentClass):
+        '''
+        Returns the concrete class of the kind of property with the payment type.
+        '''
+        PropertyClass = self.classes.get((KindClass, PaymentClass))
+        if PropertyClass is None:
+            kind_prompt, payment_prompt = KindClass.prompt_init, PaymentClass.prompt_init
+
+            def prompt_init():
+                init = kind_prompt()
+                init.update(payment_prompt())
+                return init
+            name = KindClass.__name__ + PaymentClass.__name__
+            PropertyClass = type(name, (PaymentClass, KindClass), {
+                '__doc__': 'Implements the {} of a {}.'.format(PaymentClass.__name__.lower(),
+                                                               KindClass.__name__.lower()),
+                '__module__': KindClass.__module__,
+                'prompt_init': staticmethod(prompt_init),
+            })
+            self.classes[(KindClass, PaymentClass)] = precompile(PropertyClass)
+            # published in the module of the kind, so that the listings can be pickled
+            module = sys.modules.get(KindClass.__module__)
+            if module is not None and not hasattr(module, name):
+                setattr(module, name, PropertyClass)
+        return PropertyClass
+
+    def _add(self, kind, action):
+        PropertyClass = self.compose(self.kinds[kind], self.payments[action])
+        self.agent_class.type_map[(kind, action)] = PropertyClass
+        # only the indexed attributes can be searched
+        indexed = set(PropertyIndex.attributes) | set(PropertyIndex.numeric_attributes)
+        searchable = tuple(argument for argument, _ in fields(PropertyClass) if argument in indexed) + ('text', 'location')
+        self.agent_class.search_attributes.setdefault((kind, action), searchable)
+
+    def register_kind(self, kind, KindClass):
+        '''
+        Adds a kind of property, e.g. register_kind("condo", Condo), in combination with every payment type.
+        :KindClass: A subclass of Property declaring the arguments of its constructor in init_fields.
+        Like Property.display(), its display() prints to the file it is given.
+        '''
+        self.kinds[kind] = KindClass
+        for action in self.payments:
+            self._add(kind, action)
+
+    def register_payment(self, action, PaymentClass):
+        '''
+        Adds a payment type, e.g. register_payment("lease to own", LeaseToOwn), for every kind of property.
+        :PaymentClass: A mixin like Purchase or Rental declaring the arguments of its constructor in init_fields.
+        '''
+        self.payments[action] = PaymentClass
+        for kind in self.kinds:
+            self._add(kind, action)
@@ -0,0 +1,138 @@
+'''
+Module with the reader-writer lock guarding the catalogs, the users and the permissions
+when they are used from several threads.
+'''
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# all the named locks, for metrics()
+_locks = weakref.WeakSet()
+
+
+class LockStats:
+    '''
+    How many times a lock was taken, and how long it was waited for and held, in seconds.
+    '''
+    __slots__ = ('count', 'wait', 'hold', 'max_hold')
+
+    def __init__(self):
+        self.count = 0
+        self.wait = 0.0
+        self.hold = 0.0
+        self.max_hold = 0.0
+
+    def record(self, wait, hold):
+        self.count += 1
+        self.wait += wait
+        self.hold += hold
+        if hold > self.max_hold:
+            self.max_hold = hold
+
+    def merge(self, other):
+        self.count += other.count
+        self.wait += other.wait
+        self.hold += other.hold
+        self.max_hold = max(self.max_hold, other.max_hold)
+
+    def as_dict(self):
+        return {'count': self.count, 'wait': self.wait, 'hold': self.hold, 'max_hold': self.max_hold,
+                'mean_hold': self.hold / self.count if self.count else 0.0}
+
+
+class ReadWriteLock:
+    '''
+    Lets many threads read at once, or one thread write. Waiting writers go first, so a steady
+    stream of readers does not starve them.
+    A thread holding the lock may take it again for reading, and the writing thread may take it again
+    for writing; a reading thread must not ask for the write lock, it would wait for itself.
+    '''
+
+    def __init__(self, name=None):
+        '''
+        :name: The name of the lock in metrics(); unnamed locks are left out.
+        '''
+        self.name = name
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+        # the number of times the current thread holds the read lock
+        self.local = threading.local()
+        self.stats = {'read': LockStats(), 'write': LockStats()}
+        if name is not None:
+            _locks.add(self)
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self.local, 'depth', 0)
+        if depth or self.writer == threading.get_ident():
+            self.local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.local.depth = depth
+            return
+        start = time.perf_counter()
+        with self.condition:
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        acquired = time.perf_counter()
+        self.local.depth = 1
+        try:
+            yield
+        finally:
+            self.local.depth = 0
+            with self.condition:
+                self.readers -= 1
+                self.stats['read'].record(acquired - start, time.perf_counter() - acquired)
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+        start = time.perf_counter()
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+        acquired = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = None
+                self.stats['write'].record(acquired - start, time.perf_counter() - acquired)
+                self.condition.notify_all()
+
+    def metrics(self):
+        '''
+        Returns the statistics of the lock: {"read": {...}, "write": {...}}.
+        '''
+        with self.condition:
+            return {mode: stats.as_dict() for mode, stats in self.stats.items()}
+
+
+def metrics():
+    '''
+    Returns the statistics of all the named locks, by name; locks sharing a name are added up.
+    '''
+    totals = {}
+    for lock in list(_locks):
+        with lock.condition:
+            for mode, stats in lock.stats.items():
+                totals.setdefault(lock.name, {}).setdefault(mode, LockStats()).merge(stats)
+    return {name: {mode: stats.as_dict() for mode, stats in modes.items()} for name, modes in totals.items()}
@@ -1,3 +1,13 @@
+from fields import NumericField, format_money, format_number, parse_number
+import kinds
+import metrics
+import render
+from catalog import Catalog
+from index import parse_criteria
+from locks import ReadWriteLock
+from query import LazyResultSet, ResultSet, cursors
+
+
 def get_valid_input(input_string, valid_options):
     '''
     Checks if the passed input matches one of the printed options and returns the input.
@@ -11,42 +21,87 @@ def get_valid_input(input_string, valid_options):
     return response
 
 
+def get_valid_number(input_string):
+    '''
+    Asks for the input until it can be read as a number (e.g. "$100,000") and returns the number.
+    :input_string: Message printed at input
+    '''
+    while True:
+        try:
+            return parse_number(input(input_string))
+        except ValueError:
+            pass
+
+
 class Property:
     '''
     Base class for House and Apartment.
     '''
 
-    def __init__(self, square_feet='', beds='', baths='', **kwargs):
+    __slots__ = ('_square_feet', '_num_bedrooms', '_num_baths', 'description', 'address', '_latitude',
+                 '_longitude')
+    # (argument of the constructor, attribute), see kinds.flat_init()
+    init_fields = (('square_feet', 'square_feet'), ('beds', 'num_bedrooms'), ('baths', 'num_baths'),
+                   ('description', 'description'), ('address', 'address'), ('latitude', 'latitude'),
+                   ('longitude', 'longitude'))
+
+    square_feet = NumericField()
+    num_bedrooms = NumericField()
+    num_baths = NumericField()
+    latitude = NumericField()
+    longitude = NumericField()
+
+    def __init__(self, square_feet='', beds='', baths='', description='', address='', latitude='', longitude='',
+                 **kwargs):
         '''
         :square_feet: The area of the property.
         :beds: The number of bedrooms.
         :baths: The number of bathrooms.
+        :description: Free text describing the property, searched with the "text" parameter.
+        :address: The address of the property, searched with the "text" parameter.
+        :latitude: The latitude of the property in degrees, searched with the "location" parameter.
+        :longitude: The longitude of the property in degrees.
         :kwargs: Keyword arguments for compatibility with multiple inheritance.
         '''
         super().__init__(**kwargs)
         self.square_feet = square_feet
         self.num_bedrooms = beds
         self.num_baths = baths
+        self.description = description
+        self.address = address
+        self.latitude = latitude
+        self.longitude = longitude
 
-    def display(self):
+    def display(self, file=None):
         '''
         Prints out the information on the property.
-        '''
-        print("PROPERTY DETAILS")
-        print("================")
-        print("square footage: {}".format(self.square_feet))
-        print("bedrooms: {}".format(self.num_bedrooms))
-        print("bathrooms: {}".format(self.num_baths))
-        print()
+        :file: A text file, sys.stdout by default.
+        '''
+        print("PROPERTY DETAILS", file=file)
+        print("================", file=file)
+        print("square footage: {}".format(format_number(self.square_feet)), file=file)
+        print("bedrooms: {}".format(format_number(self.num_bedrooms)), file=file)
+        print("bathrooms: {}".format(format_number(self.num_baths)), file=file)
+        if getattr(self, 'address', ''):
+            print("address: {}".format(self.address), file=file)
+        if getattr(self, 'description', ''):
+            print("description: {}".format(self.description), file=file)
+        if self.latitude is not None and self.longitude is not None:
+            print("location: {}, {}".format(format_number(self.latitude), format_number(self.longitude)), file=file)
+        print(file=file)
 
     @staticmethod
     def prompt_init():
         '''
         Requests for the input of the characteristics of the property.
         '''
-        return dict(square_feet=input("Enter the square feet: "),
-                    beds=input("Enter number of bedrooms: "),
-                    baths=input("Enter number of baths: "))
+        return dict(square_feet=get_valid_number("Enter the square feet: "),
+                    beds=get_valid_number("Enter number of bedrooms: "),
+                    baths=get_valid_number("Enter number of baths: "),
+                    address=input("Enter the address: ").strip(),
+                    description=input("Describe the property: ").strip(),
+                    latitude=get_valid_number("Enter the latitude (empty if unknown): "),
+                    longitude=get_valid_number("Enter the longitude (empty if unknown): "))
 
 
 class Apartment(Property):
@@ -54,6 +109,9 @@ class Apartment(Property):
     The class for work with apartments.
     '''
 
+    __slots__ = ('balcony', 'laundry')
+    init_fields = (('balcony', 'balcony'), ('laundry', 'laundry'))
+
     valid_laundries = ("coin", "ensuite", "none")
     valid_balconies = ("yes", "no", "solarium")
 
@@ -66,14 +124,14 @@ class Apartment(Property):
         self.balcony = balcony
         self.laundry = laundry
 
-    def display(self):
+    def display(self, file=None):
         '''
         Displays the information on the apartment.
         '''
-        super().display()
-        print("APARTMENT DETAILS")
-        print("laundry: {}".format(self.laundry))
-        print("has balcony:".format(self.balcony))
+        super().display(file)
+        print("APARTMENT DETAILS", file=file)
+        print("laundry: {}".format(self.laundry), file=file)
+        print("has balcony:".format(self.balcony), file=file)
 
     @staticmethod
     def prompt_init():
@@ -101,6 +159,9 @@ class House(Property):
     The class for work with houses.
     '''
 
+    __slots__ = ('num_stories', 'garage', 'fenced')
+    init_fields = (('num_stories', 'num_stories'), ('garage', 'garage'), ('fenced', 'fenced'))
+
     valid_garage = ("attached", "detached", "none")
     valid_fenced = ("yes", "no")
 
@@ -115,15 +176,15 @@ class House(Property):
         self.fenced = fenced
         self.num_stories = num_stories
 
-    def display(self):
+    def display(self, file=None):
         '''
         Displays the information on the house.
         '''
-        super().display()
-        print("HOUSE DETAILS")
-        print("# of stories: {}".format(self.num_stories))
-        print("garage: {}".format(self.garage))
-        print("fenced yard: {}".format(self.fenced))
+        super().display(file)
+        print("HOUSE DETAILS", file=file)
+        print("# of stories: {}".format(self.num_stories), file=file)
+        print("garage: {}".format(self.garage), file=file)
+        print("fenced yard: {}".format(self.fenced), file=file)
 
     @staticmethod
     def prompt_init():
@@ -147,8 +208,16 @@ class House(Property):
 class Purchase:
     '''
     The class to implement the purchase of a property.
+    The attributes are stored by the concrete classes, so the mixin has no slots of its own.
     '''
 
+    __slots__ = ()
+
+    init_fields = (('price', 'price'), ('taxes', 'taxes'))
+
+    price = NumericField()
+    taxes = NumericField()
+
     def __init__(self, price='', taxes='', **kwargs):
         '''
         :price: The price of the property.
@@ -158,14 +227,14 @@ class Purchase:
         self.price = price
         self.taxes = taxes
 
-    def display(self):
+    def display(self, file=None):
         '''
         Prints out the information on the purchase.
         '''
-        super().display()
-        print("PURCHASE DETAILS")
-        print("selling price: {}".format(self.price))
-        print("estimated taxes: {}".format(self.taxes))
+        super().display(file)
+        print("PURCHASE DETAILS", file=file)
+        print("selling price: {}".format(format_money(self.price)), file=file)
+        print("estimated taxes: {}".format(format_money(self.taxes)), file=file)
 
     @staticmethod
     def prompt_init():
@@ -173,14 +242,22 @@ class Purchase:
         Gets the information on the purchase and outputs it as a dictionary.
         '''
         return dict(
-                price=input("What is the selling price? "),
-                taxes=input("What are the estimated taxes? "))
+                price=get_valid_number("What is the selling price? "),
+                taxes=get_valid_number("What are the estimated taxes? "))
 
 class Rental:
     '''
     Implements the rental of a property.
+    The attributes are stored by the concrete classes, so the mixin has no slots of its own.
     '''
 
+    __slots__ = ()
+
+    init_fields = (('furnished', 'furnished'), ('rent', 'rent'), ('utilities', 'utilities'))
+
+    rent = NumericField()
+    utilities = NumericField()
+
     def __init__(self, furnished='', utilities='', rent='', **kwargs):
         '''
         :furnished: Either yes or no.
@@ -192,16 +269,16 @@ class Rental:
         self.rent = rent
         self.utilities = utilities
 
-    def display(self):
+    def display(self, file=None):
         '''
         Displays the information on the rented property.
         '''
-        super().display()
-        print("RENTAL DETAILS")
-        print("rent: {}".format(self.rent))
+        super().display(file)
+        print("RENTAL DETAILS", file=file)
+        print("rent: {}".format(format_money(self.rent)), file=file)
         print("estimated utilities: {}".format(
-        self.utilities))
-        print("furnished: {}".format(self.furnished))
+        format_money(self.utilities)), file=file)
+        print("furnished: {}".format(self.furnished), file=file)
 
     @staticmethod
     def prompt_init():
@@ -209,8 +286,8 @@ class Rental:
         Stores the information about the rental in a dictionary.
         '''
         return dict(
-            rent = input("What is the monthly rent? "),
-            utilities = input("What are the estimated utilities? "),
+            rent = get_valid_number("What is the monthly rent? "),
+            utilities = get_valid_number("What are the estimated utilities? "),
             furnished = get_valid_input(
         "Is the property furnished? ",
         ("yes", "no")))
@@ -279,6 +356,8 @@ class HousePurchase(Purchase, House):
 class Agent:
     '''
     Implements the main functionality.
+    The catalog may be used from several threads: searches and listings take its lock for reading,
+    so they run at once, while adds and removals take it for writing.
     '''
 
     type_map = {
@@ -288,8 +367,58 @@ class Agent:
         ("apartment", "purchase"): ApartmentPurchase
     }
 
-    def __init__(self):
-        self.property_list = []
+    search_attributes = {
+        ("house", "rental"): ('fenced', 'garage', 'beds', 'baths', 'furnished', 'utilities', 'rent', 'square_feet',
+                              'text', 'location'),
+        ("house", "purchase"): ('fenced', 'garage', 'beds', 'baths', 'price', 'taxes', 'square_feet', 'text',
+                                'location'),
+        ("apartment", "rental"): ('balcony', 'laundry', 'beds', 'baths', 'furnished', 'utilities', 'rent',
+                                  'square_feet', 'text', 'location'),
+        ("apartment", "purchase"): ('balcony', 'laundry', 'beds', 'baths', 'price', 'taxes', 'square_feet', 'text',
+                                    'location')
+    }
+
+    def __init__(self, catalog=None):
+        '''
+        :catalog: The storage of the properties, e.g. table.PropertyTable(). A Catalog by default.
+        '''
+        self.catalog = Catalog() if catalog is None else catalog
+        # agents sharing a catalog (e.g. the views of a SharedCatalog) share its lock
+        self.lock = getattr(self.catalog, 'lock', None) or ReadWriteLock('catalog')
+
+    def kinds(self):
+        '''
+        Returns the kinds of properties of the type map, e.g. ("apartment", "house").
+        '''
+        return tuple(sorted({kind for kind, _ in self.type_map}))
+
+    def actions(self):
+        '''
+        Returns the payment types of the type map, e.g. ("purchase", "rental").
+        '''
+        return tuple(sorted({action for _, action in self.type_map}))
+
+    @property
+    def property_list(self):
+        '''
+        The list of all the properties of the agent.
+        '''
+        with self.lock.read():
+            return list(self.catalog)
+
+    def iter_properties(self, page_size=100):
+        '''
+        Yields all the properties of the agent, reading them from the catalog a page at a time with slice(),
+        so that only one page of properties is created at once and the lock is only held while a page is read.
+        '''
+        start = 0
+        while True:
+            with self.lock.read():
+                page = self.catalog.slice(start, start + page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            start += page_size
 
     @staticmethod
     def multiple_input(message, *options):
@@ -301,50 +430,132 @@ class Agent:
             for i in opt:
                 print(i)
             inp = input()
-            if '=' not in inp or inp.count('=') > 1:
+            if '=' not in inp:
                 continue
-            index = inp.find('=')
-            if inp[:index].strip() not in options:
+            key, _, value = inp.partition('=')
+            if key.strip() not in options:
                 continue
-            output.update({inp[:index].strip(): inp[index + 1:].strip()})
+            output.update({key.strip(): value.strip()})
             try:
-                opt.remove(inp[:index].strip())
+                opt.remove(key.strip())
             except ValueError:
                 pass
         return output
 
-    @staticmethod
-    def set_of_dict(dictionary):
-        a = set()
-        for key in dictionary:
-            a.add((key, dictionary[key]))
-        return a
-
-    def find_property(self):
-        kind = get_valid_input('What kind of property do you want to find?', ('apartment', 'house'))
-        action = get_valid_input('Purchase or rental?', ('purchase', 'rental'))
-        PropertyClass = Agent.type_map[(kind, action)]
-        if (kind, action) == ('apartment', 'purchase'):
-            attributes = ['balcony', 'laundry', 'beds', 'baths', 'price', 'taxes', 'square_feet']
-        elif (kind, action) == ('apartment', 'rental'):
-            attributes = ['balcony', 'laundry', 'beds', 'baths', 'furnished', 'utilities', 'rent', 'square_feet']
-        elif (kind, action) == ('house', 'purchase'):
-            attributes = ['fenced', 'garage', 'beds', 'baths', 'price', 'taxes', 'square_feet']
-        else:
-            attributes = ['balcony', 'laundry', 'beds', 'baths', 'furnished', 'utilities', 'rent', 'square_feet']
-        search_request = Agent.multiple_input('Enter search parameters: ', *attributes)
-        for property in self.property_list:
-            if Agent.set_of_dict(property.__dict__()).issuperset(Agent.set_of_dict(search_request)):
-                return property
-        else:
+    @metrics.timed('search')
+    def search(self, kind, action, order_by=None, descending=False, **criteria):
+        '''
+        Returns the ResultSet of all the properties of the given kind and payment type matching all the criteria.
+        :kind: Either "house" or "apartment".
+        :action: Either "purchase" or "rental".
+        :order_by: The sort key of the results ("price", "rent", "square_feet", "beds", ...);
+        by default the properties are in the order they were added.
+        :descending: Whether the largest values come first.
+        :criteria: Search parameters and their values, e.g. beds='2', garage='attached', rent='<1500',
+        square_feet=Range(low=1200), text='"near the park" elm*' or location='48.8566,2.3522,2' (within 2 km);
+        a text search is ranked by relevance.
+        '''
+        property_class = self.type_map[(kind, action)]
+        if hasattr(self.catalog, 'top'):
+            # the catalog selects the first results itself, e.g. sharded.ShardedCatalog
+            return LazyResultSet(self.catalog, property_class, criteria, order_by, descending)
+        with self.lock.read():
+            found = self.catalog.search(property_class, criteria)
+        return ResultSet(found, order_by, descending)
+
+    @metrics.timed('nearest')
+    def nearest(self, kind, action, latitude, longitude, k=10, **criteria):
+        '''
+        Returns the list of the k properties of the given kind and payment type matching all the criteria
+        nearest to the point, the nearest first.
+        :latitude, longitude: The point in degrees, e.g. the location of a school.
+        '''
+        with self.lock.read():
+            return self.catalog.nearest(self.type_map[(kind, action)], parse_number(latitude),
+                                        parse_number(longitude), k, criteria)
+
+    def facets(self, kind, action):
+        '''
+        Returns the counts of the values of every facet among the properties of the given kind and payment type,
+        e.g. {'garage': {'attached': 12, 'none': 3}, 'beds': {2: 5, 3: 10}}. The default catalog keeps
+        the counts up to date and the other catalogs count the stored values, so no property is created.
+        '''
+        with self.lock.read():
+            return self.catalog.facets(self.type_map[(kind, action)])
+
+    def search_page(self, kind=None, action=None, page_size=20, cursor=None, order_by=None, descending=False,
+                    **criteria):
+        '''
+        Returns a page of the results of a search and the cursor of the next page (None after the last page).
+        To get the next page, call it again with only the cursor; the search is not run again.
+        The cursors of a user (see auth.User) are resumed only by the same user.
+        '''
+        owner = getattr(self, 'username', None)
+        if cursor is not None:
+            return cursors.resume(cursor, page_size, owner)
+        return cursors.fetch(self.search(kind, action, order_by, descending, **criteria), page_size, owner)
+
+    def find_property(self, page_size=10):
+        '''
+        Asks for the search parameters and the sort key, prints out the matching properties
+        page by page and returns the ResultSet of all of them.
+        '''
+        kind = get_valid_input('What kind of property do you want to find?', self.kinds())
+        action = get_valid_input('Purchase or rental?', self.actions())
+        attributes = Agent.search_attributes[(kind, action)]
+        while True:
+            search_request = Agent.multiple_input(
+                'Enter search parameters (numbers accept ranges such as rent=<1500, square_feet=>=1200 '
+                'or price=100000..200000; text accepts words, "phrases" and prefixes such as park*; location '
+                'accepts latitude,longitude,km or south,west,north,east): ', *attributes)
+            try:
+                criteria = parse_criteria(search_request)
+            except ValueError as error:
+                print(error)
+            else:
+                break
+        sort_keys = tuple(key for key in ('price', 'rent', 'square_feet', 'beds') if key in attributes)
+        # without a sort key, a text search is ordered by relevance
+        order_by = get_valid_input('Sort by?', ('none',) + sort_keys).lower()
+        found = self.search(kind, action, None if order_by == 'none' else order_by, **criteria)
+        if not found:
             print('Not found')
+            return found
+        for facet, counts in found.facets().items():
+            print('{}: {}'.format(facet, ', '.join('{} ({})'.format(value, number) for value, number in counts.items())))
+        while True:
+            render.write(found.page(page_size))
+            print('Shown {} of {} properties'.format(found.position, len(found)))
+            if found.exhausted() or get_valid_input('n - next page, q - quit', ('n', 'q')).lower() == 'q':
+                return found
 
     def display_properties(self):
         '''
         Prints out the information on all the properties of the agent.
-        '''
-        for property in self.property_list:
-            property.display()
+        The listings are read and written a page at a time, from the cache of formatted listings.
+        '''
+        render.stream(self.iter_properties())
+
+    def browse_properties(self, page_size=10):
+        '''
+        Prints out the properties page by page, letting the user move forward and backward.
+        :page_size: The number of properties on a page.
+        '''
+        page = 0
+        while True:
+            with self.lock.read():
+                pages = max((len(self.catalog) + page_size - 1) // page_size, 1)
+                page = min(page, pages - 1)
+                found = self.catalog.slice(page * page_size, (page + 1) * page_size)
+            render.write(found)
+            print('Page {} of {}'.format(page + 1, pages))
+            option = get_valid_input('n - next page, p - previous page, q - quit', ('n', 'p', 'q')).lower()
+            if option == 'q':
+                return
+            if option == 'n' and page + 1 < pages:
+                page += 1
+            elif option == 'p' and page > 0:
+                page -= 1
 
     def add_property(self):
         '''
@@ -352,21 +563,91 @@ class Agent:
         '''
         property_type = get_valid_input(
          "What type of property? ",
-         ("house", "apartment")).lower()
+         self.kinds()).lower()
         payment_type = get_valid_input(
          "What payment type? ",
-         ("purchase", "rental")).lower()
+         self.actions()).lower()
         PropertyClass = self.type_map[(property_type, payment_type)]
         init_args = PropertyClass.prompt_init()
-        self.property_list.append(PropertyClass(**init_args))
+        self.add(PropertyClass(**init_args))
 
-    def remove_property(self):
-        for property in enumerate(self.property_list):
-            print(property[0])
-            property[1].display()
-        print('Enter the number of property to remove: ')
-        try:
-            num = int(input())
-            self.property_list.pop(num)
-        except ValueError:
-            print('Invalid number!')
+    def add(self, property):
+        '''
+        Stores an already created property and indexes it.
+        '''
+        with self.lock.write():
+            self.catalog.add(property)
+
+    def extend(self, properties):
+        '''
+        Stores many already created properties, updating the indexes once for the whole batch.
+        '''
+        properties = list(properties)
+        with self.lock.write():
+            self.catalog.extend(properties)
+
+    def remove(self, property):
+        '''
+        Removes the property from the list of properties and from the indexes.
+        '''
+        with self.lock.write():
+            self.catalog.remove(property)
+
+    def get(self, listing_id):
+        '''
+        Returns the property with the ID; raises KeyError if there is none.
+        '''
+        with self.lock.read():
+            return self.catalog.get(listing_id)
+
+    def listing_id(self, property):
+        '''
+        Returns the ID of the property, which does not change until the property is removed.
+        '''
+        with self.lock.read():
+            return self.catalog.id_of(property)
+
+    def stored(self, listing_ids):
+        '''
+        Returns the set of the IDs whose properties are still stored.
+        '''
+        with self.lock.read():
+            return self.catalog.stored(listing_ids)
+
+    def remove_listing(self, listing_id):
+        '''
+        Removes the property with the ID; raises KeyError if there is none.
+        '''
+        with self.lock.write():
+            self.catalog.remove(self.catalog.get(listing_id))
+
+    def remove_property(self, page_size=10):
+        '''
+        Shows the properties with their IDs a page at a time and removes the property whose ID is entered.
+        '''
+        start = 0
+        while True:
+            with self.lock.read():
+                page = self.catalog.slice(start, start + page_size)
+                ids = [self.catalog.id_of(property) for property in page]
+            render.write(page, labels=['ID {}'.format(listing_id) for listing_id in ids])
+            option = input('Enter the ID of the property to remove (n - next page, q - quit): ').strip().lower()
+            if option == 'q':
+                return
+            if option == 'n':
+                start = start + page_size if len(page) == page_size else 0
+                continue
+            try:
+                self.remove_listing(int(option))
+            except (ValueError, KeyError):
+                print('Invalid ID!')
+            except PermissionError:
+                print('The property belongs to other users!')
+            else:
+                print('Removed the property {}.'.format(option))
+                return
+
+
+# the classes of the agents; new kinds and payment types are added with
+# classes.register_kind() and classes.register_payment()
+classes = kinds.ClassRegistry(Agent)
@@ -0,0 +1,224 @@
+'''
+Module recording how often the actions of the application run, how often they fail and how long they take.
+
+Every action has a histogram of its latencies with fixed buckets, so recording a call costs two clock
+reads and a binary search; the percentiles are the bounds of the buckets. The metrics can be written
+as a Prometheus text file or dumped as JSON periodically by a background thread:
+    metrics.registry.write_prometheus('property.prom')
+    dumper = metrics.JsonDumper('metrics.json', interval=60, prometheus_path='property.prom')
+    dumper.start()
+The API server starts the dumper with --metrics PATH, and the terminal application with python init.py PATH.
+'''
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import locks
+
+# upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Histogram:
+    '''
+    The number of calls of an action, of the failed ones, and of those in every latency bucket.
+    '''
+    __slots__ = ('counts', 'count', 'errors', 'total')
+
+    def __init__(self):
+        # the last bucket counts the calls slower than the largest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        '''
+        Returns the upper bound of the bucket holding the given fraction of the calls, e.g. 0.99 for the
+        99th percentile; infinity if it falls beyond the largest bound, None before the first call.
+        '''
+        if not self.count:
+            return None
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= fraction * self.count:
+                return bound
+
+    def as_dict(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'errors': self.errors, 'sum': self.total, 'buckets': buckets,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+class Registry:
+    '''
+    The histograms of all the actions, by name.
+    '''
+
+    def __init__(self, prefix='property'):
+        '''
+        :prefix: The prefix of the names of the Prometheus metrics.
+        '''
+        self.prefix = prefix
+        self.enabled = True
+        self.histograms = {}
+        self.mutex = threading.Lock()
+
+    def histogram(self, name):
+        '''
+        Returns the histogram of the action, creating it on first use.
+        '''
+        with self.mutex:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            return histogram
+
+    def observe(self, name, seconds, error=False):
+        '''
+        Records a call of the action that took the given number of seconds.
+        '''
+        histogram = self.histogram(name)
+        with self.mutex:
+            histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, name):
+        '''
+        Records the duration of the block as a call of the action; an exception counts as an error.
+        SystemExit and KeyboardInterrupt end the call without being errors.
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, error)
+
+    def as_dict(self):
+        with self.mutex:
+            return {name: histogram.as_dict() for name, histogram in sorted(self.histograms.items())}
+
+    def prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text format, together with the hold times of the locks.
+        '''
+        name = self.prefix + '_action_seconds'
+        lines = ['# HELP {} Duration of the actions.'.format(name), '# TYPE {} histogram'.format(name)]
+        errors = ['# HELP {0}_action_errors_total Failed actions.'.format(self.prefix),
+                  '# TYPE {0}_action_errors_total counter'.format(self.prefix)]
+        for action, histogram in self.as_dict().items():
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_bucket{{action="{}",le="{}"}} {}'.format(name, action, bound, count))
+            lines.append('{}_sum{{action="{}"}} {}'.format(name, action, histogram['sum']))
+            lines.append('{}_count{{action="{}"}} {}'.format(name, action, histogram['count']))
+            errors.append('{}_action_errors_total{{action="{}"}} {}'.format(self.prefix, action, histogram['errors']))
+        hold = self.prefix + '_lock_hold_seconds'
+        lines += errors + ['# HELP {} Time the locks were held.'.format(hold), '# TYPE {} summary'.format(hold)]
+        for lock, modes in sorted(locks.metrics().items()):
+            for mode, stats in modes.items():
+                labels = '{{lock="{}",mode="{}"}}'.format(lock, mode)
+                lines.append('{}_sum{} {}'.format(hold, labels, stats['hold']))
+                lines.append('{}_count{} {}'.format(hold, labels, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''
+        Writes the Prometheus text file; the file is replaced at once, so a reader never sees half of it.
+        '''
+        _replace(path, self.prometheus())
+
+    def write_json(self, path):
+        _replace(path, json.dumps({'time': time.time(), 'actions': self.as_dict(), 'locks': locks.metrics()}))
+
+
+def _replace(path, text):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+registry = Registry()
+
+
+def timed(name):
+    '''
+    Decorator recording every call of the function in the registry under the name.
+    '''
+    def decorate(function):
+        histogram = registry.histogram(name)
+        clock = time.perf_counter
+
+        # the same as registry.timer(), without the cost of a generator on the hot paths
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            start = clock()
+            error = False
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                seconds = clock() - start
+                with registry.mutex:
+                    histogram.observe(seconds, error)
+        return wrapper
+    return decorate
+
+
+class JsonDumper(threading.Thread):
+    '''
+    Background thread writing the metrics of the registry as JSON every interval seconds.
+    '''
+
+    def __init__(self, path, interval=60, registry=registry, prometheus_path=None):
+        '''
+        :prometheus_path: The Prometheus text file also written at every dump, if any.
+        '''
+        super().__init__(name='metrics-dump', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.prometheus_path = prometheus_path
+        self.stopped = threading.Event()
+
+    def dump(self):
+        self.registry.write_json(self.path)
+        if self.prometheus_path is not None:
+            self.registry.write_prometheus(self.prometheus_path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        '''
+        Stops the thread after a last dump.
+        '''
+        self.stopped.set()
+        self.dump()
@@ -0,0 +1,268 @@
+'''
+Module with the result sets returned by the searches of Agent.
+'''
+import heapq
+import secrets
+import threading
+from collections import OrderedDict
+
+import facets
+from index import Found, Matches, PropertyIndex
+
+# sort key -> attribute of the property
+SORT_KEYS = PropertyIndex.numeric_attributes
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class ResultSet:
+    '''
+    All the properties matching a search. The ordering is applied lazily: top() selects
+    the k first properties with a heap and page() pops the properties a page at a time,
+    so the whole result set is only sorted when all of it is read, and then only once.
+    '''
+
+    def __init__(self, properties, order_by=None, descending=False):
+        '''
+        :properties: The list of the matching properties in the order they were added, or the Matches
+        of an index, which are put in that order only as far as they are read.
+        :order_by: A sort key such as "price", "rent", "square_feet" or "beds"; None keeps the order they were added.
+        :descending: Whether the largest values come first.
+        '''
+        if order_by is not None and order_by not in SORT_KEYS:
+            raise KeyError(order_by)
+        self.properties = properties
+        # the positions of the properties in the order they were added, when they are not in that order
+        self.ids = properties.ids if isinstance(properties, Matches) else None
+        # the IDs of the listings, when the catalog gave them with the properties
+        self.listing_ids = getattr(properties, 'listing_ids', None)
+        self.order_by = order_by
+        self.descending = descending
+        self.heap = None
+        self.ordered = None
+        self.position = 0
+
+    def _key(self, position):
+        '''
+        Returns the sort key of the property at the position; properties without a value come last,
+        and properties with the same value are in the order they were added.
+        '''
+        added = position if self.ids is None else self.ids[position]
+        if self.order_by is None:
+            return False, 0, added
+        value = getattr(self.properties[position], SORT_KEYS[self.order_by], None)
+        if value is None:
+            return True, 0, added
+        return False, -value if self.descending else value, added
+
+    def _select(self, positions):
+        '''
+        Returns the properties at the positions, with the IDs of their listings if the catalog gave them.
+        '''
+        found = [self.properties[position] for position in positions]
+        if self.listing_ids is None:
+            return found
+        return Found(found, [self.listing_ids[position] for position in positions])
+
+    def _sorted(self):
+        '''
+        Returns the positions of all the properties in the order of the result set, sorting them on the first call.
+        '''
+        if self.ordered is None:
+            if self.order_by is None and self.ids is None:
+                self.ordered = range(len(self.properties))
+            else:
+                self.ordered = sorted(range(len(self.properties)), key=self._key)
+        return self.ordered
+
+    def top(self, k):
+        '''
+        Returns the list of the k first properties in the order of the result set.
+        '''
+        if self.ordered is not None or self.order_by is None and self.ids is None:
+            return self._select(self._sorted()[:k])
+        return self._select(heapq.nsmallest(k, range(len(self.properties)), key=self._key))
+
+    def page(self, size):
+        '''
+        Returns the next page of properties; an empty list when all of them were returned.
+        '''
+        if self.ordered is not None or self.order_by is None and self.ids is None:
+            found = self._select(self._sorted()[self.position:self.position + size])
+            self.position += len(found)
+            return found
+        if self.heap is None:
+            self.heap = [(self._key(position), position) for position in range(len(self.properties))]
+            heapq.heapify(self.heap)
+            # the properties returned before the heap was built, see LazyResultSet
+            for _ in range(self.position):
+                heapq.heappop(self.heap)
+        positions = []
+        while self.heap and len(positions) < size:
+            positions.append(heapq.heappop(self.heap)[1])
+        self.position += len(positions)
+        return self._select(positions)
+
+    def facets(self):
+        '''
+        Returns the counts of the values of every facet among all the properties, see facets.py.
+        '''
+        return facets.count(self.properties)
+
+    def exhausted(self):
+        '''
+        Tells whether page() has returned all the properties.
+        '''
+        return self.position >= len(self.properties)
+
+    def __len__(self):
+        return len(self.properties)
+
+    def __bool__(self):
+        return bool(self.properties)
+
+    def __iter__(self):
+        return (self.properties[position] for position in self._sorted())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._select(self._sorted()[item])
+        return self.properties[self._sorted()[item]]
+
+
+class LazyResultSet(ResultSet):
+    '''
+    Result set of a catalog that selects the first matching properties itself, such as
+    sharded.ShardedCatalog: until all the properties are needed, top() asks the catalog for the k first
+    properties only, and the pages are read from a stream of the catalog, which runs the search once
+    and sends the properties a batch at a time, with their number and their facet counts.
+    '''
+
+    def __init__(self, catalog, property_class, criteria, order_by=None, descending=False):
+        '''
+        :catalog: A catalog with the methods top(property_class, criteria, order_by, k, descending)
+        and stream(property_class, criteria, order_by, descending), see sharded.Stream.
+        :property_class: The class of the properties searched.
+        :criteria: A dictionary of search parameters and their values.
+        '''
+        self.catalog = catalog
+        self.property_class = property_class
+        self.criteria = criteria
+        self.fetched = None
+        self.stream = None
+        super().__init__(None, order_by, descending)
+
+    @property
+    def properties(self):
+        if self.fetched is None:
+            self.fetched = self.catalog.search(self.property_class, self.criteria)
+            self.all_ids = self.fetched.ids if isinstance(self.fetched, Matches) else None
+            self.all_listing_ids = getattr(self.fetched, 'listing_ids', None)
+        return self.fetched
+
+    @properties.setter
+    def properties(self, properties):
+        self.fetched = properties
+
+    @property
+    def ids(self):
+        self.properties
+        return self.all_ids
+
+    @ids.setter
+    def ids(self, ids):
+        self.all_ids = ids
+
+    @property
+    def listing_ids(self):
+        self.properties
+        return self.all_listing_ids
+
+    @listing_ids.setter
+    def listing_ids(self, listing_ids):
+        self.all_listing_ids = listing_ids
+
+    def _stream(self):
+        if self.stream is None:
+            self.stream = self.catalog.stream(self.property_class, self.criteria, self.order_by, self.descending)
+        return self.stream
+
+    def top(self, k):
+        if self.fetched is not None:
+            return super().top(k)
+        return self.catalog.top(self.property_class, self.criteria, self.order_by, k, self.descending)
+
+    def page(self, size):
+        if self.fetched is not None:
+            return super().page(size)
+        found = self._stream().take(size)
+        self.position += len(found)
+        return found
+
+    def facets(self):
+        if self.fetched is not None:
+            return super().facets()
+        return self._stream().counts
+
+    def exhausted(self):
+        if self.fetched is not None:
+            return super().exhausted()
+        return self.position >= len(self._stream())
+
+    def __len__(self):
+        if self.fetched is not None:
+            return super().__len__()
+        return len(self._stream())
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+class CursorStore:
+    '''
+    Keeps the result sets that are being paged through, under opaque cursors.
+    The least recently used result sets are dropped when there are too many of them.
+    A cursor is taken out of the store while its page is read, so a result set is paged by one thread at a time.
+    The result sets are kept by owner and cursor, so a cursor is resumed only by the user who got it.
+    '''
+
+    def __init__(self, size=1000):
+        '''
+        :size: The maximal number of result sets kept.
+        '''
+        self.size = size
+        self.result_sets = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def fetch(self, result_set, page_size, owner=None):
+        '''
+        Returns the next page of the result set and the cursor of the page after it,
+        or None if there are no more pages.
+        :owner: The username of the user paging through the result set.
+        '''
+        found = result_set.page(page_size)
+        if result_set.exhausted():
+            return found, None
+        cursor = secrets.token_urlsafe(12)
+        with self.mutex:
+            self.result_sets[(owner, cursor)] = result_set
+            if len(self.result_sets) > self.size:
+                self.result_sets.popitem(last=False)
+        return found, cursor
+
+    def resume(self, cursor, page_size, owner=None):
+        '''
+        Returns the page following the cursor and the cursor of the page after it.
+        Raises InvalidCursor if the cursor was not given to the owner, or was dropped.
+        '''
+        try:
+            with self.mutex:
+                result_set = self.result_sets.pop((owner, cursor))
+        except KeyError:
+            raise InvalidCursor(cursor)
+        return self.fetch(result_set, page_size, owner)
+
+
+cursors = CursorStore()
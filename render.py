@@ -0,0 +1,100 @@
+'''
+Module for rendering the details of the properties as text.
+Every listing is formatted once into a block of text that is cached until the listing changes,
+and the blocks are written a page at a time with a single write.
+'''
+import io
+import sys
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+import metrics
+
+# attributes that belong to the storage and do not change the details of a listing
+IGNORED_ATTRIBUTES = {'table_row'}
+
+_slot_names = {}
+
+
+def state(property):
+    '''
+    Returns a hashable key made of the class and the values of all the attributes of the property.
+    The key changes whenever the listing changes, so it is used to find its cached block.
+    '''
+    PropertyClass = type(property)
+    names = _slot_names.get(PropertyClass)
+    if names is None:
+        names = tuple(name for base in PropertyClass.__mro__ for name in getattr(base, '__slots__', ())
+                      if name not in IGNORED_ATTRIBUTES and name not in ('__dict__', '__weakref__'))
+        _slot_names[PropertyClass] = names
+    values = tuple(getattr(property, name, None) for name in names)
+    if hasattr(property, '__dict__'):
+        values += tuple(item for item in vars(property).items() if item[0] not in IGNORED_ATTRIBUTES)
+    return PropertyClass, values
+
+
+class BlockCache:
+    '''
+    Least recently used cache of the formatted listings.
+    The listings are formatted by display() into a buffer of their own, so several threads
+    format at the same time and sys.stdout is never redirected.
+    '''
+
+    def __init__(self, size=10000):
+        '''
+        :size: The maximal number of cached blocks.
+        '''
+        self.size = size
+        self.blocks = OrderedDict()
+        self.mutex = threading.Lock()
+
+    def get(self, property):
+        '''
+        Returns the text printed by property.display(), formatting it only if it is not cached.
+        '''
+        key = state(property)
+        with self.mutex:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                return block
+        buffer = io.StringIO()
+        property.display(file=buffer)
+        block = buffer.getvalue()
+        with self.mutex:
+            self.blocks[key] = block
+            if len(self.blocks) > self.size:
+                self.blocks.popitem(last=False)
+            return block
+
+
+cache = BlockCache()
+
+
+@metrics.timed('render')
+def write(properties, output=None, labels=None):
+    '''
+    Writes the details of the properties with a single write.
+    :output: A text file, sys.stdout by default.
+    :labels: A line written above every property, e.g. its ID.
+    '''
+    output = sys.stdout if output is None else output
+    if labels is None:
+        output.write(''.join(cache.get(property) for property in properties))
+    else:
+        output.write(''.join('{}\n{}'.format(label, cache.get(property))
+                             for label, property in zip(labels, properties)))
+    output.flush()
+
+
+def stream(properties, page_size=100, output=None):
+    '''
+    Writes the details of the properties page by page, holding one page of text at a time.
+    '''
+    properties = iter(properties)
+    while True:
+        page = list(islice(properties, page_size))
+        if not page:
+            return
+        write(page, output)
@@ -0,0 +1,343 @@
+'''
+Module with a JSON over HTTP server exposing the listings, the accounts and the permissions.
+Built on asyncio only; the requests run the commands of commands.CommandSession. The handlers run
+in executors, from the check of the session to the records of the listings, like the password hashing,
+so the event loop keeps serving the other clients while a database or the shards are read.
+
+Requests and responses are JSON. Except for /login, requests carry the token returned
+by /login in the header "Authorization: Bearer <token>". The listings returned carry their "id".
+    POST   /login                           {"username", "password"} -> {"token"}
+    POST   /logout
+    GET    /listings?start=0&stop=20        -> {"listings", "total"}
+    POST   /listings                        {"kind", "action", fields...} -> the listing
+    GET    /listings/<id>                   -> the listing
+    DELETE /listings/<id>
+    DELETE /listings                        {"kind", "action", fields...}
+    POST   /listings/search                 {"kind", "action", "criteria", "order_by", "descending",
+                                             "page_size"} or {"cursor"} -> {"listings", "cursor"}
+    POST   /users                           {"username", "password"}
+    DELETE /users/<username>
+    GET    /permissions                     -> {"permissions"}
+    POST   /permissions                     {"permission"}
+    GET    /users/<username>/permissions    -> {"permissions"}
+    POST   /users/<username>/permissions    {"permission"}
+    DELETE /users/<username>/permissions    {"permission"}
+Usage: python server.py [--host HOST] [--port PORT] [--admin USERNAME --password PASSWORD]
+                        [--metrics PATH [--prometheus PATH] [--metrics-interval SECONDS]]
+'''
+import argparse
+import asyncio
+import json
+import re
+import traceback
+from functools import partial
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import auth
+import commands
+import metrics
+from bulk_import import InvalidRecord
+from query import InvalidCursor
+
+MAX_BODY = 1024 * 1024
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+ERRORS = {
+    auth.InvalidSession: (401, 'invalid or expired session'),
+    auth.InvalidPassword: (401, 'wrong password'),
+    auth.PermissionDenied: (403, 'permission denied'),
+    auth.DoesNotExist: (404, 'does not exist'),
+    auth.AlreadyExists: (409, 'already exists'),
+    auth.PasswordTooShort: (400, 'password is too short'),
+    InvalidCursor: (400, 'invalid or expired cursor'),
+}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiServer:
+    '''
+    Serves the operations of Agent, Authenticator and Authorizer as a JSON API.
+    '''
+
+    def __init__(self, authorizer=None):
+        '''
+        :authorizer: The Authorizer checking the permissions, auth.authorizer by default.
+        Its authenticator keeps the users.
+        '''
+        self.authorizer = auth.authorizer if authorizer is None else authorizer
+        self.authenticator = self.authorizer.authenticator
+        self.routes = [
+            ('POST', r'/login', self.log_in),
+            ('POST', r'/logout', self.log_out),
+            ('GET', r'/listings', self.list_listings),
+            ('POST', r'/listings', self.add_listing),
+            ('DELETE', r'/listings', self.remove_listing),
+            ('GET', r'/listings/(\d+)', self.get_listing),
+            ('DELETE', r'/listings/(\d+)', self.remove_listing_by_id),
+            ('POST', r'/listings/search', self.search_listings),
+            ('POST', r'/users', self.add_user),
+            ('DELETE', r'/users/([^/]+)', self.delete_user),
+            ('GET', r'/permissions', self.all_permissions),
+            ('POST', r'/permissions', self.add_permission),
+            ('GET', r'/users/([^/]+)/permissions', self.user_permissions),
+            ('POST', r'/users/([^/]+)/permissions', self.give_permission),
+            ('DELETE', r'/users/([^/]+)/permissions', self.withdraw_permission),
+        ]
+        self.routes = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in self.routes]
+
+    async def run_in_executor(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args, **kwargs))
+
+    def session(self, request):
+        '''
+        Returns the CommandSession of the token of the request; nobody can create the first user without logging in.
+        '''
+        session = commands.CommandSession(self.authenticator, self.authorizer, bootstrap=False)
+        header = request['headers'].get('authorization', '')
+        if header.startswith('Bearer '):
+            session.token = header[len('Bearer '):]
+        return session
+
+    def authorized_user(self, request, perm_name):
+        '''
+        Returns the user of the request after checking that they have the permission.
+        '''
+        return self.session(request).check(perm_name)
+
+    async def run_command(self, request, name, **arguments):
+        '''
+        Runs the command in an executor, with the fields of the body of the request and the arguments,
+        and returns its result.
+        '''
+        body = request['body']
+        if body is None:
+            body = {}
+        elif not isinstance(body, dict):
+            raise HttpError(400, 'the body must be a JSON object')
+        command = dict(body, command=name, **arguments)
+        result, _ = await self.run_in_executor(self.session(request).run, command)
+        return result
+
+    @staticmethod
+    def field(body, name, kind=None):
+        '''
+        Returns the field of the body of the request.
+        :kind: The type of the field, e.g. str for the names and the passwords; None for any type.
+        '''
+        try:
+            value = body[name]
+        except (KeyError, TypeError):
+            raise HttpError(400, 'missing field "{}"'.format(name))
+        if kind is not None and not isinstance(value, kind):
+            raise HttpError(400, 'field "{}" must be a {}'.format(name, kind.__name__))
+        return value
+
+    async def log_in(self, request):
+        body = request['body']
+        token = await self.authenticator.log_in_async(self.field(body, 'username', str),
+                                                    self.field(body, 'password', str))
+        return {'token': token}
+
+    async def log_out(self, request):
+        await self.run_command(request, 'log_out')
+        return {}
+
+    async def list_listings(self, request):
+        return await self.run_in_executor(self.read_listings, request)
+
+    def read_listings(self, request):
+        '''
+        Returns a slice of the listings of the user; like the other handlers reading the catalog, it runs
+        in an executor, since the session, the catalog and the IDs may be read from a database or the shards.
+        '''
+        user = self.authorized_user(request, auth.VIEW_PROPERTIES)
+        query = request['query']
+        start = int(query.get('start', 0))
+        stop = int(query.get('stop', start + 20))
+        with user.lock.read():
+            listings = user.catalog.slice(start, stop)
+            total = len(user.catalog)
+        return {'listings': commands.CommandSession.records(user, listings), 'total': total}
+
+    async def add_listing(self, request):
+        return await self.run_command(request, 'add_property')
+
+    async def remove_listing(self, request):
+        await self.run_command(request, 'remove_property')
+        return {}
+
+    async def get_listing(self, request, listing_id):
+        return await self.run_in_executor(self.read_listing, request, int(listing_id))
+
+    def read_listing(self, request, listing_id):
+        user = self.authorized_user(request, auth.VIEW_PROPERTIES)
+        try:
+            listing = user.get(listing_id)
+        except KeyError:
+            raise auth.DoesNotExist
+        return commands.CommandSession.record(user, listing, listing_id)
+
+    async def remove_listing_by_id(self, request, listing_id):
+        await self.run_command(request, 'remove_property', id=int(listing_id))
+        return {}
+
+    async def search_listings(self, request):
+        return await self.run_in_executor(self.read_search, request)
+
+    def read_search(self, request):
+        user = self.authorized_user(request, auth.VIEW_PROPERTIES)
+        body = request['body'] or {}
+        if not isinstance(body, dict):
+            raise HttpError(400, 'the body must be a JSON object')
+        page_size = int(body.get('page_size', 20))
+        if 'cursor' in body:
+            listings, cursor = user.search_page(page_size=page_size, cursor=body['cursor'])
+        else:
+            criteria = body.get('criteria', {})
+            if not isinstance(criteria, dict):
+                raise HttpError(400, 'the criteria must be a JSON object')
+            listings, cursor = user.search_page(self.field(body, 'kind'), self.field(body, 'action'), page_size,
+                                                order_by=body.get('order_by'), descending=bool(body.get('descending')),
+                                                **criteria)
+        return {'listings': commands.CommandSession.records(user, listings), 'cursor': cursor}
+
+    async def add_user(self, request):
+        await self.run_command(request, 'add_user')
+        return {}
+
+    async def delete_user(self, request, username):
+        await self.run_command(request, 'delete_user', username=username)
+        return {}
+
+    async def all_permissions(self, request):
+        return {'permissions': await self.run_command(request, 'all_permissions')}
+
+    async def add_permission(self, request):
+        await self.run_command(request, 'add_permission')
+        return {}
+
+    async def user_permissions(self, request, username):
+        return {'permissions': await self.run_command(request, 'list_permissions', username=username)}
+
+    async def give_permission(self, request, username):
+        await self.run_command(request, 'give_permission', username=username)
+        return {}
+
+    async def withdraw_permission(self, request, username):
+        await self.run_command(request, 'withdraw_permission', username=username)
+        return {}
+
+    async def dispatch(self, method, target, headers, body):
+        '''
+        Runs the handler of the request and returns the status and the JSON payload of the response.
+        '''
+        url = urlsplit(target)
+        path = unquote(url.path.rstrip('/')) or '/'
+        request = {
+            'headers': headers,
+            'query': {name: values[-1] for name, values in parse_qs(url.query).items()},
+        }
+        try:
+            request['body'] = json.loads(body) if body else None
+            allowed = False
+            for route_method, pattern, handler in self.routes:
+                match = pattern.match(path)
+                if match is None:
+                    continue
+                allowed = True
+                if route_method == method:
+                    return 200, await handler(request, *match.groups())
+            if allowed:
+                raise HttpError(405, 'method not allowed')
+            raise HttpError(404, 'no such resource')
+        except HttpError as error:
+            return error.status, {'error': str(error)}
+        except tuple(ERRORS) as error:
+            status, message = next(value for kind, value in ERRORS.items() if isinstance(error, kind))
+            return status, {'error': message}
+        except (commands.CommandError, InvalidRecord, KeyError, ValueError, TypeError) as error:
+            return 400, {'error': str(error)}
+        except Exception:
+            # a bug of a handler fails its request, not the connection and the other requests
+            traceback.print_exc()
+            return 500, {'error': STATUS_TEXT[500].lower()}
+
+    async def handle(self, reader, writer):
+        '''
+        Serves the requests of one connection, keeping it open between requests.
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, payload = 413, {'error': 'request body is too large'}
+                    headers['connection'] = 'close'
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.dispatch(method, target, headers, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status, STATUS_TEXT[status], len(data),
+                                                             'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the property catalog as a JSON API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--admin', help='the administrator account created when there are no users')
+    parser.add_argument('--password', help='the password of the administrator account')
+    parser.add_argument('--metrics', help='the JSON file where the metrics are dumped')
+    parser.add_argument('--prometheus', help='the Prometheus text file also written with the JSON file')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='the seconds between two dumps')
+    args = parser.parse_args()
+    if args.admin and len(auth.authenticator.users) == 0:
+        auth.authenticator.add_user(args.admin, args.password or '')
+        auth.authorizer.assign_role('administrator', args.admin)
+    dumper = None
+    if args.metrics:
+        dumper = metrics.JsonDumper(args.metrics, args.metrics_interval, prometheus_path=args.prometheus)
+        dumper.start()
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        asyncio.run(ApiServer().serve(args.host, args.port))
+    finally:
+        if dumper is not None:
+            dumper.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+'''
+Module with a catalog split into shards held by worker processes.
+
+Every family of Agent.type_map (house or apartment, rental or purchase) gets its own shards, and
+the listings of a family are spread over its shards by the hash of their values. A search is sent
+to all the shards of its family at once, so they search in parallel, and their results are merged.
+Can be used in place of the default catalog: Agent(catalog=ShardedCatalog()).
+'''
+import heapq
+import multiprocessing
+import threading
+from collections import OrderedDict
+from itertools import chain, count, islice
+from operator import itemgetter
+
+import facets
+from catalog import Catalog
+from geo import distance
+from index import Found, Matches, PropertyIndex
+from main import Agent
+from query import SORT_KEYS
+from text import TextIndex
+from render import state
+
+# the number of searches a worker keeps for the Streams being read; the oldest ones are dropped
+MAX_STREAMS = 100
+
+
+def _text_index(catalog):
+    '''
+    Returns the text index of the catalog of a shard, or None if it has none.
+    '''
+    index = getattr(catalog, 'index', None)
+    return index.indexes['text'] if isinstance(index, PropertyIndex) else None
+
+
+def _scores(catalog, query, properties, statistics):
+    '''
+    Returns the BM25 scores of the properties in the text index of the catalog, with the statistics
+    of all the shards, or in an index of the properties themselves for the catalogs without one.
+    '''
+    text_index = _text_index(catalog)
+    if text_index is None:
+        text_index, statistics = TextIndex(), None
+        text_index.extend(properties)
+    return text_index.scores(query, properties, statistics)
+
+
+def _search(catalog, sequence, property_class, criteria, k=None, order_by=None, descending=False,
+            statistics=None):
+    '''
+    Returns the keys, the listings of the catalog of a shard matching the criteria and their IDs in the shard.
+    The keys order the listings of all the shards alike: by the sort key, by relevance for a text search,
+    and then by the sequence number given by the ShardedCatalog when they were added. With k, only the k first
+    listings are returned, sorted; otherwise all of them, in no particular order.
+    :statistics: The statistics of the text indexes of all the shards, see TextIndex.statistics().
+    '''
+    found = catalog.search(property_class, criteria)
+    listing_ids = getattr(found, 'listing_ids', None)
+    if listing_ids is None:
+        listing_ids = [catalog.id_of(property) for property in found]
+    added = [sequence[listing_id] for listing_id in listing_ids]
+    if order_by is not None:
+        attribute = SORT_KEYS[order_by]
+
+        def key(position):
+            value = getattr(found[position], attribute, None)
+            if value is None:
+                return True, 0, added[position]
+            return False, -value if descending else value, added[position]
+        keys = [key(position) for position in range(len(found))]
+    elif criteria.get('text'):
+        scores = _scores(catalog, criteria['text'], found, statistics)
+        keys = [(-scores[property], number) for property, number in zip(found, added)]
+    else:
+        keys = [(number,) for number in added]
+    if k is None:
+        return keys, list(found), listing_ids
+    positions = heapq.nsmallest(k, range(len(found)), key=keys.__getitem__)
+    return ([keys[position] for position in positions], [found[position] for position in positions],
+            [listing_ids[position] for position in positions])
+
+
+def _next(streams, number, size):
+    '''
+    Returns the next listings of a Stream from a shard: at most size triples (key, listing, ID in the shard),
+    in the order of the keys. The search is dropped when all its listings were returned.
+    '''
+    try:
+        heap, found, listing_ids = streams[number]
+    except KeyError:
+        raise KeyError('the search is no longer kept by the shard')
+    batch = [heapq.heappop(heap) for _ in range(min(size, len(heap)))]
+    if not heap:
+        del streams[number]
+    return [(key, found[position], listing_ids[position]) for key, position in batch]
+
+
+def _serve(connection, backend):
+    '''
+    The loop of a worker process: runs the calls received on the connection on its catalog
+    and sends back ("ok", result) or ("error", exception).
+    '''
+    catalog = backend()
+    # ID of the listing in the shard -> sequence number given by the ShardedCatalog
+    sequence = {}
+    # number of the Stream -> heap of (key, position) of the listings not read yet, the listings and their IDs
+    streams = OrderedDict()
+    while True:
+        try:
+            method, args = connection.recv()
+        except EOFError:
+            return
+        if method == 'close':
+            connection.close()
+            return
+        try:
+            if method == 'add':
+                property, number = args
+                catalog.add(property)
+                sequence[catalog.id_of(property)] = number
+                result = None
+            elif method == 'extend':
+                properties, numbers = args
+                catalog.extend(properties)
+                sequence.update((catalog.id_of(property), number) for property, number in zip(properties, numbers))
+                result = None
+            elif method == 'remove':
+                listing_id = catalog.id_of(args[0])
+                catalog.remove(catalog.get(listing_id))
+                sequence.pop(listing_id, None)
+                result = None
+            elif method == 'search':
+                result = _search(catalog, sequence, *args)
+            elif method == 'stream':
+                number, property_class, criteria, order_by, descending, statistics, size = args
+                keys, found, listing_ids = _search(catalog, sequence, property_class, criteria, None, order_by,
+                                                   descending, statistics)
+                heap = list(zip(keys, range(len(found))))
+                heapq.heapify(heap)
+                streams[number] = heap, found, listing_ids
+                if len(streams) > MAX_STREAMS:
+                    streams.popitem(last=False)
+                result = len(found), facets.count(found), _next(streams, number, size)
+            elif method == 'next':
+                result = _next(streams, *args)
+            elif method == 'slice':
+                found = catalog.slice(*args)
+                result = found, [catalog.id_of(property) for property in found]
+            elif method == 'text_statistics':
+                text_index = _text_index(catalog)
+                result = None if text_index is None else text_index.statistics(args[0])
+            elif method == 'len':
+                result = len(catalog)
+            else:
+                result = getattr(catalog, method)(*args)
+            connection.send(('ok', result))
+        except Exception as error:
+            connection.send(('error', error))
+
+
+class Shard:
+    '''
+    A worker process holding a part of the catalog.
+    '''
+
+    def __init__(self, context, backend, number):
+        '''
+        :number: The number of the shard in its catalog, part of the IDs of its listings.
+        '''
+        self.number = number
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, backend), daemon=True)
+        self.process.start()
+        child.close()
+        # a request and its reply must not be interleaved with those of another thread
+        self.mutex = threading.Lock()
+
+    def send(self, method, *args):
+        self.connection.send((method, args))
+
+    def receive(self):
+        status, result = self.connection.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def call(self, method, *args):
+        with self.mutex:
+            self.send(method, *args)
+            return self.receive()
+
+    def close(self):
+        with self.mutex:
+            try:
+                self.send('close')
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join()
+
+
+class Stream:
+    '''
+    The listings matching a search over all the shards of its family, read in order a batch at a time.
+    Every shard runs the search once and keeps its results in a heap; the batches of the shards are
+    merged as they are read, so reading the next page neither runs the search again nor fetches the
+    listings of the pages before it. The number of listings and their facet counts are sent with the first batches.
+    '''
+
+    def __init__(self, number, shards, opened, batch_size):
+        '''
+        :number: The number of the search in the workers.
+        :shards: The shards of the family.
+        :opened: The replies of the shards to the "stream" call: (number of listings, facet counts, first batch).
+        :batch_size: The number of listings read from a shard at once.
+        '''
+        self.number = number
+        self.batch_size = batch_size
+        self.length = sum(length for length, _, _ in opened)
+        self.counts = facets.merge([counts for _, counts, _ in opened])
+        self.merged = heapq.merge(*(self._read(shard, length, batch)
+                                    for shard, (length, _, batch) in zip(shards, opened)), key=itemgetter(0))
+
+    def _read(self, shard, length, batch):
+        '''
+        Yields the triples (key, listing, ID) of the shard, asking for the next batch when one is read.
+        '''
+        read = 0
+        while True:
+            for key, property, listing_id in batch:
+                yield key, property, listing_id * ShardedCatalog.MAX_SHARDS + shard.number
+            read += len(batch)
+            if read >= length or not batch:
+                return
+            batch = shard.call('next', self.number, self.batch_size)
+
+    def take(self, size):
+        '''
+        Returns the next listings, at most size of them, with their IDs.
+        '''
+        found = list(islice(self.merged, size))
+        return Found([property for _, property, _ in found], [listing_id for _, _, listing_id in found])
+
+    def __len__(self):
+        return self.length
+
+
+class ShardedCatalog:
+    '''
+    Catalog whose listings are held by worker processes, one or more per family of listings.
+    The listings cross the processes as pickles, so the catalog returns copies of the stored listings;
+    removing a copy removes the stored listing with the same values.
+    Every listing gets a sequence number when it is added, so that the results of the shards are merged
+    in the order the listings were added. Agent.search() sends the top-k of its ResultSet to top(),
+    so that every shard only sends its own k first listings, and reads its pages from a Stream.
+    The shards of a family registered in the type map after the catalog was created, e.g. by
+    kinds.ClassRegistry.register_kind(), are started when its first listing arrives.
+    '''
+
+    # the ID of a listing is its ID in its shard times this, plus the number of the shard
+    MAX_SHARDS = 1 << 12
+
+    def __init__(self, shards_per_family=1, type_map=None, backend=Catalog, start_method=None):
+        '''
+        :shards_per_family: The number of shards of every family; the listings are spread over them by hash.
+        :type_map: The classes of the listings, Agent.type_map by default.
+        :backend: The catalog class of the shards, e.g. table.PropertyTable.
+        :start_method: The way of starting the worker processes ("fork", "spawn" ...), see multiprocessing.
+        '''
+        self.type_map = Agent.type_map if type_map is None else type_map
+        self.context = multiprocessing.get_context(start_method)
+        self.backend = backend
+        self.shards_per_family = shards_per_family
+        # class of the listings -> its shards
+        self.shards = {}
+        # all the shards, numbered in the order they were started
+        self.numbered = []
+        self.mutex = threading.Lock()
+        self.sequence = count()
+        self.streams = count()
+        for PropertyClass in list(self.type_map.values()):
+            self._family(PropertyClass)
+
+    def _family(self, property_class):
+        '''
+        Returns the shards of the class, starting them if the class is new in the type map.
+        '''
+        shards = self.shards.get(property_class)
+        if shards is not None:
+            return shards
+        if property_class not in self.type_map.values():
+            raise TypeError('no shard holds a {}'.format(property_class.__name__))
+        with self.mutex:
+            if property_class not in self.shards:
+                if len(self.numbered) + self.shards_per_family > self.MAX_SHARDS:
+                    raise ValueError('too many shards')
+                shards = [Shard(self.context, self.backend, number)
+                          for number in range(len(self.numbered), len(self.numbered) + self.shards_per_family)]
+                self.numbered.extend(shards)
+                self.shards[property_class] = shards
+            return self.shards[property_class]
+
+    def _shard(self, property):
+        shards = self._family(type(property))
+        return shards[hash(state(property)[1]) % self.shards_per_family]
+
+    def _all_shards(self):
+        return list(self.numbered)
+
+    def _scatter(self, shards, method, *args):
+        '''
+        Sends the call to all the shards before waiting for any of them, and returns the list of their results.
+        '''
+        for shard in shards:
+            shard.mutex.acquire()
+        try:
+            for shard in shards:
+                shard.send(method, *args)
+            results, error = [], None
+            # all the replies are read, so that none of them is left for the next call
+            for shard in shards:
+                try:
+                    results.append(shard.receive())
+                except Exception as shard_error:
+                    error = shard_error
+            if error is not None:
+                raise error
+            return results
+        finally:
+            for shard in shards:
+                shard.mutex.release()
+
+    def add(self, property):
+        self._shard(property).call('add', property, next(self.sequence))
+
+    def extend(self, properties):
+        '''
+        Sends the listings to their shards in one batch per shard.
+        '''
+        batches = {}
+        for property in properties:
+            batch = batches.setdefault(self._shard(property), ([], []))
+            batch[0].append(property)
+            batch[1].append(next(self.sequence))
+        for shard, (batch, numbers) in batches.items():
+            shard.call('extend', batch, numbers)
+
+    def remove(self, property):
+        self._shard(property).call('remove', property)
+
+    def get(self, listing_id):
+        '''
+        Returns the listing with the ID. The ID of a listing is its ID in its shard times MAX_SHARDS,
+        plus the number of the shard, so it does not change when the shards of a new family are started.
+        '''
+        local, number = divmod(listing_id, self.MAX_SHARDS)
+        if number >= len(self.numbered):
+            raise KeyError(listing_id)
+        return self.numbered[number].call('get', local)
+
+    def id_of(self, property):
+        shard = self._shard(property)
+        return shard.call('id_of', property) * self.MAX_SHARDS + shard.number
+
+    def stored(self, listing_ids):
+        '''
+        Returns the set of the IDs whose listings are still stored, asking every shard once for its IDs.
+        '''
+        by_shard = {}
+        for listing_id in listing_ids:
+            local, number = divmod(listing_id, self.MAX_SHARDS)
+            if number < len(self.numbered):
+                by_shard.setdefault(number, []).append(local)
+        found = set()
+        for number, local_ids in by_shard.items():
+            shard = self.numbered[number]
+            found.update(self._listing_ids(shard, shard.call('stored', local_ids)))
+        return found
+
+    def _listing_ids(self, shard, listing_ids):
+        '''
+        Returns the IDs of the listings of the shard from their IDs in the shard, see get().
+        '''
+        return [listing_id * self.MAX_SHARDS + shard.number for listing_id in listing_ids]
+
+    def _statistics(self, shards, query):
+        '''
+        Returns the statistics of the text indexes of all the shards added up, so that the shards
+        score their listings alike; None if a shard has no text index.
+        '''
+        count, total_length, containing = 0, 0, {}
+        for statistics in self._scatter(shards, 'text_statistics', query):
+            if statistics is None:
+                return None
+            count += statistics[0]
+            total_length += statistics[1]
+            for term, texts in statistics[2].items():
+                containing[term] = containing.get(term, 0) + texts
+        return count, total_length, containing
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the listings of the given class matching all the criteria, from all its shards:
+        the Matches of all of them, or for a text search the list of them merged by relevance.
+        '''
+        shards = self._family(property_class)
+        if criteria.get('text'):
+            statistics = self._statistics(shards, criteria['text'])
+            found = self._scatter(shards, 'search', property_class, criteria, None, None, False, statistics)
+            ranked = sorted((item for shard, (keys, properties, listing_ids) in zip(shards, found)
+                             for item in zip(keys, properties, self._listing_ids(shard, listing_ids))),
+                            key=itemgetter(0))
+            return Found([property for _, property, _ in ranked], [listing_id for _, _, listing_id in ranked])
+        found = self._scatter(shards, 'search', property_class, criteria)
+        return Matches(list(chain.from_iterable(properties for _, properties, _ in found)),
+                       [number for keys, _, _ in found for (number,) in keys],
+                       [listing_id for shard, (_, _, listing_ids) in zip(shards, found)
+                        for listing_id in self._listing_ids(shard, listing_ids)])
+
+    def top(self, property_class, criteria, order_by, k, descending=False):
+        '''
+        Returns the k first matching listings ordered by the sort key, or with no sort key in the order
+        of search(). Every shard returns only its own k first listings, which are then merged.
+        '''
+        if order_by is not None and order_by not in SORT_KEYS:
+            raise KeyError(order_by)
+        shards = self._family(property_class)
+        statistics = self._statistics(shards, criteria['text']) if criteria.get('text') else None
+        found = self._scatter(shards, 'search', property_class, criteria, k, order_by, descending, statistics)
+        merged = list(islice(heapq.merge(*(zip(keys, properties, self._listing_ids(shard, listing_ids))
+                                           for shard, (keys, properties, listing_ids) in zip(shards, found)),
+                                         key=itemgetter(0)), k))
+        return Found([property for _, property, _ in merged], [listing_id for _, _, listing_id in merged])
+
+    def stream(self, property_class, criteria, order_by=None, descending=False, batch_size=100):
+        '''
+        Returns the Stream of the listings matching the criteria, in the order of top().
+        :batch_size: The number of listings sent by a shard at once.
+        '''
+        if order_by is not None and order_by not in SORT_KEYS:
+            raise KeyError(order_by)
+        shards = self._family(property_class)
+        statistics = self._statistics(shards, criteria['text']) if criteria.get('text') else None
+        number = next(self.streams)
+        opened = self._scatter(shards, 'stream', number, property_class, criteria, order_by, descending, statistics,
+                               batch_size)
+        return Stream(number, shards, opened, batch_size)
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the k matching listings nearest to the point. Every shard returns its own k nearest
+        listings, which are then merged.
+        '''
+        found = self._scatter(self._family(property_class), 'nearest', property_class, latitude, longitude, k,
+                              criteria)
+        return list(heapq.merge(*found, key=lambda property: distance(latitude, longitude, property.latitude,
+                                                                         property.longitude)))[:k]
+
+    def facets(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the listings of the class, summed over its shards.
+        '''
+        return facets.merge(self._scatter(self._family(property_class), 'facets', property_class))
+
+    def slice(self, start, stop):
+        '''
+        Returns the listings from position start up to position stop, counting the shards one after another.
+        '''
+        found, listing_ids = [], []
+        for shard, size in zip(self._all_shards(), self._scatter(self._all_shards(), 'len')):
+            if start < size and stop > 0:
+                properties, shard_ids = shard.call('slice', max(start, 0), stop)
+                found.extend(properties)
+                listing_ids.extend(self._listing_ids(shard, shard_ids))
+            start -= size
+            stop -= size
+        return Found(found, listing_ids)
+
+    def __iter__(self, page_size=10000):
+        for shard in self._all_shards():
+            start = 0
+            while True:
+                page, _ = shard.call('slice', start, start + page_size)
+                yield from page
+                if len(page) < page_size:
+                    break
+                start += page_size
+
+    def __len__(self):
+        return sum(self._scatter(self._all_shards(), 'len'))
+
+    def close(self):
+        '''
+        Stops the worker processes.
+        '''
+        for shard in self._all_shards():
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
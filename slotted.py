@@ -0,0 +1,68 @@
+'''
+Module with the compact variants of the concrete property classes.
+Their instances keep all the attributes in __slots__ and have no __dict__.
+'''
+from kinds import ClassRegistry
+from main import (Agent, Apartment, ApartmentPurchase, ApartmentRental, House, HousePurchase, HouseRental,
+                  Purchase, Rental)
+
+# Only one base of a class may have non-empty slots, so the slots of the Purchase and Rental
+# mixins are declared by the concrete classes.
+PURCHASE_SLOTS = ('_price', '_taxes')
+RENTAL_SLOTS = ('furnished', '_rent', '_utilities')
+
+
+class SlottedHouseRental(Rental, House):
+    '''
+    Implements the rental of a house without a per-instance dictionary.
+    '''
+
+    __slots__ = RENTAL_SLOTS
+
+    prompt_init = staticmethod(HouseRental.prompt_init)
+
+
+class SlottedApartmentRental(Rental, Apartment):
+    '''
+    Implements the rental of an apartment without a per-instance dictionary.
+    '''
+
+    __slots__ = RENTAL_SLOTS
+
+    prompt_init = staticmethod(ApartmentRental.prompt_init)
+
+
+class SlottedApartmentPurchase(Purchase, Apartment):
+    '''
+    Implements the purchase of an apartment without a per-instance dictionary.
+    '''
+
+    __slots__ = PURCHASE_SLOTS
+
+    prompt_init = staticmethod(ApartmentPurchase.prompt_init)
+
+
+class SlottedHousePurchase(Purchase, House):
+    '''
+    Implements the purchase of a house without a per-instance dictionary.
+    '''
+
+    __slots__ = PURCHASE_SLOTS
+
+    prompt_init = staticmethod(HousePurchase.prompt_init)
+
+
+class SlottedAgent(Agent):
+    '''
+    Agent that creates the compact variants of the properties.
+    '''
+
+    type_map = {
+        ("house", "rental"): SlottedHouseRental,
+        ("house", "purchase"): SlottedHousePurchase,
+        ("apartment", "rental"): SlottedApartmentRental,
+        ("apartment", "purchase"): SlottedApartmentPurchase
+    }
+
+
+classes = ClassRegistry(SlottedAgent)
@@ -0,0 +1,423 @@
+'''
+Module for saving a catalog of properties into a binary snapshot and opening it with mmap.
+
+Layout of a snapshot (little-endian, version 3):
+    header      magic, version, number of records, offsets of the sections
+    records     one fixed-size record per property: the kind code, the numeric fields as doubles
+                (NaN when missing) and the codes of the text fields (-1 when missing)
+    strings     for the kind and each text field, the list of its values; codes index these lists
+    indexes     for every field, the values sorted in ascending order and the record numbers in the same order
+    free texts  the offsets of the free texts of every record, then the texts in UTF-8: the description
+                and the address of record i lie between offsets 2i, 2i + 1 and 2i + 2
+Version 1 had no free texts and version 2 no location; their snapshots are written again with write_snapshot().
+
+Usage:
+    snapshot.write_snapshot('catalog.snap', agent.catalog)
+    agent = Agent(catalog=snapshot.SnapshotCatalog('catalog.snap'))
+'''
+import math
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import islice
+
+import geo
+import text
+from catalog import Catalog
+from facets import FACETS, merge
+from fields import Range, parse_range
+from index import PropertyIndex, in_order
+from main import Agent
+
+MAGIC = b'PROPSNAP'
+VERSION = 3
+NUMERIC_FIELDS = ('square_feet', 'beds', 'baths', 'price', 'taxes', 'rent', 'utilities', 'latitude', 'longitude')
+TEXT_FIELDS = ('balcony', 'laundry', 'garage', 'fenced', 'num_stories', 'furnished')
+CODED_FIELDS = ('kind',) + TEXT_FIELDS
+FREE_TEXT_FIELDS = ('description', 'address')
+
+HEADER = struct.Struct('<8sHHIQQQQ')
+RECORD = struct.Struct('<h{}d{}h'.format(len(NUMERIC_FIELDS), len(TEXT_FIELDS)))
+INFINITY = float('inf')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_snapshot(path, properties, type_map=None):
+    '''
+    Saves the properties into a snapshot file.
+    :path: The path of the snapshot file.
+    :properties: Any iterable of properties, e.g. the catalog of an agent.
+    :type_map: The classes of the properties, Agent.type_map by default.
+    '''
+    type_map = Agent.type_map if type_map is None else type_map
+    kinds = {PropertyClass: ' '.join(key) for key, PropertyClass in type_map.items()}
+    attributes = dict(PropertyIndex.numeric_attributes, latitude='latitude', longitude='longitude',
+                      **PropertyIndex.attributes)
+    strings = {name: [] for name in CODED_FIELDS}
+    string_codes = {name: {} for name in CODED_FIELDS}
+    numeric = {name: array('d') for name in NUMERIC_FIELDS}
+    coded = {name: array('h') for name in CODED_FIELDS}
+
+    def code(name, value):
+        if value is None:
+            return -1
+        value = str(value)
+        if value not in string_codes[name]:
+            string_codes[name][value] = len(strings[name])
+            strings[name].append(value)
+        return string_codes[name][value]
+
+    records = bytearray()
+    free_texts = bytearray()
+    free_text_offsets = array('Q', [0])
+    for property in properties:
+        for name in FREE_TEXT_FIELDS:
+            free_texts += (getattr(property, name, None) or '').encode('utf-8')
+            free_text_offsets.append(len(free_texts))
+        coded['kind'].append(code('kind', kinds[type(property)]))
+        for name in NUMERIC_FIELDS:
+            value = getattr(property, attributes[name], None)
+            numeric[name].append(float('nan') if value is None else value)
+        for name in TEXT_FIELDS:
+            coded[name].append(code(name, getattr(property, attributes[name], None)))
+        records += RECORD.pack(coded['kind'][-1], *[numeric[name][-1] for name in NUMERIC_FIELDS],
+                               *[coded[name][-1] for name in TEXT_FIELDS])
+    count = len(coded['kind'])
+
+    string_section = bytearray()
+    for name in CODED_FIELDS:
+        string_section += struct.pack('<I', len(strings[name]))
+        for value in strings[name]:
+            encoded = value.encode('utf-8')
+            string_section += struct.pack('<H', len(encoded)) + encoded
+
+    index_section = bytearray()
+    for name in NUMERIC_FIELDS + CODED_FIELDS:
+        if name in numeric:
+            # missing values are sorted last as infinity
+            values = array('d', (INFINITY if math.isnan(value) else value for value in numeric[name]))
+        else:
+            values = coded[name]
+        order = sorted(range(count), key=values.__getitem__)
+        index_section += array(values.typecode, (values[i] for i in order)).tobytes()
+        index_section += bytes(_align(len(index_section)) - len(index_section))
+        index_section += array('I', order).tobytes()
+        index_section += bytes(_align(len(index_section)) - len(index_section))
+
+    records_offset = HEADER.size
+    strings_offset = _align(records_offset + len(records))
+    index_offset = _align(strings_offset + len(string_section))
+    free_text_offset = _align(index_offset + len(index_section))
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, 0, count, records_offset, strings_offset, index_offset,
+                               free_text_offset))
+        file.write(records)
+        file.write(bytes(strings_offset - records_offset - len(records)))
+        file.write(string_section)
+        file.write(bytes(index_offset - strings_offset - len(string_section)))
+        file.write(index_section)
+        file.write(bytes(free_text_offset - index_offset - len(index_section)))
+        file.write(free_text_offsets.tobytes())
+        file.write(free_texts)
+
+
+class SnapshotCatalog:
+    '''
+    Read-only view of a snapshot file mapped into memory, usable as the catalog of an agent.
+    Records are decoded only when a property is returned. Properties added after opening
+    are kept in memory, and removed records are only hidden.
+    '''
+
+    def __init__(self, path, type_map=None):
+        '''
+        :path: The path of a snapshot written by write_snapshot().
+        :type_map: The classes of the properties, Agent.type_map by default. It is read when the records
+        are decoded, so the classes registered in it after opening, e.g. by kinds.ClassRegistry, are found.
+        '''
+        self.type_map = Agent.type_map if type_map is None else type_map
+        with open(path, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        magic, version = struct.unpack_from('<8sH', self.buffer)
+        if magic != MAGIC:
+            raise SnapshotError('Not a property snapshot: {}'.format(path))
+        if version != VERSION:
+            raise SnapshotError('Unsupported snapshot version {}, write it again with write_snapshot(): {}'
+                                .format(version, path))
+        _, _, _, self.count, self.records_offset, strings_offset, index_offset, free_text_offset = \
+            HEADER.unpack_from(self.buffer)
+        self.strings = self._read_strings(strings_offset)
+        # code of the kind -> class, filled in as the records are decoded
+        self.classes = [None] * len(self.strings['kind'])
+        self.indexes = self._read_indexes(index_offset)
+        self.free_text_offsets = self.buffer[free_text_offset:free_text_offset + (2 * self.count + 1) * 8].cast('Q')
+        self.free_texts_offset = free_text_offset + (2 * self.count + 1) * 8
+        self.removed = set()
+        self.added = Catalog()
+
+    def _read_strings(self, offset):
+        strings = {}
+        for name in CODED_FIELDS:
+            (number,) = struct.unpack_from('<I', self.buffer, offset)
+            offset += 4
+            values = []
+            for _ in range(number):
+                (length,) = struct.unpack_from('<H', self.buffer, offset)
+                values.append(bytes(self.buffer[offset + 2:offset + 2 + length]).decode('utf-8'))
+                offset += 2 + length
+            strings[name] = values
+        return strings
+
+    def _read_indexes(self, offset):
+        indexes = {}
+        for name in NUMERIC_FIELDS + CODED_FIELDS:
+            typecode = 'd' if name in NUMERIC_FIELDS else 'h'
+            size = self.count * struct.calcsize(typecode)
+            values = self.buffer[offset:offset + size].cast(typecode)
+            offset = _align(offset + size)
+            order = self.buffer[offset:offset + self.count * 4].cast('I')
+            offset = _align(offset + self.count * 4)
+            indexes[name] = (values, order)
+        return indexes
+
+    def close(self):
+        '''
+        Releases the mapping of the file.
+        '''
+        for values, order in self.indexes.values():
+            values.release()
+            order.release()
+        self.free_text_offsets.release()
+        self.buffer.release()
+        self.mmap.close()
+
+    def _class(self, code):
+        '''
+        Returns the class of the kind code of a record.
+        '''
+        PropertyClass = self.classes[code]
+        if PropertyClass is None:
+            kind = self.strings['kind'][code]
+            try:
+                PropertyClass = self.classes[code] = self.type_map[tuple(kind.split(' '))]
+            except KeyError:
+                raise SnapshotError('Unknown kind of property: {}'.format(kind))
+        return PropertyClass
+
+    def _kind(self, property_class):
+        '''
+        Returns the kind of the records of the class, e.g. "house rental", or None if it is not in the type map.
+        '''
+        for key, PropertyClass in list(self.type_map.items()):
+            if PropertyClass is property_class:
+                return ' '.join(key)
+        return None
+
+    def _field(self, record, name):
+        '''
+        Reads a single field of the record without decoding the rest of it.
+        '''
+        offset = self.records_offset + record * RECORD.size
+        if name == 'kind':
+            return struct.unpack_from('<h', self.buffer, offset)[0]
+        if name in NUMERIC_FIELDS:
+            return struct.unpack_from('<d', self.buffer, offset + 2 + 8 * NUMERIC_FIELDS.index(name))[0]
+        return struct.unpack_from('<h', self.buffer, offset + 2 + 8 * len(NUMERIC_FIELDS) +
+                                  2 * TEXT_FIELDS.index(name))[0]
+
+    def _build(self, record):
+        '''
+        Decodes the record into a property.
+        '''
+        values = RECORD.unpack_from(self.buffer, self.records_offset + record * RECORD.size)
+        init_args = {}
+        for name, value in zip(NUMERIC_FIELDS, values[1:]):
+            if not math.isnan(value):
+                init_args[name] = int(value) if value.is_integer() else value
+        for name, code in zip(TEXT_FIELDS, values[1 + len(NUMERIC_FIELDS):]):
+            if code >= 0:
+                init_args[name] = self.strings[name][code]
+        for position, name in enumerate(FREE_TEXT_FIELDS, 2 * record):
+            start, stop = self.free_text_offsets[position], self.free_text_offsets[position + 1]
+            if stop > start:
+                init_args[name] = bytes(self.buffer[self.free_texts_offset + start:self.free_texts_offset + stop]) \
+                    .decode('utf-8')
+        property = self._class(values[0])(**init_args)
+        try:
+            property.table_row = record
+        except AttributeError:
+            pass
+        return property
+
+    def _bounds(self, name, value):
+        '''
+        Returns the slice (start, stop) of the sorted index of the field holding the value.
+        '''
+        values, _ = self.indexes[name]
+        if name in NUMERIC_FIELDS:
+            value_range = parse_range(value)
+            start = 0 if value_range.low is None else (
+                bisect_left(values, value_range.low) if value_range.low_inclusive
+                else bisect_right(values, value_range.low))
+            stop = bisect_left(values, INFINITY) if value_range.high is None else (
+                bisect_right(values, value_range.high) if value_range.high_inclusive
+                else bisect_left(values, value_range.high))
+        else:
+            try:
+                code = self.strings[name].index(str(value))
+            except ValueError:
+                return 0, 0
+            start, stop = bisect_left(values, code), bisect_right(values, code)
+        return start, max(start, stop)
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the list of properties of the given class matching all the criteria,
+        ranked by relevance when searching the text.
+        :property_class: One of the classes of the type map.
+        :criteria: A dictionary of search parameters and their values.
+        '''
+        if criteria.get('text'):
+            # the records matching the other criteria and the properties added after opening are ranked together
+            others = {name: value for name, value in criteria.items() if name != 'text'}
+            return text.search(self.search(property_class, others), criteria['text'])
+        wanted = [('kind', self._kind(property_class))]
+        for name, value in criteria.items():
+            if name == 'location' and value:
+                # the records in the latitudes of the area, of which those in the area are kept below
+                box = geo.parse_area(value).box()
+                wanted.append(('latitude', Range(box.south, box.north)))
+            if name in ('text', 'location'):
+                continue
+            if name not in NUMERIC_FIELDS and name not in TEXT_FIELDS:
+                raise KeyError(name)
+            wanted.append((name, value))
+        bounds = [(self._bounds(name, value), name, value) for name, value in wanted]
+        bounds.sort(key=lambda item: item[0][1] - item[0][0])
+        (start, stop), name, _ = bounds[0]
+        records = set(self.indexes[name][1][start:stop])
+        for (start, stop), name, value in bounds[1:]:
+            if not records:
+                break
+            if name in NUMERIC_FIELDS:
+                value_range = parse_range(value)
+                records = {record for record in records if self._field(record, name) in value_range}
+            else:
+                code = self.strings[name].index(str(value)) if start < stop else None
+                records = {record for record in records if self._field(record, name) == code}
+        found = [self._build(record) for record in sorted(records - self.removed)]
+        if criteria.get('location'):
+            found = geo.within(found, criteria['location'])
+        return found + in_order(self.added.search(property_class, criteria))
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the list of the k properties of the given class matching all the criteria
+        nearest to the point, the nearest first. Only the records with a location are decoded.
+        '''
+        if not criteria.get('location'):
+            criteria = dict(criteria, location=geo.Box(-90.0, -180.0, 90.0, 180.0))
+        return geo.nearest(self.search(property_class, criteria), latitude, longitude, k)
+
+    def facets(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the properties of the class, see facets.py.
+        Only the fields of the facets are read from the records of the class.
+        '''
+        (start, stop) = self._bounds('kind', self._kind(property_class))
+        records = [record for record in self.indexes['kind'][1][start:stop] if record not in self.removed]
+        found = {}
+        for facet in FACETS:
+            counts = found[facet] = Counter()
+            if facet in NUMERIC_FIELDS:
+                for record in records:
+                    value = self._field(record, facet)
+                    if not math.isnan(value):
+                        counts[int(value) if value.is_integer() else value] += 1
+            else:
+                for record in records:
+                    code = self._field(record, facet)
+                    if code >= 0:
+                        counts[self.strings[facet][code]] += 1
+        return merge([found, self.added.facets(property_class)])
+
+    def add(self, property):
+        '''
+        Keeps the new property in memory; the snapshot file is not changed.
+        '''
+        self.added.add(property)
+
+    def extend(self, properties):
+        '''
+        Keeps the new properties in memory; the snapshot file is not changed.
+        '''
+        self.added.extend(properties)
+
+    def remove(self, property):
+        '''
+        Hides the record of the property, or removes it if it was added after opening.
+        '''
+        record = getattr(property, 'table_row', None)
+        if record is not None and record < self.count and record not in self.removed \
+                and type(property) is self._class(self._field(record, 'kind')):
+            self.removed.add(record)
+            return
+        if property in self.added.positions:
+            self.added.remove(property)
+            return
+        raise ValueError('The property is not in the catalog')
+
+    def get(self, listing_id):
+        '''
+        Returns the listing with the ID: the number of its record, or for the properties added
+        after opening, the number of records plus their ID in memory. Raises KeyError if there is none.
+        '''
+        if listing_id < self.count:
+            if listing_id < 0 or listing_id in self.removed:
+                raise KeyError(listing_id)
+            return self._build(listing_id)
+        return self.added.get(listing_id - self.count)
+
+    def id_of(self, property):
+        record = getattr(property, 'table_row', None)
+        if record is not None and record < self.count and record not in self.removed:
+            return record
+        return self.count + self.added.id_of(property)
+
+    def stored(self, listing_ids):
+        '''
+        Returns the set of the IDs whose listings are not removed.
+        '''
+        listing_ids = list(listing_ids)
+        found = {listing_id for listing_id in listing_ids
+                 if 0 <= listing_id < self.count and listing_id not in self.removed}
+        added = self.added.stored(listing_id - self.count for listing_id in listing_ids if listing_id >= self.count)
+        return found | {listing_id + self.count for listing_id in added}
+
+    def slice(self, start, stop):
+        '''
+        Returns the list of the properties from position start up to position stop.
+        Only the records in the slice are decoded.
+        '''
+        records = islice((record for record in range(self.count) if record not in self.removed), start, stop)
+        found = [self._build(record) for record in records]
+        kept = self.count - len(self.removed)
+        return found + self.added.slice(max(start - kept, 0), max(stop - kept, 0))
+
+    def __iter__(self):
+        for record in range(self.count):
+            if record not in self.removed:
+                yield self._build(record)
+        yield from self.added
+
+    def __len__(self):
+        return self.count - len(self.removed) + len(self.added)
@@ -0,0 +1,496 @@
+'''
+Module with the SQLite storages of the properties and of the users.
+Usage:
+    connection = storage.connect('property.db')
+    agent = Agent(catalog=storage.SQLiteCatalog(connection))
+    authenticator = auth.Authenticator(users=storage.SQLiteUserStore(connection))
+The listings of all the users are kept in one SharedCatalog over an SQLiteCatalog, which also stores
+their owners and their visibility, so that they are found again when the database is opened.
+'''
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+import auth
+import geo
+import text
+from catalog import SharedCatalog
+from facets import FACETS, sort_counts
+from fields import parse_range
+from index import PropertyIndex
+from main import Agent
+
+NUMERIC_COLUMNS = PropertyIndex.numeric_attributes
+TEXT_COLUMNS = PropertyIndex.attributes
+# the free texts searched with the "text" parameter; they are not indexed by the database
+FREE_TEXT_COLUMNS = ('description', 'address')
+# the location searched with the "location" parameter and nearest(); latitude is indexed for the bounding boxes
+LOCATION_COLUMNS = ('latitude', 'longitude')
+# the version of the schema, kept in PRAGMA user_version; see migrate()
+SCHEMA_VERSION = 1
+
+
+class Connection(sqlite3.Connection):
+    '''
+    Connection usable from several threads: the catalog and the users take its mutex
+    around every use, so that the statements of two threads are never interleaved.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mutex = threading.RLock()
+
+
+def connect(path):
+    '''
+    Opens the database, creates the tables and the indexes if they do not exist,
+    and brings the databases of the older versions up to date, see migrate().
+    The connection may be used by any thread, see Connection.
+    :path: The path of the database file, or ":memory:".
+    '''
+    connection = sqlite3.connect(path, check_same_thread=False, factory=Connection)
+    columns = ['{} NUMERIC'.format(name) for name in list(NUMERIC_COLUMNS) + list(LOCATION_COLUMNS)]
+    columns += ['{} TEXT'.format(name) for name in list(TEXT_COLUMNS) + list(FREE_TEXT_COLUMNS)]
+    # "private" for the listings seen only by their owners, see catalog.SharedCatalog
+    columns.append('visibility TEXT')
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS properties ('
+            'id INTEGER PRIMARY KEY, kind TEXT NOT NULL, action TEXT NOT NULL, {})'.format(', '.join(columns)))
+        # the databases created before a column was added get it
+        existing = {row[1] for row in connection.execute('PRAGMA table_info(properties)')}
+        for column in columns:
+            if column.split()[0] not in existing:
+                connection.execute('ALTER TABLE properties ADD COLUMN {}'.format(column))
+        connection.execute('CREATE TABLE IF NOT EXISTS listing_owners ('
+                           'id INTEGER NOT NULL, username TEXT NOT NULL, PRIMARY KEY (id, username))')
+        connection.execute('CREATE INDEX IF NOT EXISTS listing_owners_username ON listing_owners (username)')
+        if connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            migrate(connection, existing)
+        connection.execute('CREATE INDEX IF NOT EXISTS properties_kind ON properties (kind, action)')
+        for name in list(NUMERIC_COLUMNS) + list(TEXT_COLUMNS) + ['latitude']:
+            connection.execute('CREATE INDEX IF NOT EXISTS properties_{0} ON properties (kind, action, {0})'
+                               .format(name))
+        connection.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL)')
+        # the names of the permissions given to the users and of their roles, as JSON lists
+        existing = {row[1] for row in connection.execute('PRAGMA table_info(users)')}
+        for column in ('permissions', 'roles'):
+            if column not in existing:
+                connection.execute("ALTER TABLE users ADD COLUMN {} TEXT NOT NULL DEFAULT '[]'".format(column))
+        # the permissions in the order of their bits, and the roles with the names of their permissions
+        # and of their parents as JSON lists, see auth.Authorizer.restore_definitions()
+        connection.execute('CREATE TABLE IF NOT EXISTS permissions (name TEXT PRIMARY KEY)')
+        connection.execute('CREATE TABLE IF NOT EXISTS roles ('
+                           'name TEXT PRIMARY KEY, permissions TEXT NOT NULL, parents TEXT NOT NULL)')
+    return connection
+
+
+def migrate(connection, columns):
+    '''
+    Brings the tables of a database of an older version to SCHEMA_VERSION, within the transaction of connect().
+    Version 1: the listings imported with an owner, in the owner column of the properties before the owners
+    had their table, get their row in listing_owners, and the owner column and its indexes are dropped.
+    :columns: The names of the columns of the properties when the database was opened.
+    '''
+    if 'owner' in columns:
+        connection.execute('INSERT OR IGNORE INTO listing_owners (id, username) '
+                           'SELECT id, owner FROM properties WHERE owner IS NOT NULL')
+        # the indexes started with the owner; connect() creates them again without it
+        for name in ['kind'] + list(NUMERIC_COLUMNS) + list(TEXT_COLUMNS) + ['latitude']:
+            connection.execute('DROP INDEX IF EXISTS properties_{}'.format(name))
+        connection.execute('ALTER TABLE properties DROP COLUMN owner')
+    connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+
+class SQLiteCatalog:
+    '''
+    Catalog that keeps the properties in an SQLite table.
+    Searches are translated into WHERE clauses served by the indexes of the table,
+    and properties are only created for the rows that are read.
+    The owners and the visibility of the listings are kept for a SharedCatalog, see ownerships().
+    '''
+
+    def __init__(self, connection, type_map=None):
+        '''
+        :connection: A connection returned by connect().
+        :type_map: The classes of the properties, Agent.type_map by default.
+        '''
+        self.connection = connection
+        self.mutex = connection.mutex
+        self.type_map = Agent.type_map if type_map is None else type_map
+        self.keys = {}
+        self.columns = list(NUMERIC_COLUMNS) + list(TEXT_COLUMNS) + list(FREE_TEXT_COLUMNS) + list(LOCATION_COLUMNS)
+        self.attributes = [NUMERIC_COLUMNS.get(name) or TEXT_COLUMNS.get(name) or name for name in self.columns]
+
+    def _key(self, PropertyClass):
+        '''
+        Returns the (kind, action) of the class; the type map is read again for the classes registered in it lately.
+        '''
+        key = self.keys.get(PropertyClass)
+        if key is None:
+            self.keys = {PropertyClass: key for key, PropertyClass in list(self.type_map.items())}
+            key = self.keys[PropertyClass]
+        return key
+
+    def _values(self, property):
+        '''
+        Returns the values of the columns of the property; missing free texts are NULL.
+        '''
+        return [getattr(property, attribute, None) or None if name in FREE_TEXT_COLUMNS
+                else getattr(property, attribute, None) for name, attribute in zip(self.columns, self.attributes)]
+
+    def add(self, property):
+        '''
+        Inserts the property into the table.
+        '''
+        kind, action = self._key(type(property))
+        values = self._values(property)
+        with self.mutex, self.connection:
+            self._insert(property, kind, action, values)
+
+    def _insert(self, property, kind, action, values):
+        '''
+        Inserts the row of the property and gives the property its ID; the caller holds the mutex.
+        '''
+        cursor = self.connection.execute(
+            'INSERT INTO properties (kind, action, {}) VALUES (?, ?, {})'.format(
+                ', '.join(self.columns), ', '.join('?' * len(self.columns))), [kind, action] + values)
+        try:
+            property.table_row = cursor.lastrowid
+        except AttributeError:
+            pass
+
+    def extend(self, properties):
+        '''
+        Inserts all the properties in a single transaction; like add(), it gives them the ID of their row.
+        '''
+        rows = [(property, self._key(type(property)), self._values(property)) for property in properties]
+        with self.mutex, self.connection:
+            for property, (kind, action), values in rows:
+                self._insert(property, kind, action, values)
+
+    def remove(self, property):
+        '''
+        Deletes the row of the property and its owners.
+        '''
+        listing_id = self.id_of(property)
+        with self.mutex, self.connection:
+            cursor = self.connection.execute('DELETE FROM properties WHERE id = ?', (listing_id,))
+            self.connection.execute('DELETE FROM listing_owners WHERE id = ?', (listing_id,))
+        if not cursor.rowcount:
+            raise ValueError('The property is not in the catalog')
+
+    def ownerships(self):
+        '''
+        Returns the owners of the listings, {listing ID: [usernames]}, and the set of the IDs of the private listings.
+        '''
+        owners = {}
+        with self.mutex:
+            for listing_id, username in self.connection.execute(
+                    'SELECT id, username FROM listing_owners ORDER BY rowid'):
+                owners.setdefault(listing_id, []).append(username)
+            private = {row[0] for row in self.connection.execute(
+                "SELECT id FROM properties WHERE visibility = 'private'")}
+        return owners, private
+
+    def save_ownerships(self, ownerships):
+        '''
+        Replaces the owners and the visibility of the listings in a single transaction.
+        :ownerships: An iterable of triples (listing ID, usernames of the owners, "public" or "private").
+        '''
+        with self.mutex, self.connection:
+            for listing_id, owners, visibility in ownerships:
+                self.connection.execute('DELETE FROM listing_owners WHERE id = ?', (listing_id,))
+                self.connection.executemany('INSERT INTO listing_owners (id, username) VALUES (?, ?)',
+                                            [(listing_id, username) for username in owners])
+                self.connection.execute('UPDATE properties SET visibility = ? WHERE id = ?',
+                                        (None if visibility == 'public' else visibility, listing_id))
+
+    def get(self, listing_id):
+        '''
+        Returns the listing with the ID, which is the id of its row; raises KeyError if there is none.
+        '''
+        found = self._select(['id = ?'], [listing_id])
+        if not found:
+            raise KeyError(listing_id)
+        return found[0]
+
+    def id_of(self, property):
+        '''
+        Returns the ID of the listing, the id of its row.
+        The row named by the table_row of the property is used only if it holds the property, since the property
+        may come from another catalog, or from a row that was deleted.
+        '''
+        kind, action = self._key(type(property))
+        conditions = ['kind = ?', 'action = ?']
+        # the rows written by other programs may hold NULL where the properties have an empty text
+        conditions += ["IFNULL({}, '') IS IFNULL(?, '')".format(name) if name in TEXT_COLUMNS
+                       else '{} IS ?'.format(name) for name in self.columns]
+        values = [kind, action] + self._values(property)
+        row = getattr(property, 'table_row', None)
+        with self.mutex:
+            if row is not None and self.connection.execute(
+                    'SELECT 1 FROM properties WHERE id = ? AND {}'.format(' AND '.join(conditions)),
+                    [row] + values).fetchone():
+                return row
+            found = self.connection.execute(
+                'SELECT id FROM properties WHERE {} ORDER BY id LIMIT 1'.format(' AND '.join(conditions)),
+                values).fetchone()
+        if found is None:
+            raise ValueError('The property is not in the catalog')
+        return found[0]
+
+    def stored(self, listing_ids, chunk_size=500):
+        '''
+        Returns the set of the IDs whose rows are not deleted.
+        :chunk_size: The number of IDs looked up by one statement, below the limit of the parameters of SQLite.
+        '''
+        listing_ids, found = list(listing_ids), set()
+        with self.mutex:
+            for start in range(0, len(listing_ids), chunk_size):
+                chunk = listing_ids[start:start + chunk_size]
+                found.update(row[0] for row in self.connection.execute(
+                    'SELECT id FROM properties WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk))
+        return found
+
+    def _build(self, row):
+        '''
+        Creates the property from a row (id, kind, action, columns...).
+        '''
+        init_args = {name: value for name, value in zip(self.columns, row[3:]) if value is not None}
+        property = self.type_map[(row[1], row[2])](**init_args)
+        try:
+            property.table_row = row[0]
+        except AttributeError:
+            pass
+        return property
+
+    def _rows(self, conditions, values, limit=-1, offset=0):
+        '''
+        Returns the list of the rows satisfying all the conditions, in the order they were added.
+        The rows are all fetched before the mutex is released.
+        '''
+        with self.mutex:
+            return self.connection.execute(
+                'SELECT id, kind, action, {} FROM properties {} ORDER BY id LIMIT ? OFFSET ?'.format(
+                    ', '.join(self.columns), 'WHERE ' + ' AND '.join(conditions) if conditions else ''),
+                values + [limit, offset]).fetchall()
+
+    def _select(self, conditions, values, limit=-1, offset=0):
+        '''
+        Returns the list of the properties of the rows satisfying all the conditions, in the order they were added.
+        '''
+        return [self._build(row) for row in self._rows(conditions, values, limit, offset)]
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the list of properties of the given class matching all the criteria,
+        ranked by relevance when searching the text.
+        :property_class: One of the classes of the type map.
+        :criteria: A dictionary of search parameters and their values.
+        '''
+        kind, action = self._key(property_class)
+        conditions = ['kind = ?', 'action = ?']
+        values = [kind, action]
+        for name, value in criteria.items():
+            if name in NUMERIC_COLUMNS:
+                value_range = parse_range(value)
+                conditions.append('{} IS NOT NULL'.format(name))
+                if value_range.low is not None:
+                    conditions.append('{} {} ?'.format(name, '>=' if value_range.low_inclusive else '>'))
+                    values.append(value_range.low)
+                if value_range.high is not None:
+                    conditions.append('{} {} ?'.format(name, '<=' if value_range.high_inclusive else '<'))
+                    values.append(value_range.high)
+            elif name in TEXT_COLUMNS:
+                conditions.append('{} = ?'.format(name))
+                values.append(value)
+            elif name == 'text':
+                if value:
+                    self._like(value, conditions, values)
+            elif name == 'location':
+                if value:
+                    self._box(geo.parse_area(value).box(), conditions, values)
+            else:
+                raise KeyError(name)
+        found = self._select(conditions, values)
+        if criteria.get('location'):
+            # the conditions hold the bounding box of the area
+            found = geo.within(found, criteria['location'])
+        if criteria.get('text'):
+            return text.search(found, criteria['text'])
+        return found
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the list of the k properties of the given class matching all the criteria
+        nearest to the point, the nearest first. The distances are computed over the rows with a location.
+        '''
+        if not criteria.get('location'):
+            # only the rows with a location are read
+            criteria = dict(criteria, location=geo.Box(-90.0, -180.0, 90.0, 180.0))
+        return geo.nearest(self.search(property_class, criteria), latitude, longitude, k)
+
+    @staticmethod
+    def _box(box, conditions, values):
+        '''
+        Adds the conditions selecting the rows located in the geo.Box.
+        '''
+        conditions.append('latitude BETWEEN ? AND ?')
+        values.extend([box.south, box.north])
+        # a box crossing the 180th meridian holds the longitudes on both sides of it
+        conditions.append('longitude BETWEEN ? AND ?' if box.west <= box.east
+                          else '(longitude >= ? OR longitude <= ?)')
+        values.extend([box.west, box.east])
+
+    @staticmethod
+    def _like(query, conditions, values):
+        '''
+        Adds the conditions selecting the rows whose free texts contain every word of the text query.
+        They only narrow down the rows ranked by text.search(): LIKE ignores the case of ASCII letters only,
+        so the words with other characters are left to it.
+        '''
+        phrases, words, prefixes = text.parse_query(query)
+        for word in dict.fromkeys(words + prefixes + [word for phrase in phrases for word in phrase]):
+            if not word.isascii():
+                continue
+            # the words are made of letters, digits and underscores, of which only the underscore is special
+            pattern = '%{}%'.format(word.replace('_', '\\_'))
+            conditions.append('({})'.format(' OR '.join("{} LIKE ? ESCAPE '\\'".format(name)
+                                                       for name in FREE_TEXT_COLUMNS)))
+            values.extend([pattern] * len(FREE_TEXT_COLUMNS))
+
+    def facets(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the properties of the class, see facets.py.
+        The values are counted by the database, one GROUP BY per facet served by the index of its column.
+        '''
+        kind, action = self._key(property_class)
+        found = {}
+        with self.mutex:
+            for facet in FACETS:
+                rows = self.connection.execute(
+                    'SELECT {0}, COUNT(*) FROM properties WHERE kind = ? AND action = ? '
+                    'AND {0} IS NOT NULL GROUP BY {0}'.format(facet), (kind, action)).fetchall()
+                counts = sort_counts(dict(rows))
+                if counts:
+                    found[facet] = counts
+        return found
+
+    def slice(self, start, stop):
+        '''
+        Returns the list of the properties from position start up to position stop.
+        '''
+        return self._select([], [], max(stop - start, 0), start)
+
+    def __iter__(self, page_size=1000):
+        # read a page at a time, so that the mutex is not held while the caller works
+        last = None
+        while True:
+            rows = self._rows([] if last is None else ['id > ?'], [] if last is None else [last], page_size)
+            for row in rows:
+                yield self._build(row)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def __len__(self):
+        with self.mutex:
+            return self.connection.execute('SELECT COUNT(*) FROM properties').fetchone()[0]
+
+
+class SQLiteUserStore(MutableMapping):
+    '''
+    Storage of the users in an SQLite table, used in place of auth.UserStore.
+    Users are loaded when they are first accessed, and each of them gets a view of the shared catalog.
+    The permissions and the roles of the users are stored by name, since the bits of the permissions
+    are given by the Authorizer when they are added, and may differ from one run to the next.
+    The permissions and the roles themselves are stored too, and added to the Authorizer when the store is created.
+    '''
+
+    def __init__(self, connection, catalog=None, authorizer=None):
+        '''
+        :connection: A connection returned by connect().
+        :catalog: The SharedCatalog of the listings of all the users. One over an SQLiteCatalog by default.
+        :authorizer: The Authorizer giving the bits of the permissions and the roles. auth.authorizer by default.
+        '''
+        self.connection = connection
+        self.mutex = connection.mutex
+        self.catalog = SharedCatalog(SQLiteCatalog(connection)) if catalog is None else catalog
+        self.authorizer = auth.authorizer if authorizer is None else authorizer
+        self.loaded = {}
+        self.authorizer.restore_definitions(self)
+
+    def load_definitions(self):
+        '''
+        Returns the names of the saved permissions, and the saved roles: {name: (permissions, parents)}.
+        '''
+        with self.mutex:
+            perm_names = [row[0] for row in self.connection.execute('SELECT name FROM permissions ORDER BY rowid')]
+            rows = self.connection.execute('SELECT name, permissions, parents FROM roles').fetchall()
+        return perm_names, {name: (json.loads(role_perms), json.loads(parents)) for name, role_perms, parents in rows}
+
+    def save_definitions(self, perm_names, roles):
+        '''
+        Replaces the saved permissions and roles, see load_definitions().
+        '''
+        with self.mutex, self.connection:
+            self.connection.execute('DELETE FROM permissions')
+            self.connection.executemany('INSERT INTO permissions (name) VALUES (?)', ((name,) for name in perm_names))
+            self.connection.execute('DELETE FROM roles')
+            self.connection.executemany('INSERT INTO roles (name, permissions, parents) VALUES (?, ?, ?)',
+                                        ((role, json.dumps(role_perms), json.dumps(parents))
+                                         for role, (role_perms, parents) in roles.items()))
+
+    def create_catalog(self, username):
+        '''
+        Returns the view of the shared catalog seen by the user.
+        '''
+        return self.catalog.view(username)
+
+    def __getitem__(self, username):
+        if username in self.loaded:
+            return self.loaded[username]
+        with self.mutex:
+            row = self.connection.execute('SELECT password, permissions, roles FROM users WHERE username = ?',
+                                          (username,)).fetchone()
+        if row is None:
+            raise KeyError(username)
+        user = auth.User.restore(username, row[0], self.create_catalog(username))
+        self.authorizer.restore(user, json.loads(row[1]), json.loads(row[2]))
+        self.loaded[username] = user
+        return user
+
+    def __setitem__(self, username, user):
+        with self.mutex, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO users (username, password, permissions, roles) '
+                                    'VALUES (?, ?, ?, ?)',
+                                    (username, user.password, json.dumps(self.authorizer.decode(user.permission_mask)),
+                                     json.dumps(sorted(user.roles))))
+        self.loaded[username] = user
+
+    def __delitem__(self, username):
+        with self.mutex, self.connection:
+            cursor = self.connection.execute('DELETE FROM users WHERE username = ?', (username,))
+        self.loaded.pop(username, None)
+        if not cursor.rowcount:
+            raise KeyError(username)
+
+    def __contains__(self, username):
+        if username in self.loaded:
+            return True
+        with self.mutex:
+            return self.connection.execute('SELECT 1 FROM users WHERE username = ?',
+                                           (username,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.mutex:
+            rows = self.connection.execute('SELECT username FROM users ORDER BY rowid').fetchall()
+        for row in rows:
+            yield row[0]
+
+    def __len__(self):
+        with self.mutex:
+            return self.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
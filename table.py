@@ -0,0 +1,314 @@
+'''
+Module with a columnar catalog of properties backed by NumPy arrays.
+'''
+import geo
+import text
+from facets import FACETS, sort_counts
+from fields import parse_range
+from index import PropertyIndex
+from main import Agent, Apartment, House
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PropertyTable:
+    '''
+    Catalog that stores every attribute of the properties in a typed NumPy column.
+    Categorical attributes are stored as small integer codes, searches are evaluated
+    as boolean masks and property objects are only created for the returned rows.
+    The free texts, the description and the address, are kept in Python lists; a "text" search
+    ranks the rows matching the other criteria, see text.search(). A "location" search selects
+    the rows in the bounding box of the area, and nearest() computes the distances over the columns.
+    Can be used in place of the default catalog: Agent(catalog=PropertyTable()).
+    The properties get the number of their row as table_row; for the properties without a __dict__,
+    such as those of slotted.SlottedAgent, the row is found again from their values.
+    '''
+
+    # column -> attribute of the property; the columns are named as the arguments of the constructors
+    numeric_columns = dict(PropertyIndex.numeric_attributes, latitude='latitude', longitude='longitude')
+    categorical_columns = PropertyIndex.attributes
+    text_columns = ('description', 'address')
+    categories = {
+        'balcony': Apartment.valid_balconies,
+        'laundry': Apartment.valid_laundries,
+        'garage': House.valid_garage,
+        'fenced': House.valid_fenced,
+        'furnished': ('yes', 'no')
+    }
+
+    def __init__(self, capacity=1024, type_map=None):
+        '''
+        :capacity: The number of rows allocated up front; the columns grow as needed.
+        :type_map: The classes of the properties, Agent.type_map by default. The classes registered
+        in it later, e.g. by kinds.ClassRegistry.register_kind(), are stored too.
+        '''
+        if numpy is None:
+            raise ImportError('PropertyTable requires numpy')
+        self.type_map = Agent.type_map if type_map is None else type_map
+        # the classes stored so far; the kind column holds their positions in this list
+        self.classes = []
+        self.class_codes = {}
+        self.size = 0
+        self.count = 0
+        self.kinds = numpy.full(capacity, -1, dtype=numpy.int8)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        self.numeric = {name: numpy.full(capacity, numpy.nan) for name in self.numeric_columns}
+        self.codes = {name: numpy.full(capacity, -1, dtype=numpy.int16) for name in self.categorical_columns}
+        # one string per row, empty when missing
+        self.texts = {name: [] for name in self.text_columns}
+        self.values = {name: list(self.categories.get(name, ())) for name in self.categorical_columns}
+        self.value_codes = {name: {value: code for code, value in enumerate(values)}
+                            for name, values in self.values.items()}
+
+    def _grow(self):
+        '''
+        Doubles the capacity of all the columns.
+        '''
+        capacity = len(self.kinds)
+        self.kinds = numpy.concatenate((self.kinds, numpy.full(capacity, -1, dtype=numpy.int8)))
+        self.alive = numpy.concatenate((self.alive, numpy.zeros(capacity, dtype=bool)))
+        for name, column in self.numeric.items():
+            self.numeric[name] = numpy.concatenate((column, numpy.full(capacity, numpy.nan)))
+        for name, column in self.codes.items():
+            self.codes[name] = numpy.concatenate((column, numpy.full(capacity, -1, dtype=numpy.int16)))
+
+    def _kind(self, PropertyClass):
+        '''
+        Returns the code of the class of the properties, registering the class if it is new.
+        '''
+        code = self.class_codes.get(PropertyClass)
+        if code is None:
+            if PropertyClass not in self.type_map.values():
+                raise TypeError('{} is not in the type map'.format(PropertyClass.__name__))
+            code = self.class_codes[PropertyClass] = len(self.classes)
+            self.classes.append(PropertyClass)
+        return code
+
+    def _code(self, name, value):
+        '''
+        Returns the code of the categorical value, registering the value if it is new.
+        '''
+        code = self.value_codes[name].get(value)
+        if code is None:
+            code = len(self.values[name])
+            self.values[name].append(value)
+            self.value_codes[name][value] = code
+        return code
+
+    def add(self, property):
+        '''
+        Appends the property to the table as a new row.
+        '''
+        kind = self._kind(type(property))
+        if self.size == len(self.kinds):
+            self._grow()
+        row = self.size
+        self.kinds[row] = kind
+        for name, attribute in self.numeric_columns.items():
+            value = getattr(property, attribute, None)
+            self.numeric[name][row] = numpy.nan if value is None else value
+        for name, attribute in self.categorical_columns.items():
+            value = getattr(property, attribute, None)
+            self.codes[name][row] = -1 if value is None else self._code(name, value)
+        for name, column in self.texts.items():
+            column.append(getattr(property, name, None) or '')
+        self.alive[row] = True
+        self.size += 1
+        self.count += 1
+        try:
+            property.table_row = row
+        except AttributeError:
+            pass
+
+    def extend(self, properties):
+        '''
+        Appends all the properties to the table.
+        '''
+        for property in properties:
+            self.add(property)
+
+    def _find_row(self, property):
+        '''
+        Returns the row of a property that was not created by the table, comparing all its attributes.
+        '''
+        mask = self.alive[:self.size] & (self.kinds[:self.size] == self.class_codes.get(type(property), -1))
+        for name, attribute in self.numeric_columns.items():
+            value = getattr(property, attribute, None)
+            column = self.numeric[name][:self.size]
+            mask &= numpy.isnan(column) if value is None else column == value
+        for name, attribute in self.categorical_columns.items():
+            value = getattr(property, attribute, None)
+            code = -1 if value is None else self.value_codes[name].get(value, -2)
+            mask &= self.codes[name][:self.size] == code
+        rows = [row for row in numpy.flatnonzero(mask)
+                if all(column[row] == (getattr(property, name, None) or '') for name, column in self.texts.items())]
+        if not rows:
+            raise ValueError('The property is not in the table')
+        return rows[0]
+
+    def remove(self, property):
+        '''
+        Marks the row of the property as deleted.
+        '''
+        self.alive[self.id_of(property)] = False
+        self.count -= 1
+
+    def get(self, listing_id):
+        '''
+        Returns the listing with the ID, which is the number of its row; raises KeyError if there is none.
+        '''
+        if not 0 <= listing_id < self.size or not self.alive[listing_id]:
+            raise KeyError(listing_id)
+        return self.build(listing_id)
+
+    def id_of(self, property):
+        '''
+        Returns the ID of the listing, the number of its row. Deleted rows are never reused, so IDs are stable.
+        '''
+        row = getattr(property, 'table_row', None)
+        if row is None or row >= self.size or not self.alive[row]:
+            row = self._find_row(property)
+        return int(row)
+
+    def stored(self, listing_ids):
+        '''
+        Returns the set of the IDs whose rows are not deleted.
+        '''
+        return {listing_id for listing_id in listing_ids if 0 <= listing_id < self.size and self.alive[listing_id]}
+
+    def _mask(self, property_class, criteria):
+        '''
+        Returns the boolean mask of the rows of the given class matching all the criteria.
+        '''
+        mask = self.alive[:self.size] & (self.kinds[:self.size] == self.class_codes.get(property_class, -1))
+        for name, value in criteria.items():
+            if name == 'text':
+                # see search()
+                continue
+            if name == 'location':
+                if value:
+                    mask &= self._box(geo.parse_area(value).box())
+                continue
+            if name in self.numeric:
+                value_range = parse_range(value)
+                column = self.numeric[name][:self.size]
+                mask &= ~numpy.isnan(column)
+                if value_range.low is not None:
+                    mask &= column >= value_range.low if value_range.low_inclusive else column > value_range.low
+                if value_range.high is not None:
+                    mask &= column <= value_range.high if value_range.high_inclusive else column < value_range.high
+            else:
+                code = self.value_codes[name].get(value)
+                if code is None:
+                    mask[:] = False
+                    break
+                mask &= self.codes[name][:self.size] == code
+        return mask
+
+    def _box(self, box):
+        '''
+        Returns the boolean mask of the rows located in the geo.Box; the rows without a location are not.
+        '''
+        latitudes = self.numeric['latitude'][:self.size]
+        longitudes = self.numeric['longitude'][:self.size]
+        mask = (latitudes >= box.south) & (latitudes <= box.north)
+        if box.west <= box.east:
+            return mask & (longitudes >= box.west) & (longitudes <= box.east)
+        # the box crosses the 180th meridian
+        return mask & ((longitudes >= box.west) | (longitudes <= box.east))
+
+    def build(self, row):
+        '''
+        Creates the property object stored in the row.
+        '''
+        init_args = {}
+        for name, column in self.numeric.items():
+            value = column[row]
+            if not numpy.isnan(value):
+                init_args[name] = int(value) if value.is_integer() else float(value)
+        for name, column in self.codes.items():
+            code = column[row]
+            if code >= 0:
+                init_args[name] = self.values[name][code]
+        for name, column in self.texts.items():
+            if column[row]:
+                init_args[name] = column[row]
+        property = self.classes[self.kinds[row]](**init_args)
+        try:
+            property.table_row = int(row)
+        except AttributeError:
+            pass
+        return property
+
+    def search(self, property_class, criteria):
+        '''
+        Returns the list of properties of the given class matching all the criteria, in the order they were added,
+        or ranked by relevance when searching the text.
+        :property_class: One of the classes of Agent.type_map.
+        :criteria: A dictionary of search parameters and their values.
+        '''
+        found = [self.build(row) for row in numpy.flatnonzero(self._mask(property_class, criteria))]
+        if criteria.get('location'):
+            # the mask holds the bounding box of the area
+            found = geo.within(found, criteria['location'])
+        if criteria.get('text'):
+            return text.search(found, criteria['text'])
+        return found
+
+    def nearest(self, property_class, latitude, longitude, k, criteria):
+        '''
+        Returns the list of the k properties of the given class matching all the criteria
+        nearest to the point, the nearest first. The distances are computed over the columns,
+        and only the k nearest properties are created.
+        '''
+        if criteria.get('text') or criteria.get('location'):
+            return geo.nearest(self.search(property_class, criteria), latitude, longitude, k)
+        latitudes = self.numeric['latitude'][:self.size]
+        longitudes = self.numeric['longitude'][:self.size]
+        rows = numpy.flatnonzero(self._mask(property_class, criteria) & ~numpy.isnan(latitudes) &
+                                 ~numpy.isnan(longitudes))
+        # the haversine formula of geo.distance()
+        phi, other_phi = numpy.radians(latitude), numpy.radians(latitudes[rows])
+        sin_phi = numpy.sin((other_phi - phi) / 2)
+        sin_lambda = numpy.sin(numpy.radians(longitudes[rows] - longitude) / 2)
+        a = sin_phi * sin_phi + numpy.cos(phi) * numpy.cos(other_phi) * sin_lambda * sin_lambda
+        distances = 2 * geo.EARTH_RADIUS * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(a)))
+        return [self.build(row) for row in rows[numpy.argsort(distances, kind='stable')[:k]]]
+
+    def facets(self, property_class):
+        '''
+        Returns the counts of the values of every facet among the properties of the class, see facets.py.
+        The counts are taken over the columns, without creating the properties.
+        '''
+        mask = self._mask(property_class, {})
+        found = {}
+        for facet in FACETS:
+            if facet in self.numeric:
+                column = self.numeric[facet][:self.size]
+                values, numbers = numpy.unique(column[mask & ~numpy.isnan(column)], return_counts=True)
+                counts = {int(value) if value.is_integer() else float(value): int(number)
+                          for value, number in zip(values, numbers)}
+            else:
+                column = self.codes[facet][:self.size]
+                numbers = numpy.bincount(column[mask & (column >= 0)], minlength=len(self.values[facet]))
+                counts = {value: int(number) for value, number in zip(self.values[facet], numbers)}
+            counts = sort_counts(counts)
+            if counts:
+                found[facet] = counts
+        return found
+
+    def slice(self, start, stop):
+        '''
+        Returns the list of the properties from position start up to position stop.
+        '''
+        return [self.build(row) for row in numpy.flatnonzero(self.alive[:self.size])[start:stop]]
+
+    def __iter__(self):
+        for row in numpy.flatnonzero(self.alive[:self.size]):
+            yield self.build(row)
+
+    def __len__(self):
+        return self.count
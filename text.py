@@ -0,0 +1,258 @@
+'''
+Module with the full-text index of the descriptions and the addresses of the listings.
+
+The text of a listing is split into lowercase words when it is added, and every word keeps the
+listings containing it together with the positions of the word in them. A query is a list of
+words that must all appear, with "quoted phrases" whose words must follow each other and
+prefixes such as park* matching every word starting with them:
+    agent.search('house', 'rental', text='"near the park" elm*', beds='3')
+The matching listings are ranked by BM25, the relevance score used by most search engines.
+'''
+import math
+import re
+from bisect import bisect_left
+from heapq import merge
+
+WORD = re.compile(r'\w+')
+QUERY = re.compile(r'"([^"]*)"|(\S+)')
+# the parameters of BM25: how fast repeated words stop adding to the score, and how much
+# the length of the text is taken into account
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    '''
+    Returns the list of the lowercase words of the text.
+    '''
+    return WORD.findall(text.lower()) if text else []
+
+
+def parse_query(query):
+    '''
+    Returns the phrases, the words and the prefixes of the query.
+    A phrase is a tuple of words; a word ending with * is a prefix.
+    '''
+    phrases, words, prefixes = [], [], []
+    for phrase, word in QUERY.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                phrases.append(tuple(tokens))
+            else:
+                words.extend(tokens)
+        else:
+            tokens = tokenize(word)
+            if word.endswith('*') and tokens:
+                # only the last word of e.g. o'neil* is a prefix
+                words.extend(tokens[:-1])
+                prefixes.append(tokens[-1])
+            else:
+                words.extend(tokens)
+    return phrases, words, prefixes
+
+
+class TextIndex:
+    '''
+    Inverted index of the free-text attributes of the properties.
+    Answers the "text" search parameter of PropertyIndex and ranks the results.
+    '''
+
+    def __init__(self, attributes=('description', 'address')):
+        '''
+        :attributes: The names of the indexed text attributes of the property.
+        '''
+        self.attributes = attributes
+        # word -> {property: positions of the word in its text}
+        self.postings = {}
+        # all the words, sorted, to find the words starting with a prefix
+        self.words = []
+        # property -> number of words of its text
+        self.lengths = {}
+        self.total_length = 0
+
+    def _positions(self, property):
+        '''
+        Returns the dictionary of the words of the property and their positions. The attributes are
+        numbered one after another with a gap, so that a phrase does not run from one into the next.
+        '''
+        positions, offset = {}, 0
+        for attribute in self.attributes:
+            tokens = tokenize(getattr(property, attribute, None))
+            for position, word in enumerate(tokens, offset):
+                positions.setdefault(word, []).append(position)
+            offset += len(tokens) + 1
+        return positions, offset - len(self.attributes)
+
+    def _insert(self, property):
+        '''
+        Adds the property to the postings and returns the words that were not indexed before.
+        '''
+        positions, length = self._positions(property)
+        if not positions:
+            return []
+        new, postings = [], self.postings
+        for word, found in positions.items():
+            posting = postings.get(word)
+            if posting is None:
+                posting = postings[word] = {}
+                new.append(word)
+            posting[property] = found
+        self.lengths[property] = length
+        self.total_length += length
+        return new
+
+    def add(self, property):
+        '''
+        Indexes the words of the property.
+        '''
+        for word in self._insert(property):
+            self.words.insert(bisect_left(self.words, word), word)
+
+    def extend(self, properties):
+        '''
+        Indexes all the properties, merging their new words with the sorted words once for the whole batch.
+        '''
+        new = []
+        for property in properties:
+            new.extend(self._insert(property))
+        if new:
+            self.words = list(merge(self.words, sorted(new)))
+
+    def remove(self, property):
+        '''
+        Removes the property from the postings of its words.
+        '''
+        length = self.lengths.pop(property, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for word in self._positions(property)[0]:
+            posting = self.postings.get(word)
+            if posting is None:
+                continue
+            posting.pop(property, None)
+            if not posting:
+                del self.postings[word]
+                position = bisect_left(self.words, word)
+                if position < len(self.words) and self.words[position] == word:
+                    del self.words[position]
+
+    def expand(self, prefix):
+        '''
+        Returns the indexed words starting with the prefix.
+        '''
+        found = []
+        for position in range(bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[position].startswith(prefix):
+                break
+            found.append(self.words[position])
+        return found
+
+    def _phrase(self, phrase, candidates):
+        '''
+        Returns the candidates in which the words of the phrase follow each other.
+        '''
+        postings = [self.postings[word] for word in phrase]
+        found = set()
+        for property in candidates:
+            starts = set(postings[0][property])
+            for offset, posting in enumerate(postings[1:], 1):
+                starts &= {position - offset for position in posting[property]}
+                if not starts:
+                    break
+            if starts:
+                found.add(property)
+        return found
+
+    def lookup(self, query):
+        '''
+        Returns the set of properties matching all the words, phrases and prefixes of the query.
+        '''
+        phrases, words, prefixes = parse_query(query)
+        required = set(words) | {word for phrase in phrases for word in phrase}
+        if not required and not prefixes:
+            return set(self.lengths)
+        if any(word not in self.postings for word in required):
+            return set()
+        groups = [self.postings[word].keys() for word in required]
+        for prefix in prefixes:
+            expanded = self.expand(prefix)
+            if not expanded:
+                return set()
+            if len(expanded) == 1:
+                groups.append(self.postings[expanded[0]].keys())
+            else:
+                groups.append(set().union(*(self.postings[word] for word in expanded)))
+        groups.sort(key=len)
+        found = set(groups[0])
+        for group in groups[1:]:
+            if not found:
+                break
+            found.intersection_update(group)
+        for phrase in phrases:
+            found = self._phrase(phrase, found)
+        return found
+
+    def _terms(self, query):
+        '''
+        Returns the set of the indexed words scored for the query, the prefixes being expanded.
+        '''
+        phrases, words, prefixes = parse_query(query)
+        terms = set(words) | {word for phrase in phrases for word in phrase}
+        for prefix in prefixes:
+            terms.update(self.expand(prefix))
+        return terms
+
+    def statistics(self, query):
+        '''
+        Returns the number of indexed texts, their total length in words and the number of texts
+        containing each word of the query, which are added up over the parts of a split collection.
+        '''
+        return len(self.lengths), self.total_length, {term: len(self.postings[term])
+                                                      for term in self._terms(query) if term in self.postings}
+
+    def scores(self, query, properties, statistics=None):
+        '''
+        Returns the BM25 scores of the properties for the words and prefixes of the query.
+        :statistics: The statistics of the whole collection when the index only holds a part of it,
+        e.g. one shard of sharded.ShardedCatalog, see statistics(); those of the index by default.
+        '''
+        count, total_length, containing = self.statistics(query) if statistics is None else statistics
+        average = total_length / count if count else 0
+        scores = dict.fromkeys(properties, 0.0)
+        for term, texts in containing.items():
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - texts + 0.5) / (texts + 0.5))
+            # the smaller of the two sets is walked
+            matching = posting.keys() & scores.keys() if len(posting) < len(scores) else \
+                [property for property in scores if property in posting]
+            for property in matching:
+                frequency = len(posting[property])
+                norm = K1 * (1 - B + B * self.lengths[property] / average) if average else K1
+                scores[property] += idf * frequency * (K1 + 1) / (frequency + norm)
+        return scores
+
+    def rank(self, properties, query, order):
+        '''
+        Returns the properties sorted by their score for the query, the best first;
+        properties with the same score keep the order given by the order dictionary.
+        '''
+        scores = self.scores(query, properties)
+        return sorted(properties, key=lambda property: (-scores[property], order[property]))
+
+
+def search(properties, query):
+    '''
+    Returns the properties matching the query ranked by relevance, the best first, for the catalogs
+    without a text index of their own, such as storage.SQLiteCatalog. A TextIndex of the properties
+    is built for the query, so the words are scored among these properties only.
+    :properties: The candidates in the order they were added, e.g. those matching the other criteria.
+    '''
+    index = TextIndex()
+    index.extend(properties)
+    found = index.lookup(query)
+    order = {property: position for position, property in enumerate(properties)}
+    return index.rank([property for property in properties if property in found], query, order)